@@ -0,0 +1,158 @@
+"""
+端到端消息处理基准测试
+
+在本进程内启动模拟的 NagaAgent 服务器，用多个模拟用户的消息事件驱动完整的
+NoneBot事件处理流程（匹配规则、准入控制、会话、API调用、工具调用和回复发送），
+统计吞吐量、延迟分布和内存占用。例如：
+
+    python benchmarks/bench_handler.py --users 200 --messages 5 --concurrency 64
+    python benchmarks/bench_handler.py --tool-ratio 0.3 --stream --set naga_max_concurrent_requests=16
+"""
+import argparse
+import asyncio
+import random
+import time
+import tracemalloc
+from typing import Dict, List
+
+from common import (
+    BenchEvent, format_table, init_nonebot, parse_overrides, percentile, rss_mb
+)
+from fake_server import FakeNagaServer, FakeServerConfig
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="NagaAgent 插件端到端基准测试")
+    parser.add_argument("--users", type=int, default=100, help="模拟用户数")
+    parser.add_argument("--messages", type=int, default=5, help="每个用户发送的消息数")
+    parser.add_argument("--concurrency", type=int, default=50, help="同时处理的最大事件数")
+    parser.add_argument("--group-ratio", type=float, default=0.5, help="群聊消息比例")
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟服务器对话接口延迟（秒）")
+    parser.add_argument("--tool-latency", type=float, default=0.02, help="模拟服务器工具调用延迟（秒）")
+    parser.add_argument("--reply-chars", type=int, default=200, help="对话回复长度")
+    parser.add_argument("--tool-result-chars", type=int, default=500, help="工具调用结果长度")
+    parser.add_argument("--tool-ratio", type=float, default=0.0, help="回复中包含工具调用的比例")
+    parser.add_argument("--tools-per-reply", type=int, default=1, help="每条回复包含的工具调用数")
+    parser.add_argument("--stream", action="store_true", help="使用流式接口分段回复")
+    parser.add_argument("--tracemalloc", action="store_true", help="统计Python内存分配峰值（会明显降低速度）")
+    parser.add_argument("--seed", type=int, default=42, help="随机数种子")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="覆盖插件配置，例如 --set naga_max_queue_size=10，可重复使用")
+    return parser.parse_args()
+
+
+def build_events(args: argparse.Namespace) -> List[BenchEvent]:
+    """按用户轮流生成消息事件，模拟多个用户交替发言"""
+    rng = random.Random(args.seed)
+    groups = max(1, args.users // 20)
+    user_groups = {
+        f"{10000 + i}": (rng.randrange(groups) + 1 if rng.random() < args.group_ratio else None)
+        for i in range(args.users)
+    }
+    events = []
+    for n in range(args.messages):
+        for user, group_id in user_groups.items():
+            events.append(BenchEvent(text=f"#naga 第{n + 1}条测试消息，来自用户{user}", user=user, group_id=group_id))
+    return events
+
+
+async def run(args: argparse.Namespace) -> None:
+    server = FakeNagaServer(FakeServerConfig(
+        chat_latency=args.latency,
+        tool_latency=args.tool_latency,
+        reply_chars=args.reply_chars,
+        tool_result_chars=args.tool_result_chars,
+        tool_ratio=args.tool_ratio,
+        tools_per_reply=args.tools_per_reply,
+        seed=args.seed
+    ))
+    await server.start()
+
+    config = {
+        "naga_api_host": server.host,
+        "naga_api_port": server.port,
+        "naga_stream_reply": args.stream,
+        # 基准测试关注处理路径本身，默认放开准入限制，可以通过 --set 覆盖
+        "naga_max_concurrent_requests": args.concurrency,
+        "naga_max_user_concurrent_requests": args.messages,
+        "naga_max_queue_size": len(build_events(args)),
+        "naga_max_user_queue_size": args.messages,
+        "naga_user_rate_limit": 0,
+    }
+    config.update(parse_overrides(args.set))
+    bot = init_nonebot(**config)
+
+    from nonebot.message import handle_event
+    from nonebot_plugin_naga import handlers
+
+    await handlers.open_session_store()
+    await handlers.start_health_monitor()
+    # 等待启动时的健康检查完成，避免第一批消息被当作服务不可用
+    for _ in range(100):
+        if handlers.naga_client.available:
+            break
+        await asyncio.sleep(0.01)
+
+    events = build_events(args)
+    latencies: List[float] = []
+    failures = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def process(event: BenchEvent) -> None:
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await handle_event(bot, event)
+            except Exception:
+                failures += 1
+            latencies.append(time.perf_counter() - start)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(process(event) for event in events))
+    # 开启任务模式时工具调用在后台执行，等待后台任务全部完成
+    while handlers.job_manager.pending:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    if args.tracemalloc:
+        tracemalloc.stop()
+
+    await handlers.close_naga_client()
+    await handlers.close_session_store()
+    await handlers.close_tracer()
+    await server.stop()
+
+    latencies.sort()
+    replies = sum(bot.sent.values())
+    silent_users = sum(1 for i in range(args.users) if f"{10000 + i}" not in bot.sent)
+    rows = [
+        ("指标", "值"),
+        ("事件数", str(len(events))),
+        ("总耗时", f"{elapsed:.3f} s"),
+        ("吞吐量", f"{len(events) / elapsed:.1f} 事件/秒"),
+        ("p50 延迟", f"{percentile(latencies, 50) * 1000:.1f} ms"),
+        ("p95 延迟", f"{percentile(latencies, 95) * 1000:.1f} ms"),
+        ("p99 延迟", f"{percentile(latencies, 99) * 1000:.1f} ms"),
+        ("最大延迟", f"{latencies[-1] * 1000:.1f} ms" if latencies else "-"),
+        ("发送消息数", str(replies)),
+        ("发送字符数", str(bot.sent_chars)),
+        ("未收到回复的用户", str(silent_users)),
+        ("处理异常", str(failures)),
+    ]
+    rows.extend(
+        (f"服务端请求 {path}", str(count))
+        for path, count in sorted(server.requests.items())
+    )
+    peak = rss_mb()
+    if peak is not None:
+        rows.append(("峰值常驻内存", f"{peak:.1f} MB"))
+    if traced_peak is not None:
+        rows.append(("Python分配峰值", f"{traced_peak / 1024 / 1024:.1f} MB"))
+    print(format_table(rows))
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
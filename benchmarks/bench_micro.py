@@ -0,0 +1,188 @@
+"""
+热点函数微基准测试
+
+分别测量工具调用解析、消息匹配规则和会话管理操作的单次耗时，
+不需要模拟服务器。例如：
+
+    python benchmarks/bench_micro.py
+    python benchmarks/bench_micro.py --only parse --number 20000
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Callable, List, Tuple
+
+from common import BenchEvent, format_table, init_nonebot
+
+
+def measure(func: Callable[[], object], number: int, repeat: int) -> Tuple[float, float]:
+    """
+    多轮重复执行函数
+
+    Returns:
+        (每次调用的最短平均耗时, 每次调用的中位平均耗时)，单位为秒
+    """
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        rounds.append((time.perf_counter() - start) / number)
+    rounds.sort()
+    return rounds[0], rounds[len(rounds) // 2]
+
+
+def measure_async(loop: asyncio.AbstractEventLoop, func: Callable[[], object],
+                  number: int, repeat: int) -> Tuple[float, float]:
+    """在同一个事件循环中多轮重复执行协程函数"""
+
+    async def batch() -> float:
+        start = time.perf_counter()
+        for _ in range(number):
+            await func()
+        return (time.perf_counter() - start) / number
+
+    rounds = sorted(loop.run_until_complete(batch()) for _ in range(repeat))
+    return rounds[0], rounds[len(rounds) // 2]
+
+
+def handoff_text(calls: int, payload_chars: int, noise_chars: int) -> str:
+    """生成包含工具调用的LLM回复"""
+    parts = ["好的，我来帮你查询相关信息。" * (noise_chars // 15 + 1)]
+    for i in range(calls):
+        parts.append(json.dumps({
+            "agentType": "mcp",
+            "service_name": f"service_{i}",
+            "tool_name": "search",
+            "query": {"keyword": "天气" * (payload_chars // 2), "filters": {"city": "上海", "days": [1, 2, 3]}}
+        }, ensure_ascii=False))
+        parts.append("接下来继续处理。")
+    return "\n".join(parts)
+
+
+def bench_parse(number: int, repeat: int) -> List[Tuple[str, float, float]]:
+    from nonebot_plugin_naga.utils import parse_handoff_calls, parse_handoff_content
+
+    cases = [
+        ("parse 无工具调用", "这是一段普通回复，没有任何工具调用。" * 20),
+        ("parse 单个小调用", handoff_text(1, 20, 50)),
+        ("parse 全角括号", handoff_text(1, 20, 50).replace("{", "｛").replace("}", "｝")),
+        ("parse 大参数", handoff_text(1, 4000, 50)),
+        ("parse 长文本中的调用", handoff_text(1, 20, 8000)),
+        ("parse 大量无关括号", "{a} {b: {c}} " * 500 + handoff_text(1, 20, 50)),
+        ("parse 不成对的引号", '{ 看这里 "引号 ' + handoff_text(1, 20, 50)),
+        ("parse 大量左括号后的引号", "{" * 2000 + '"x'),
+        ("parse 大量未闭合的字符串", '{"' * 2000 + handoff_text(1, 20, 50)),
+    ]
+    results = []
+    for name, text in cases:
+        results.append((name, *measure(lambda: parse_handoff_content(text), number, repeat)))
+    multi = handoff_text(5, 100, 200)
+    results.append(("parse_handoff_calls 5个调用", *measure(lambda: parse_handoff_calls(multi), number, repeat)))
+    return results
+
+
+def bench_match(loop: asyncio.AbstractEventLoop, bot, number: int,
+                repeat: int) -> List[Tuple[str, float, float]]:
+    from nonebot_plugin_naga.handlers import matcher_engine, message_match_naga
+
+    # 预先注册一批自定义前缀，模拟已有大量用户设置前缀的情况
+    for i in range(1000):
+        matcher_engine.set_user_prefix(f"Bench_{20000 + i}", f"!ai{i}", None)
+    matcher_engine.set_user_prefix("Bench_10001", "小娜", None)
+
+    cases = [
+        ("match 普通消息", BenchEvent(text="今天天气不错，我们出去玩吧", user="10000")),
+        ("match 群聊普通消息", BenchEvent(text="今天天气不错", user="10000", group_id=1)),
+        ("match #naga 消息", BenchEvent(text="#naga 你好", user="10000")),
+        ("match 自定义前缀", BenchEvent(text="小娜 你好", user="10001")),
+        ("match 长消息", BenchEvent(text="这是一条很长的普通消息。" * 200, user="10000")),
+    ]
+    results = []
+    for name, event in cases:
+        results.append((name, *measure_async(loop, lambda: message_match_naga(bot, event, {}), number, repeat)))
+    return results
+
+
+def bench_sessions(loop: asyncio.AbstractEventLoop, number: int, repeat: int) -> List[Tuple[str, float, float]]:
+    from nonebot_plugin_naga.sessions import SessionIdAllocator
+    from nonebot_plugin_naga.storage import SessionStore
+
+    store = SessionStore(":memory:", flush_interval=0, max_cached_users=0)
+    allocator = SessionIdAllocator(store)
+    users = [f"user_{i}" for i in range(1000)]
+
+    async def prepare() -> None:
+        await store.open()
+        for user in users:
+            state = await store.get_user(user)
+            state.sessions["default"] = await allocator.allocate()
+            state.active = "default"
+            store.mark_dirty(user)
+        await store.flush()
+
+    loop.run_until_complete(prepare())
+    counter = iter(range(10 ** 9))
+
+    async def get_cached() -> None:
+        await store.get_user(users[next(counter) % len(users)])
+
+    async def modify() -> None:
+        user = users[next(counter) % len(users)]
+        state = await store.get_user(user)
+        state.active = "default"
+        store.mark_dirty(user)
+
+    results = [
+        ("session get 已缓存", *measure_async(loop, get_cached, number, repeat)),
+        ("session 修改并标记", *measure_async(loop, modify, number, repeat)),
+        ("session 分配ID", *measure_async(loop, allocator.allocate, number, repeat)),
+    ]
+    loop.run_until_complete(store.flush())
+
+    async def reload() -> None:
+        for user in users:
+            await store.get_user(user)
+
+    # 淘汰只在有空闲用户时才有意义，每轮重新构造空闲状态
+    evict_times = []
+    for _ in range(repeat):
+        store.idle_timeout = 1e-9
+        start = time.perf_counter()
+        store.evict()
+        evict_times.append(time.perf_counter() - start)
+        store.idle_timeout = 0
+        loop.run_until_complete(reload())
+    evict_times.sort()
+    results.append(("session evict 1000个空闲", evict_times[0], evict_times[len(evict_times) // 2]))
+    results.append(("session evict 无空闲", *measure(store.evict, number, repeat)))
+    loop.run_until_complete(store.close())
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="NagaAgent 插件微基准测试")
+    parser.add_argument("--number", type=int, default=2000, help="每轮执行次数")
+    parser.add_argument("--repeat", type=int, default=5, help="重复轮数")
+    parser.add_argument("--only", choices=["parse", "match", "session"], help="只运行指定类别")
+    args = parser.parse_args()
+
+    bot = init_nonebot()
+    loop = asyncio.new_event_loop()
+    results: List[Tuple[str, float, float]] = []
+    if args.only in (None, "parse"):
+        results.extend(bench_parse(args.number, args.repeat))
+    if args.only in (None, "match"):
+        results.extend(bench_match(loop, bot, args.number, args.repeat))
+    if args.only in (None, "session"):
+        results.extend(bench_sessions(loop, args.number, args.repeat))
+    loop.close()
+
+    rows = [("用例", "最快 (µs)", "中位 (µs)")]
+    rows.extend((name, f"{best * 1e6:.2f}", f"{median * 1e6:.2f}") for name, best, median in results)
+    print(format_table(rows))
+
+
+if __name__ == "__main__":
+    main()
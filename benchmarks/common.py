@@ -0,0 +1,182 @@
+"""
+基准测试公共组件
+
+提供模拟的适配器、机器人、消息与事件，以及初始化NoneBot并加载插件的辅助函数，
+基准测试不需要连接任何真实的聊天平台
+"""
+import json
+import math
+import os
+import sys
+import unicodedata
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# 允许在仓库根目录直接运行 python benchmarks/xxx.py
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import nonebot
+from nonebot.adapters import Adapter, Bot, Event, Message, MessageSegment
+
+
+class BenchSegment(MessageSegment["BenchMessage"]):
+    """纯文本消息段"""
+
+    @classmethod
+    def get_message_class(cls):
+        return BenchMessage
+
+    def __str__(self) -> str:
+        return self.data.get("text", "")
+
+    def is_text(self) -> bool:
+        return self.type == "text"
+
+
+class BenchMessage(Message[BenchSegment]):
+    """纯文本消息"""
+
+    @classmethod
+    def get_segment_class(cls):
+        return BenchSegment
+
+    @staticmethod
+    def _construct(msg: str) -> Iterable[BenchSegment]:
+        yield BenchSegment("text", {"text": msg})
+
+
+class BenchAdapter(Adapter):
+    """不连接任何平台的适配器"""
+
+    @classmethod
+    def get_name(cls) -> str:
+        return "Bench"
+
+    async def _call_api(self, bot: Bot, api: str, **data: Any) -> Any:
+        return None
+
+
+class BenchBot(Bot):
+    """记录发送次数而不实际发送消息的机器人"""
+
+    def __init__(self, adapter: Adapter, self_id: str):
+        super().__init__(adapter, self_id)
+        # 每个用户收到的消息数 {user_id: count}
+        self.sent: Dict[str, int] = {}
+        self.sent_chars = 0
+
+    async def send(self, event: Event, message: Any, **kwargs: Any) -> Any:
+        user_id = event.get_user_id()
+        self.sent[user_id] = self.sent.get(user_id, 0) + 1
+        self.sent_chars += len(str(message))
+
+
+class BenchEvent(Event):
+    """私聊或群聊文本消息事件"""
+
+    text: str
+    user: str
+    group_id: Optional[int] = None
+
+    def get_type(self) -> str:
+        return "message"
+
+    def get_event_name(self) -> str:
+        return "message.group" if self.group_id is not None else "message.private"
+
+    def get_event_description(self) -> str:
+        return self.text
+
+    def get_user_id(self) -> str:
+        return self.user
+
+    def get_session_id(self) -> str:
+        return f"{self.group_id}_{self.user}" if self.group_id is not None else self.user
+
+    def get_message(self) -> BenchMessage:
+        return BenchMessage(self.text)
+
+    def is_tome(self) -> bool:
+        return True
+
+
+def init_nonebot(**config: Any) -> BenchBot:
+    """
+    初始化NoneBot并加载插件
+
+    Args:
+        config: 传给 nonebot.init 的配置项，例如 naga_api_port
+
+    Returns:
+        模拟机器人
+    """
+    config.setdefault("naga_store_path", ":memory:")
+    config.setdefault("log_level", "WARNING")
+    nonebot.init(driver="~none", **config)
+    driver = nonebot.get_driver()
+    bot = BenchBot(BenchAdapter(driver), "bench")
+    nonebot.load_plugin("nonebot_plugin_naga")
+    return bot
+
+
+def parse_overrides(items: Sequence[str]) -> Dict[str, Any]:
+    """
+    解析命令行中的 key=value 配置覆盖，值按JSON解析，解析失败时作为字符串
+
+    Args:
+        items: key=value 列表
+
+    Returns:
+        配置字典
+    """
+    result = {}
+    for item in items:
+        key, _, value = item.partition("=")
+        try:
+            result[key.strip()] = json.loads(value)
+        except ValueError:
+            result[key.strip()] = value
+    return result
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    计算百分位数（最近秩法）
+
+    Args:
+        values: 已排序的样本
+        p: 百分位，0-100
+
+    Returns:
+        百分位数，没有样本时返回0
+    """
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+def _display_width(text: str) -> int:
+    """终端显示宽度，中文等全角字符占两列"""
+    return sum(2 if unicodedata.east_asian_width(ch) in "WF" else 1 for ch in text)
+
+
+def format_table(rows: List[Tuple[str, ...]]) -> str:
+    """将多行结果格式化为左对齐的表格"""
+    widths = [max(_display_width(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(cell + " " * (width - _display_width(cell)) for cell, width in zip(row, widths)).rstrip()
+        for row in rows
+    )
+
+
+def rss_mb() -> Optional[float]:
+    """当前进程的峰值常驻内存（MB），不支持的平台返回None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux以KB为单位，macOS以字节为单位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
@@ -0,0 +1,213 @@
+"""
+本地模拟 NagaAgent 服务器
+
+只依赖标准库，实现插件用到的全部接口，延迟、回复长度和工具调用比例均可配置。
+既可以在基准测试进程内启动，也可以单独运行供手动测试：
+
+    python benchmarks/fake_server.py --port 8000 --latency 0.2
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+
+@dataclass
+class FakeServerConfig:
+    """模拟服务器配置"""
+    # 对话接口延迟（秒）
+    chat_latency: float = 0.05
+    # 工具调用接口延迟（秒）
+    tool_latency: float = 0.02
+    # 延迟的随机抖动比例，0.2表示在 ±20% 范围内波动
+    jitter: float = 0.2
+    # 对话回复长度（字符）
+    reply_chars: int = 200
+    # 工具调用结果长度（字符）
+    tool_result_chars: int = 500
+    # 对话回复中包含工具调用的比例
+    tool_ratio: float = 0.0
+    # 每条回复包含的工具调用数
+    tools_per_reply: int = 1
+    # 流式回复每个数据块的字符数
+    stream_chunk_chars: int = 20
+    # 随机数种子，保证多次运行结果可复现
+    seed: int = 42
+
+
+class FakeNagaServer:
+    """基于 asyncio 的最小HTTP/1.1服务器，支持keep-alive和分块传输"""
+
+    def __init__(self, config: Optional[FakeServerConfig] = None):
+        self.config = config or FakeServerConfig()
+        self.random = random.Random(self.config.seed)
+        self.requests: Dict[str, int] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._session_ids = itertools.count(1)
+        self.host = "127.0.0.1"
+        self.port = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        """启动服务器，port为0时自动分配空闲端口"""
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        self.host, self.port = self._server.sockets[0].getsockname()[:2]
+
+    async def stop(self) -> None:
+        """停止服务器"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _sleep(self, base: float) -> None:
+        """按配置的抖动模拟处理延迟"""
+        if base <= 0:
+            return
+        jitter = self.config.jitter
+        await asyncio.sleep(base * self.random.uniform(1 - jitter, 1 + jitter))
+
+    def _text(self, chars: int) -> str:
+        """生成指定长度的回复文本，每句以句号结尾以便流式分段"""
+        sentence = "这是模拟的NagaAgent回复内容。"
+        return (sentence * (chars // len(sentence) + 1))[:chars]
+
+    def _reply(self, message: str) -> str:
+        """生成对话回复，按比例附带工具调用"""
+        config = self.config
+        text = self._text(config.reply_chars)
+        # 工具调用结果的后续对话直接给出最终回复，避免无限循环
+        if message.startswith("工具") or self.random.random() >= config.tool_ratio:
+            return text
+        calls = [
+            json.dumps({
+                "agentType": "mcp",
+                "service_name": f"bench_tool_{i}",
+                "tool_name": "lookup",
+                "query": {"keyword": message[:20], "options": {"limit": 5}}
+            }, ensure_ascii=False)
+            for i in range(config.tools_per_reply)
+        ]
+        return "好的，我来查询一下。" + " ".join(calls)
+
+    async def _route(self, method: str, path: str, body: bytes) -> Tuple[int, object]:
+        """处理普通请求，返回 (状态码, JSON对象)"""
+        self.requests[path] = self.requests.get(path, 0) + 1
+        data = json.loads(body) if body else {}
+        if path == "/health":
+            return 200, {"status": "ok"}
+        if path == "/system/info":
+            return 200, {"version": "bench", "status": "running"}
+        if path == "/system/devmode":
+            return 200, {"status": "success", "enabled": data.get("enabled")}
+        if path == "/chat":
+            await self._sleep(self.config.chat_latency)
+            return 200, {
+                "status": "success",
+                "response": self._reply(data.get("message", "")),
+                "session_id": data.get("session_id") or f"bench-{next(self._session_ids)}"
+            }
+        if path == "/mcp/handoff":
+            await self._sleep(self.config.tool_latency)
+            return 200, {
+                "status": "success",
+                "service_name": data.get("service_name"),
+                "result": self._text(self.config.tool_result_chars)
+            }
+        return 404, {"status": "error", "message": f"未知接口: {method} {path}"}
+
+    async def _stream(self, writer: asyncio.StreamWriter, body: bytes) -> None:
+        """以SSE分块发送流式回复"""
+        self.requests["/chat/stream"] = self.requests.get("/chat/stream", 0) + 1
+        data = json.loads(body) if body else {}
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream; charset=utf-8\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+        session_id = data.get("session_id") or f"bench-{next(self._session_ids)}"
+        reply = self._reply(data.get("message", ""))
+        size = max(1, self.config.stream_chunk_chars)
+        pieces = [reply[i:i + size] for i in range(0, len(reply), size)]
+        events = [f"data: session_id: {session_id}\n\n"]
+        events.extend(f"data: {piece}\n\n" for piece in pieces)
+        events.append("data: [DONE]\n\n")
+        # 首包延迟占总延迟的一半，其余平均分摊到每个数据块
+        await self._sleep(self.config.chat_latency / 2)
+        per_chunk = self.config.chat_latency / 2 / max(1, len(pieces))
+        for event in events:
+            payload = event.encode("utf-8")
+            writer.write(f"{len(payload):X}\r\n".encode() + payload + b"\r\n")
+            await writer.drain()
+            await self._sleep(per_chunk)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """处理一个TCP连接上的所有请求"""
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                body = await reader.readexactly(length) if length else b""
+                path = target.split("?", 1)[0]
+
+                if path == "/chat/stream":
+                    await self._stream(writer, body)
+                    continue
+
+                status, obj = await self._route(method, path, body)
+                payload = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+                reason = "OK" if status == 200 else "Not Found"
+                writer.write(
+                    f"HTTP/1.1 {status} {reason}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+async def _serve_forever(args: argparse.Namespace) -> None:
+    config = FakeServerConfig(
+        chat_latency=args.latency,
+        tool_latency=args.tool_latency,
+        reply_chars=args.reply_chars,
+        tool_result_chars=args.tool_result_chars,
+        tool_ratio=args.tool_ratio
+    )
+    server = FakeNagaServer(config)
+    await server.start(args.host, args.port)
+    print(f"模拟 NagaAgent 服务器已启动: http://{server.host}:{server.port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地模拟 NagaAgent 服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05, help="对话接口延迟（秒）")
+    parser.add_argument("--tool-latency", type=float, default=0.02, help="工具调用接口延迟（秒）")
+    parser.add_argument("--reply-chars", type=int, default=200, help="对话回复长度")
+    parser.add_argument("--tool-result-chars", type=int, default=500, help="工具调用结果长度")
+    parser.add_argument("--tool-ratio", type=float, default=0.0, help="回复中包含工具调用的比例")
+    try:
+        asyncio.run(_serve_forever(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -1,40 +1,426 @@
 import httpx
-from typing import AsyncGenerator, Dict, Any, Optional
+from typing import AsyncGenerator, Dict, Any, List, Optional
+import asyncio
+import importlib.util
 import json
 import logging
+import time
 
-from . import plugin_config
+from . import deadline, plugin_config
+from .cache import SingleFlight, ToolResultCache, canonical_hash
+from .health import CircuitBreaker
+from .metrics import ERRORS, REQUEST_DURATION, REQUESTS, error_type
+from .retry import NOT_SENT_ERRORS, RetryBudget, backoff_delay, is_retryable
+from .routing import Backend, BackendRouter, normalize_backend_url
+from .sse import SSEDecoder, SSEEvent
+from .tracing import tracer
 
 
 # 创建日志记录器
 logger = logging.getLogger(__name__)
 
+# 指标中使用的接口名称
+ENDPOINT_NAMES = {
+    "/chat": "chat",
+    "/chat/stream": "chat_stream",
+    "/mcp/handoff": "mcp_handoff",
+    "/system/info": "system/info",
+    "/system/devmode": "system/devmode",
+    "/health": "health"
+}
+
+# 流式接口JSON数据块可能包含的字段
+STREAM_ENVELOPE_KEYS = {"type", "status", "content", "response", "text", "session_id", "message"}
+
+
+def parse_stream_event(event: SSEEvent) -> Optional[Dict[str, Any]]:
+    """
+    将流式接口的SSE事件转换为统一的流式事件字典
+    
+    NagaAgent 的流式接口会以 "session_id: xxx" 的形式下发会话ID，
+    回复内容可能是纯文本，也可能是包含content/response字段的JSON
+    
+    Args:
+        event: 解码后的SSE事件
+        
+    Returns:
+        流式事件字典，内容为空时返回None
+    """
+    payload = event.data
+    if event.event == "error":
+        return {"type": "error", "message": payload or "流式调用失败"}
+    if event.event == "session":
+        return {"type": "session", "session_id": payload.strip()}
+    if payload.startswith("session_id:"):
+        return {"type": "session", "session_id": payload[11:].strip()}
+    if payload.startswith("{"):
+        # 只有包含流式信封字段的JSON才拆包，LLM输出的工具调用JSON按原文处理
+        obj = event.json()
+        if isinstance(obj, dict) and "agentType" not in obj and obj.keys() & STREAM_ENVELOPE_KEYS:
+            if obj.get("status") == "error":
+                return {"type": "error", "message": obj.get("message", "流式调用失败")}
+            if obj.get("session_id") and not (obj.get("content") or obj.get("response")):
+                return {"type": "session", "session_id": obj["session_id"]}
+            text = obj.get("content") or obj.get("response") or obj.get("text") or ""
+            return {"type": "content", "content": text} if text else None
+    return {"type": "content", "content": payload} if payload else None
+
 
 class NagaAgentClient:
     """NagaAgent API 客户端，用于与NagaAgent服务进行交互"""
     
     def __init__(self):
         """初始化客户端"""
-        self.base_url = f"http://{plugin_config.naga_api_host}:{plugin_config.naga_api_port}"
-        # 设置较长的超时时间以支持长响应
-        self.client = httpx.AsyncClient(timeout=httpx.Timeout(300.0))
+        backend_urls = plugin_config.naga_api_backends or [
+            f"{plugin_config.naga_api_host}:{plugin_config.naga_api_port}"
+        ]
+        # 每个后端节点有独立的熔断器，节点不可用时会被自动摘除，请求立即失败而不是等待超时
+        self.backends: List[Backend] = [
+            Backend(
+                normalize_backend_url(url),
+                CircuitBreaker(
+                    failure_threshold=plugin_config.naga_circuit_failure_threshold,
+                    recovery_timeout=plugin_config.naga_circuit_recovery_timeout,
+                    half_open_max_calls=plugin_config.naga_circuit_half_open_max_calls,
+                    name=f"NagaAgent({normalize_backend_url(url)})"
+                ),
+                ewma_alpha=plugin_config.naga_backend_ewma_alpha
+            )
+            for url in dict.fromkeys(backend_urls)
+        ]
+        self.router = BackendRouter(self.backends, max_affinity=plugin_config.naga_backend_max_affinity)
+        self.client = self._build_client()
+        # 重试预算，后端整体故障时限制重试请求的比例
+        self.retry_budget = RetryBudget(ratio=plugin_config.naga_retry_budget_ratio)
+        # MCP工具调用结果缓存，只对白名单中的服务生效
+        self.tool_cache = ToolResultCache(
+            plugin_config.naga_tool_cache_services,
+            max_size=plugin_config.naga_tool_cache_size
+        )
+        # 相同请求合并，同一时刻的重复请求共享同一个结果
+        self.single_flight = SingleFlight()
+    
+    @property
+    def available(self) -> bool:
+        """是否存在可能可用的后端节点"""
+        return self.router.available
+    
+    @staticmethod
+    def _build_client() -> httpx.AsyncClient:
+        """根据插件配置创建带连接池的HTTP客户端"""
+        limits = httpx.Limits(
+            max_connections=plugin_config.naga_max_connections,
+            max_keepalive_connections=plugin_config.naga_max_keepalive_connections,
+            keepalive_expiry=plugin_config.naga_keepalive_expiry
+        )
+        # 读取超时需要较长时间以支持长响应，其余阶段单独设置以便尽早发现问题
+        timeout = httpx.Timeout(
+            connect=plugin_config.naga_connect_timeout,
+            read=plugin_config.naga_read_timeout,
+            write=plugin_config.naga_write_timeout,
+            pool=plugin_config.naga_pool_timeout
+        )
+        http2 = plugin_config.naga_http2
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("未安装 h2，无法启用HTTP/2，请使用 pip install httpx[http2] 安装，已回退到HTTP/1.1")
+            http2 = False
+        return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2)
+    
+    async def close(self) -> None:
+        """关闭HTTP客户端，释放连接池中的所有连接"""
+        await self.client.aclose()
+        logger.debug("NagaAgent API 客户端已关闭")
+    
+    @staticmethod
+    def _record_error(backend: Backend, error: Exception) -> None:
+        """根据请求异常更新节点熔断器状态"""
+        if isinstance(error, httpx.HTTPStatusError):
+            # 只有服务端错误才说明后端不健康
+            if error.response.status_code >= 500:
+                backend.breaker.record_failure()
+            else:
+                backend.breaker.record_success()
+        elif isinstance(error, httpx.PoolTimeout):
+            # 连接池繁忙是本地资源不足，不计入后端失败
+            backend.breaker.release_probe()
+        else:
+            backend.breaker.record_failure()
+    
+    def _acquire_backend(self, session_id: Optional[str] = None,
+                         exclude: tuple = ()) -> Optional[Backend]:
+        """选择后端节点并占用熔断器的放行名额，没有可用节点时返回None"""
+        tried = list(exclude)
+        while True:
+            backend = self.router.pick(session_id, exclude=tried)
+            if backend is None:
+                return None
+            if backend.breaker.allow_request():
+                return backend
+            tried.append(backend)
+            if len(self.backends) == 1:
+                return None
+    
+    @staticmethod
+    def _error_result(error: Exception, action: str) -> Dict[str, Any]:
+        """将请求异常转换为错误字典"""
+        if isinstance(error, httpx.HTTPStatusError):
+            error_msg = f"HTTP错误 {error.response.status_code}: {getattr(error.response, 'text', str(error))}"
+            logger.error(f"{action}HTTP错误: {error_msg}")
+        elif isinstance(error, httpx.PoolTimeout):
+            logger.warning("等待连接池空闲连接超时，请考虑调大 naga_max_connections")
+            error_msg = "NagaAgent API 连接繁忙，请稍后重试"
+        else:
+            error_msg = f"无法连接到 NagaAgent API: {str(error)}"
+            logger.error(f"{action}请求错误: {error_msg}")
+        return {
+            "status": "error",
+            "message": error_msg
+        }
+    
+    @staticmethod
+    def _timeout_result(timeout: float, action: str) -> Dict[str, Any]:
+        """生成超时错误字典，区分请求自身超时和整体处理时间预算用完"""
+        if deadline.expired():
+            logger.warning(f"{action}未完成，处理时间预算已用完")
+            error_msg = "处理时间预算已用完"
+        else:
+            logger.warning(f"{action}超时（{timeout:g}秒）")
+            error_msg = f"请求超时（{timeout:g}秒）"
+        return {
+            "status": "error",
+            "message": error_msg,
+            "timeout": True
+        }
+    
+    def _capped_timeout(self, limit: Optional[float]) -> httpx.Timeout:
+        """将客户端的各项超时限制在limit秒以内"""
+        base = self.client.timeout
+        if limit is None:
+            return base
+        
+        def cap(value: Optional[float]) -> float:
+            return limit if value is None else min(value, limit)
+        
+        return httpx.Timeout(connect=cap(base.connect), read=cap(base.read),
+                             write=cap(base.write), pool=cap(base.pool))
+    
+    def _acquire_retry_backend(self, failed: Backend, session_id: Optional[str] = None) -> Optional[Backend]:
+        """
+        为重试选择节点
+        
+        已绑定会话的请求只要原节点未被摘除就继续使用原节点以保持上下文，
+        其他请求优先换到别的节点
+        """
+        if session_id:
+            return self._acquire_backend(session_id)
+        return self._acquire_backend(exclude=(failed,)) or self._acquire_backend()
+    
+    async def _request(self, method: str, path: str, data: Optional[Dict[str, Any]] = None,
+                       action: str = "API调用", idempotent: bool = False,
+                       session_id: Optional[str] = None,
+                       backend: Optional[Backend] = None,
+                       timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        统一的请求流程，负责节点选择、熔断判断、失败重试、被动健康记录和错误转换
+        
+        幂等请求在网络错误和网关错误时重试，非幂等请求只在请求尚未发出
+        （例如连接失败）时重试，重试间隔为带随机抖动的指数退避，并受重试预算限制
+        
+        Args:
+            method: HTTP方法
+            path: 接口路径
+            data: 请求体（可选）
+            action: 操作名称，用于日志
+            idempotent: 请求是否幂等
+            session_id: 会话ID（可选），用于将同一会话固定到同一节点
+            backend: 指定请求的节点（可选），不指定时由路由器选择
+            timeout: 单次请求的总超时（秒），实际超时不超过当前请求剩余的处理时间预算
+            
+        Returns:
+            API响应结果，失败时返回包含status和message字段的错误字典
+        """
+        pinned = backend is not None
+        if pinned:
+            if not backend.breaker.allow_request():
+                backend = None
+        else:
+            backend = self._acquire_backend(session_id)
+        if backend is None:
+            logger.debug(f"{action}被熔断器拒绝")
+            return {
+                "status": "error",
+                "message": "NagaAgent API 暂时不可用，请稍后重试"
+            }
+        
+        endpoint = ENDPOINT_NAMES.get(path, path.lstrip("/"))
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            limit = deadline.budget(timeout)
+            if limit is not None and limit <= 0:
+                backend.breaker.release_probe()
+                return self._timeout_result(0.0, action)
+            current = backend
+            current.inflight += 1
+            outcome = "error"
+            start = time.monotonic()
+            span = tracer.start_span(f"http {endpoint}", backend=current.base_url, attempt=attempt)
+            try:
+                response = await asyncio.wait_for(
+                    self.client.request(method, f"{current.base_url}{path}", json=data, headers=tracer.headers(span)),
+                    limit
+                )
+                response.raise_for_status()  # 检查HTTP错误
+                result = response.json()
+                outcome = "success"
+            except (httpx.HTTPStatusError, httpx.RequestError) as e:
+                ERRORS.labels(endpoint, error_type(e)).inc()
+                self._record_error(backend, e)
+                if (
+                    attempt < plugin_config.naga_retry_attempts
+                    and is_retryable(e, idempotent)
+                    and self.retry_budget.withdraw()
+                ):
+                    delay = backoff_delay(
+                        attempt,
+                        plugin_config.naga_retry_backoff_base,
+                        plugin_config.naga_retry_backoff_max
+                    )
+                    left = deadline.remaining()
+                    if left is not None and left <= delay:
+                        # 剩余时间不够再重试一次
+                        return self._error_result(e, action)
+                    attempt += 1
+                    logger.warning(f"{action}失败，{delay:.2f}秒后进行第 {attempt} 次重试: {e!r}")
+                    await asyncio.sleep(delay)
+                    # 重试时优先换到其他节点，节点熔断后不再继续重试
+                    if pinned:
+                        retry_backend = backend if backend.breaker.allow_request() else None
+                    else:
+                        retry_backend = self._acquire_retry_backend(backend, session_id)
+                    if retry_backend is not None:
+                        backend = retry_backend
+                        continue
+                return self._error_result(e, action)
+            except asyncio.TimeoutError as e:
+                outcome = "timeout"
+                ERRORS.labels(endpoint, error_type(e)).inc()
+                if deadline.expired():
+                    # 预算用完导致的超时不能说明后端不健康
+                    backend.breaker.release_probe()
+                else:
+                    backend.breaker.record_failure()
+                return self._timeout_result(limit, action)
+            except json.JSONDecodeError as e:
+                ERRORS.labels(endpoint, "JSONDecodeError").inc()
+                backend.breaker.record_success()
+                error_msg = f"API响应格式错误: {str(e)}"
+                logger.error(f"{action}JSON解析错误: {error_msg}")
+                return {
+                    "status": "error",
+                    "message": error_msg
+                }
+            except asyncio.CancelledError:
+                # 调用方超时或取消，无法判断后端是否健康
+                outcome = "cancelled"
+                backend.breaker.release_probe()
+                raise
+            except Exception as e:
+                ERRORS.labels(endpoint, error_type(e)).inc()
+                backend.breaker.release_probe()
+                error_msg = f"API调用失败: {str(e)}"
+                logger.error(f"{action}未知错误: {error_msg}")
+                return {
+                    "status": "error",
+                    "message": error_msg
+                }
+            finally:
+                elapsed = time.monotonic() - start
+                current.inflight -= 1
+                current.record_latency(elapsed)
+                REQUESTS.labels(endpoint, outcome).inc()
+                REQUEST_DURATION.labels(endpoint).observe(elapsed)
+                span.end("ok" if outcome == "success" else outcome)
+            
+            backend.breaker.record_success()
+            # 服务端分配了新的会话ID时，将新会话绑定到处理该请求的节点
+            if isinstance(result, dict) and result.get("session_id"):
+                self.router.bind(str(result["session_id"]), backend)
+            return result
+    
+    async def _probe(self, backend: Backend) -> bool:
+        """
+        探测单个节点是否健康
+        
+        健康检查不受熔断器限制，检查结果会同步更新熔断器状态，
+        健康检查是幂等的，遇到瞬时错误时会按重试配置重试
+        
+        Args:
+            backend: 后端节点
+            
+        Returns:
+            bool: 节点是否健康
+        """
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                response = await self.client.get(
+                    f"{backend.base_url}/health",
+                    timeout=plugin_config.naga_health_check_timeout
+                )
+                response.raise_for_status()
+                is_healthy = response.status_code == 200
+                REQUESTS.labels("health", "success").inc()
+                REQUEST_DURATION.labels("health").observe(time.monotonic() - start)
+                break
+            except Exception as e:
+                REQUESTS.labels("health", "error").inc()
+                REQUEST_DURATION.labels("health").observe(time.monotonic() - start)
+                ERRORS.labels("health", error_type(e)).inc()
+                if (
+                    attempt < plugin_config.naga_retry_attempts
+                    and is_retryable(e, idempotent=True)
+                    and self.retry_budget.withdraw()
+                ):
+                    await asyncio.sleep(backoff_delay(
+                        attempt,
+                        plugin_config.naga_retry_backoff_base,
+                        plugin_config.naga_retry_backoff_max
+                    ))
+                    attempt += 1
+                    continue
+                logger.warning(f"{backend.base_url} 健康检查失败: {str(e)}")
+                is_healthy = False
+                break
+        
+        if is_healthy:
+            backend.breaker.record_success()
+        else:
+            backend.breaker.record_failure()
+        logger.debug(f"{backend.base_url} 健康检查结果: {is_healthy}")
+        return is_healthy
     
     async def health_check(self) -> bool:
         """
         健康检查，验证NagaAgent服务是否正常运行
         
+        配置了多个后端时会同时探测所有节点，
+        同一节点同时进行的探测会被合并，结果缓存 naga_coalesce_ttl 秒
+        
         Returns:
-            bool: 服务器是否健康
-        """
-        try:
-            response = await self.client.get(f"{self.base_url}/health")
-            response.raise_for_status()
-            is_healthy = response.status_code == 200
-            logger.debug(f"健康检查结果: {is_healthy}")
-            return is_healthy
-        except Exception as e:
-            logger.warning(f"健康检查失败: {str(e)}")
-            return False
+            bool: 是否至少有一个节点健康
+        """
+        results = await asyncio.gather(*(
+            self.single_flight.do(
+                ("GET", "/health", backend.base_url),
+                lambda backend=backend: self._probe(backend),
+                ttl=plugin_config.naga_coalesce_ttl
+            )
+            for backend in self.backends
+        ))
+        return any(results)
     
     async def chat(self, message: str, session_id: Optional[str] = None) -> Dict[str, Any]:
         """
@@ -47,40 +433,27 @@ class NagaAgentClient:
         Returns:
             API响应结果，包含status、response和session_id字段
         """
-        url = f"{self.base_url}/chat"
         data = {
             "message": message,
             "stream": False
         }
         if session_id:
             data["session_id"] = session_id
-            
-        try:
-            response = await self.client.post(url, json=data)
-            response.raise_for_status()  # 检查HTTP错误
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            return {
-                "status": "error",
-                "message": f"HTTP错误 {e.response.status_code}: {getattr(e.response, 'text', str(e))}"
-            }
-        except httpx.RequestError as e:
-            return {
-                "status": "error",
-                "message": f"无法连接到 NagaAgent API: {str(e)}"
-            }
-        except json.JSONDecodeError as e:
-            return {
-                "status": "error",
-                "message": f"API响应格式错误: {str(e)}"
-            }
-        except Exception as e:
-            return {
-                "status": "error",
-                "message": f"API调用失败: {str(e)}"
-            }
+        if not plugin_config.naga_coalesce_chat:
+            return await self._request(
+                "POST", "/chat", data, action="对话", session_id=session_id,
+                timeout=plugin_config.naga_chat_timeout
+            )
+        # 同一会话中同时发送的相同消息只请求一次，请求体中已包含会话ID
+        return await self.single_flight.do(
+            ("POST", "/chat", canonical_hash(data)),
+            lambda: self._request(
+                "POST", "/chat", data, action="对话", session_id=session_id,
+                timeout=plugin_config.naga_chat_timeout
+            )
+        )
     
-    async def chat_stream(self, message: str, session_id: Optional[str] = None) -> AsyncGenerator[str, None]:
+    async def chat_stream(self, message: str, session_id: Optional[str] = None) -> AsyncGenerator[Dict[str, Any], None]:
         """
         流式对话接口，向NagaAgent发送用户消息并以流式方式获取回复
         
@@ -89,9 +462,19 @@ class NagaAgentClient:
             session_id: 会话ID（可选）
             
         Yields:
-            流式响应数据，每个数据块为一行JSON格式的内容
+            流式事件字典，type字段为以下之一：
+            - content: 回复文本片段，内容在content字段中
+            - session: 服务端分配的会话ID，内容在session_id字段中
+            - error: 调用失败，错误信息在message字段中
         """
-        url = f"{self.base_url}/chat/stream"
+        backend = self._acquire_backend(session_id)
+        if backend is None:
+            yield {
+                "type": "error",
+                "message": "NagaAgent API 暂时不可用，请稍后重试"
+            }
+            return
+        
         data = {
             "message": message,
             "stream": True
@@ -99,23 +482,121 @@ class NagaAgentClient:
         if session_id:
             data["session_id"] = session_id
             
-        try:
-            async with self.client.stream("POST", url, json=data) as response:
-                response.raise_for_status()  # 检查HTTP错误
-                async for chunk in response.aiter_text():
-                    if chunk.startswith("data: "):
-                        yield chunk[6:]  # 去掉 "data: " 前缀
-        except httpx.HTTPStatusError as e:
-            yield f"HTTP错误 {e.response.status_code}: {getattr(e.response, 'text', str(e))}"
-        except httpx.RequestError as e:
-            yield f"错误: 无法连接到 NagaAgent API: {str(e)}"
-        except Exception as e:
-            yield f"错误: API调用失败: {str(e)}"
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            limit = deadline.budget(plugin_config.naga_chat_timeout)
+            if limit is not None and limit <= 0:
+                backend.breaker.release_probe()
+                yield {"type": "error", **self._timeout_result(0.0, "流式对话")}
+                return
+            current = backend
+            current.inflight += 1
+            outcome = "error"
+            start = time.monotonic()
+            span = tracer.start_span("http chat_stream", backend=current.base_url, attempt=attempt)
+            try:
+                async with self.client.stream(
+                    "POST", f"{current.base_url}/chat/stream", json=data,
+                    headers=tracer.headers(span), timeout=self._capped_timeout(limit)
+                ) as response:
+                    response.raise_for_status()  # 检查HTTP错误
+                    # 收到响应头即说明后端可用
+                    backend.breaker.record_success()
+                    # 网络数据块与SSE事件边界不对齐，交给增量解码器按行重组
+                    decoder = SSEDecoder()
+                    async for chunk in response.aiter_text():
+                        if limit is not None and time.monotonic() - start > limit:
+                            # 服务端持续输出但总时间超出限制，保留已收到的内容
+                            outcome = "timeout"
+                            ERRORS.labels("chat_stream", "TimeoutError").inc()
+                            yield {"type": "error", **self._timeout_result(limit, "流式对话")}
+                            return
+                        for sse_event in decoder.feed(chunk):
+                            if sse_event.is_done:
+                                outcome = "success"
+                                return
+                            event = parse_stream_event(sse_event)
+                            if event:
+                                if event["type"] == "session":
+                                    self.router.bind(event["session_id"], backend)
+                                yield event
+                    for sse_event in decoder.flush():
+                        if sse_event.is_done:
+                            outcome = "success"
+                            return
+                        event = parse_stream_event(sse_event)
+                        if event:
+                            if event["type"] == "session":
+                                self.router.bind(event["session_id"], backend)
+                            yield event
+                outcome = "success"
+            except httpx.HTTPStatusError as e:
+                ERRORS.labels("chat_stream", error_type(e)).inc()
+                self._record_error(backend, e)
+                yield {
+                    "type": "error",
+                    "message": f"HTTP错误 {e.response.status_code}: {getattr(e.response, 'text', str(e))}"
+                }
+            except NOT_SENT_ERRORS as e:
+                # 请求尚未发出，可以安全重试
+                ERRORS.labels("chat_stream", error_type(e)).inc()
+                self._record_error(backend, e)
+                if (
+                    attempt < plugin_config.naga_retry_attempts
+                    and self.retry_budget.withdraw()
+                ):
+                    await asyncio.sleep(backoff_delay(
+                        attempt,
+                        plugin_config.naga_retry_backoff_base,
+                        plugin_config.naga_retry_backoff_max
+                    ))
+                    attempt += 1
+                    retry_backend = self._acquire_retry_backend(backend, session_id)
+                    if retry_backend is not None:
+                        backend = retry_backend
+                        continue
+                yield {
+                    "type": "error",
+                    "message": f"无法连接到 NagaAgent API: {str(e)}"
+                }
+            except httpx.PoolTimeout as e:
+                ERRORS.labels("chat_stream", error_type(e)).inc()
+                backend.breaker.release_probe()
+                logger.warning("等待连接池空闲连接超时，请考虑调大 naga_max_connections")
+                yield {
+                    "type": "error",
+                    "message": "NagaAgent API 连接繁忙，请稍后重试"
+                }
+            except httpx.RequestError as e:
+                ERRORS.labels("chat_stream", error_type(e)).inc()
+                backend.breaker.record_failure()
+                yield {
+                    "type": "error",
+                    "message": f"无法连接到 NagaAgent API: {str(e)}"
+                }
+            except Exception as e:
+                ERRORS.labels("chat_stream", error_type(e)).inc()
+                backend.breaker.release_probe()
+                yield {
+                    "type": "error",
+                    "message": f"API调用失败: {str(e)}"
+                }
+            finally:
+                elapsed = time.monotonic() - start
+                current.inflight -= 1
+                current.record_latency(elapsed)
+                REQUESTS.labels("chat_stream", outcome).inc()
+                REQUEST_DURATION.labels("chat_stream").observe(elapsed)
+                span.end("ok" if outcome == "success" else outcome)
+            return
     
     async def mcp_handoff(self, service_name: str, task: Dict[str, Any], session_id: Optional[str] = None) -> Dict[str, Any]:
         """
         MCP服务调用接口，执行指定的MCP服务任务
         
+        在缓存白名单中的服务，相同参数的成功结果在过期前直接从缓存返回
+        
         Args:
             service_name: 服务名称
             task: 任务信息，包含tool_name和其他参数
@@ -124,38 +605,26 @@ class NagaAgentClient:
         Returns:
             API响应结果
         """
-        url = f"{self.base_url}/mcp/handoff"
+        cacheable = self.tool_cache.cacheable(service_name)
+        if cacheable:
+            cached = self.tool_cache.get(service_name, task)
+            if cached is not None:
+                logger.debug(f"MCP服务 {service_name} 命中缓存")
+                return cached
+        
         data = {
             "service_name": service_name,
             "task": task
         }
         if session_id:
             data["session_id"] = session_id
-            
-        try:
-            response = await self.client.post(url, json=data)
-            response.raise_for_status()  # 检查HTTP错误
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            return {
-                "status": "error",
-                "message": f"HTTP错误 {e.response.status_code}: {getattr(e.response, 'text', str(e))}"
-            }
-        except httpx.RequestError as e:
-            return {
-                "status": "error",
-                "message": f"无法连接到 NagaAgent API: {str(e)}"
-            }
-        except json.JSONDecodeError as e:
-            return {
-                "status": "error",
-                "message": f"API响应格式错误: {str(e)}"
-            }
-        except Exception as e:
-            return {
-                "status": "error",
-                "message": f"API调用失败: {str(e)}"
-            }
+        result = await self._request(
+            "POST", "/mcp/handoff", data, action="MCP服务调用", session_id=session_id,
+            timeout=plugin_config.naga_handoff_call_timeout
+        )
+        if cacheable:
+            self.tool_cache.set(service_name, task, result)
+        return result
     
     async def toggle_developer_mode(self, enabled: bool) -> Dict[str, Any]:
         """
@@ -167,70 +636,44 @@ class NagaAgentClient:
         Returns:
             API响应结果
         """
-        url = f"{self.base_url}/system/devmode"
         data = {"enabled": enabled}
-        try:
-            response = await self.client.post(url, json=data)
-            response.raise_for_status()  # 检查HTTP错误
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            error_msg = f"HTTP错误 {e.response.status_code}: {getattr(e.response, 'text', str(e))}"
-            logger.error(f"切换开发者模式HTTP错误: {error_msg}")
-            return {
-                "status": "error",
-                "message": error_msg
-            }
-        except httpx.RequestError as e:
-            error_msg = f"无法连接到 NagaAgent API: {str(e)}"
-            logger.error(f"切换开发者模式请求错误: {error_msg}")
-            return {
-                "status": "error",
-                "message": error_msg
-            }
-        except json.JSONDecodeError as e:
-            error_msg = f"API响应格式错误: {str(e)}"
-            logger.error(f"切换开发者模式JSON解析错误: {error_msg}")
-            return {
-                "status": "error",
-                "message": error_msg
-            }
-        except Exception as e:
-            error_msg = f"API调用失败: {str(e)}"
-            logger.error(f"切换开发者模式未知错误: {error_msg}")
-            return {
-                "status": "error",
-                "message": error_msg
-            }
+        if len(self.backends) == 1:
+            return await self._request(
+                "POST", "/system/devmode", data, action="切换开发者模式",
+                timeout=plugin_config.naga_system_timeout
+            )
+        
+        # 多个节点时需要同时切换所有节点，保证后续请求无论路由到哪个节点行为一致
+        results = await asyncio.gather(*(
+            self._request(
+                "POST", "/system/devmode", data, action="切换开发者模式", backend=backend,
+                timeout=plugin_config.naga_system_timeout
+            )
+            for backend in self.backends
+        ))
+        for backend, result in zip(self.backends, results):
+            if isinstance(result, dict) and result.get("status") == "error":
+                return {
+                    "status": "error",
+                    "message": f"{backend.base_url}: {result.get('message', '未知错误')}"
+                }
+        return results[0]
     
     async def get_system_info(self) -> Dict[str, Any]:
         """
         获取系统信息
         
+        同一时刻的重复请求会被合并，成功结果缓存 naga_coalesce_ttl 秒
+        
         Returns:
             系统信息，包含版本、状态等信息
         """
-        url = f"{self.base_url}/system/info"
-        try:
-            response = await self.client.get(url)
-            response.raise_for_status()  # 检查HTTP错误
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            return {
-                "status": "error",
-                "message": f"HTTP错误 {e.response.status_code}: {getattr(e.response, 'text', str(e))}"
-            }
-        except httpx.RequestError as e:
-            return {
-                "status": "error",
-                "message": f"无法连接到 NagaAgent API: {str(e)}"
-            }
-        except json.JSONDecodeError as e:
-            return {
-                "status": "error",
-                "message": f"API响应格式错误: {str(e)}"
-            }
-        except Exception as e:
-            return {
-                "status": "error",
-                "message": f"API调用失败: {str(e)}"
-            }
\ No newline at end of file
+        return await self.single_flight.do(
+            ("GET", "/system/info"),
+            lambda: self._request(
+                "GET", "/system/info", action="获取系统信息", idempotent=True,
+                timeout=plugin_config.naga_system_timeout
+            ),
+            ttl=plugin_config.naga_coalesce_ttl,
+            cacheable=lambda result: not (isinstance(result, dict) and result.get("status") == "error")
+        )
@@ -0,0 +1,240 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    带过期时间的LRU缓存
+
+    条目按最近访问顺序排列，超出容量时淘汰最久未访问的条目，
+    每个条目可以有各自的过期时间，过期条目在读取时惰性删除
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 60.0):
+        """
+        初始化缓存
+
+        Args:
+            max_size: 最多缓存的条目数
+            ttl: 默认过期时间（秒）
+        """
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        # {key: (过期时间, 值)}
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        读取缓存
+
+        Args:
+            key: 缓存键
+
+        Returns:
+            缓存的值，不存在或已过期时返回None
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value = entry
+        if time.monotonic() >= expires:
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        写入缓存
+
+        Args:
+            key: 缓存键
+            value: 缓存的值
+            ttl: 过期时间（秒），默认使用初始化时的设置
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        """清空缓存"""
+        self._data.clear()
+
+
+def canonical_hash(value: Any) -> str:
+    """
+    计算参数的规范化哈希，键的顺序和空白不影响结果
+
+    Args:
+        value: 可以序列化为JSON的参数
+
+    Returns:
+        十六进制哈希字符串
+    """
+    text = json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class ToolResultCache:
+    """
+    MCP工具调用结果缓存
+
+    只缓存白名单中服务的成功结果，每个服务有独立的过期时间，
+    缓存键为服务名加参数的规范化哈希，同时按服务统计命中和未命中次数
+    """
+
+    def __init__(self, services: Dict[str, float], max_size: int = 1000):
+        """
+        初始化工具结果缓存
+
+        Args:
+            services: 可以缓存的服务及其过期时间 {service_name: ttl}
+            max_size: 所有服务合计最多缓存的结果数
+        """
+        self.services = {name: ttl for name, ttl in services.items() if ttl > 0}
+        self._cache = TTLCache(max_size=max_size)
+        # 按服务统计 {service_name: [命中次数, 未命中次数]}
+        self._stats: Dict[str, list] = {}
+
+    @property
+    def enabled(self) -> bool:
+        """是否有需要缓存的服务"""
+        return bool(self.services)
+
+    def cacheable(self, service_name: str) -> bool:
+        """服务是否在缓存白名单中"""
+        return service_name in self.services
+
+    def get(self, service_name: str, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        读取缓存的工具调用结果，调用方不应修改返回的字典
+
+        Args:
+            service_name: 服务名称
+            params: 调用参数
+
+        Returns:
+            缓存的结果，未命中时返回None
+        """
+        result = self._cache.get((service_name, canonical_hash(params)))
+        stats = self._stats.setdefault(service_name, [0, 0])
+        stats[0 if result is not None else 1] += 1
+        return result
+
+    def set(self, service_name: str, params: Dict[str, Any], result: Dict[str, Any]) -> None:
+        """
+        缓存工具调用结果，失败的结果不会被缓存
+
+        Args:
+            service_name: 服务名称
+            params: 调用参数
+            result: 调用结果
+        """
+        if not isinstance(result, dict) or result.get("status") == "error":
+            return
+        self._cache.set((service_name, canonical_hash(params)), result, self.services[service_name])
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        获取命中统计
+
+        Returns:
+            {service_name: {"hits": 命中次数, "misses": 未命中次数}}
+        """
+        return {
+            name: {"hits": hits, "misses": misses}
+            for name, (hits, misses) in self._stats.items()
+        }
+
+
+class SingleFlight:
+    """
+    相同请求合并
+
+    同一时刻相同键的请求只实际执行一次，其余调用方等待同一个任务的结果；
+    可选地将成功结果缓存一小段时间，吸收短时间内的重复请求。
+    所有等待者都被取消时，共享的任务也会被取消
+    """
+
+    def __init__(self, max_size: int = 1000):
+        """
+        初始化请求合并器
+
+        Args:
+            max_size: 最多缓存的结果数
+        """
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[Hashable, int] = {}
+        self._results = TTLCache(max_size=max_size)
+        # 被合并的请求数
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]],
+                 ttl: float = 0.0, cacheable: Optional[Callable[[Any], bool]] = None) -> Any:
+        """
+        执行请求，相同键的并发请求共享同一个结果
+
+        Args:
+            key: 请求键
+            factory: 实际执行请求的协程函数
+            ttl: 成功结果的缓存时间（秒），0表示不缓存
+            cacheable: 判断结果是否可以缓存的函数，默认全部缓存
+
+        Returns:
+            请求结果
+        """
+        if ttl > 0:
+            cached = self._results.get(key)
+            if cached is not None:
+                self.coalesced += 1
+                return cached
+
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._tasks[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t, ttl, cacheable))
+        else:
+            self.coalesced += 1
+
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self._waiters.get(key) == 1:
+                # 最后一个等待者被取消，没有必要继续执行
+                task.cancel()
+            raise
+        finally:
+            remaining = self._waiters.get(key, 1) - 1
+            if remaining:
+                self._waiters[key] = remaining
+            else:
+                self._waiters.pop(key, None)
+
+    def _finish(self, key: Hashable, task: asyncio.Task, ttl: float,
+                cacheable: Optional[Callable[[Any], bool]]) -> None:
+        """任务结束后移除进行中的记录，并缓存成功结果"""
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if task.cancelled() or task.exception() is not None or ttl <= 0:
+            return
+        result = task.result()
+        if cacheable is None or cacheable(result):
+            self._results.set(key, result, ttl)
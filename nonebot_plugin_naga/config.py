@@ -1,3 +1,5 @@
+from typing import Dict, List
+
 from pydantic import BaseModel
 
 
@@ -6,7 +8,119 @@ class Config(BaseModel):
     # NagaAgent API 配置
     naga_api_host: str = "127.0.0.1"
     naga_api_port: int = 8000
+    # 多个NagaAgent后端地址，例如 ["127.0.0.1:8000", "http://10.0.0.2:8000"]
+    # 配置后忽略 naga_api_host 和 naga_api_port
+    naga_api_backends: List[str] = []
+    naga_backend_max_affinity: int = 10000  # 最多记录的会话与节点绑定数
+    naga_backend_ewma_alpha: float = 0.3  # 节点延迟指数加权平均的平滑系数
+    
+    # 激活前缀配置
+    naga_global_aliases: List[str] = []  # 所有用户都可使用的激活前缀别名，例如 ["/ai"]
+    naga_group_aliases: Dict[str, List[str]] = {}  # 按群组配置的激活前缀别名 {群号: [前缀, ...]}
     
     # HANDOFF 工具调用循环配置
     max_handoff_loop: int = 5
-    show_handoff: bool = False
\ No newline at end of file
+    show_handoff: bool = False
+    naga_handoff_max_parallel: int = 4  # 同一轮中最多同时执行的工具调用数
+    naga_handoff_call_timeout: float = 60.0  # 单个工具调用超时（秒），0表示不限制
+    
+    # 工具调用结果缓存配置，只缓存结果与调用者无关的幂等服务
+    naga_tool_cache_services: Dict[str, float] = {}  # 可缓存的服务及缓存时间（秒），例如 {"weather": 600}
+    naga_tool_cache_size: int = 1000  # 最多缓存的工具调用结果数
+    
+    # 工具调用结果整形配置，限制发回给LLM的结果大小，0表示不限制
+    naga_tool_result_max_bytes: int = 16000  # 单个结果最大字节数
+    naga_tool_result_max_tokens: int = 4000  # 单个结果最大估算token数
+    naga_tool_result_max_items: int = 50  # 数组最多保留的元素数
+    naga_tool_result_max_string: int = 4000  # 字符串最多保留的字符数
+    naga_tool_result_drop_fields: List[str] = []  # 需要删除的噪声字段，例如 ["debug", "raw_html"]
+    
+    # 流式回复配置
+    naga_stream_reply: bool = False  # 是否使用 /chat/stream 分段发送回复
+    naga_stream_min_chars: int = 30  # 分段发送的最小长度，过短的句子会与后续内容合并
+    naga_stream_max_chars: int = 300  # 单段最大长度，超过时强制切分
+
+    
+    # HTTP 连接配置
+    naga_max_connections: int = 100  # 连接池最大连接数
+    naga_max_keepalive_connections: int = 20  # 最大保持活动的空闲连接数
+    naga_keepalive_expiry: float = 30.0  # 空闲连接保持时间（秒）
+    naga_http2: bool = False  # 是否启用HTTP/2，需要安装 httpx[http2]
+    naga_connect_timeout: float = 10.0  # 建立连接超时（秒）
+    naga_read_timeout: float = 300.0  # 读取响应超时（秒），LLM长回复需要较长时间
+    naga_write_timeout: float = 30.0  # 发送请求超时（秒）
+    naga_pool_timeout: float = 10.0  # 等待连接池空闲连接的超时（秒）
+    
+    # 处理时间预算配置，0表示不限制
+    naga_request_deadline: float = 180.0  # 一条消息从开始处理到回复的总时间上限（秒），所有调用共享
+    naga_chat_timeout: float = 120.0  # 单次对话请求超时（秒），流式回复为接收全部内容的时间
+    naga_system_timeout: float = 10.0  # 系统信息和开发者模式接口超时（秒）
+    
+    # 并发准入控制配置
+    naga_max_concurrent_requests: int = 32  # 全局最大并发请求数，0表示不限制
+    naga_max_user_concurrent_requests: int = 2  # 单个用户最大并发请求数，0表示不限制
+    naga_max_queue_size: int = 100  # 等待队列最大长度，队列满时直接提示繁忙
+    naga_queue_timeout: float = 30.0  # 排队等待超时（秒）
+    naga_max_user_queue_size: int = 10  # 单个用户最多排队的请求数，0表示不限制
+    # 排队请求各通道的权重，interactive 为用户对话，handoff 为工具调用及其后续请求，background 为后台任务
+    naga_lane_weights: Dict[str, int] = {"handoff": 4, "interactive": 2, "background": 1}
+    
+    # 健康检查与熔断配置
+    naga_health_check_interval: float = 30.0  # 后台健康检查间隔（秒），0表示只在启动时检查一次
+    naga_health_check_timeout: float = 5.0  # 健康检查超时（秒）
+    naga_circuit_failure_threshold: int = 5  # 连续失败多少次后熔断
+    naga_circuit_recovery_timeout: float = 30.0  # 熔断后多久开始半开探测（秒）
+    naga_circuit_half_open_max_calls: int = 1  # 半开状态下允许的探测请求数
+    
+    # 失败重试配置
+    naga_retry_attempts: int = 2  # 最大重试次数，0表示不重试
+    naga_retry_backoff_base: float = 0.2  # 指数退避基础时间（秒）
+    naga_retry_backoff_max: float = 2.0  # 单次退避最长时间（秒）
+    naga_retry_budget_ratio: float = 0.2  # 重试请求占总请求的比例上限
+    
+    # 相同请求合并配置，系统信息查询和健康检查始终合并
+    naga_coalesce_ttl: float = 2.0  # 系统信息和健康检查结果的缓存时间（秒），0表示只合并同时进行的请求
+    naga_coalesce_chat: bool = False  # 是否合并同一会话中同时发送的相同对话消息
+    
+    # 指标配置
+    naga_metrics_enabled: bool = False  # 是否收集Prometheus指标，关闭时埋点为空操作
+    naga_metrics_path: str = "/naga/metrics"  # 指标采集接口路径，需要支持HTTP服务端的驱动器
+    naga_metrics_services: List[str] = []  # 工具调用指标中单独统计的MCP服务，可缓存的服务也单独统计，其余服务计入 "other"
+    
+    # 请求追踪配置
+    naga_trace_exporters: List[str] = []  # 追踪导出方式，可选 "log"、"jsonl"、"otel"，为空时关闭追踪
+    naga_trace_sample_rate: float = 1.0  # 采样比例，0到1之间
+    naga_trace_slow_threshold: float = 0.0  # 总耗时超过该值（秒）的请求即使未被采样也会导出，0表示关闭
+    naga_trace_file: str = "data/naga/traces.jsonl"  # jsonl导出器的输出文件路径
+    
+    # 连续消息合并配置，同一用户在同一会话中短时间内连续发送的消息合并为一次对话请求
+    naga_debounce_window: float = 0.0  # 合并窗口（秒），每收到一条新消息重新计时，0表示不合并
+    naga_debounce_max_chars: int = 2000  # 合并后的最大字符数，超出时先发送已合并的消息
+    naga_debounce_max_messages: int = 10  # 最多合并的消息数
+    
+    # 请求频率限制配置（令牌桶），按用户、群组和适配器分别限制发往NagaAgent的请求
+    naga_user_rate_limit: float = 0.0  # 每个用户每秒补充的请求数，0表示不限制
+    naga_user_rate_burst: int = 5  # 每个用户允许的突发请求数
+    naga_group_rate_limit: float = 0.0  # 每个群组每秒补充的请求数，0表示不限制
+    naga_group_rate_burst: int = 20  # 每个群组允许的突发请求数
+    naga_adapter_rate_limit: float = 0.0  # 每个适配器每秒补充的请求数，0表示不限制
+    naga_adapter_rate_burst: int = 50  # 每个适配器允许的突发请求数
+    naga_rate_limit_notice_interval: float = 30.0  # 被限流时的提示间隔（秒），期间重复触发的限流不再回复
+    
+    # 后台任务配置，回复中包含工具调用时立即回复任务ID，工具调用在后台执行，完成后发送结果
+    naga_job_workers: int = 0  # 同时执行的后台任务数，0表示关闭任务模式，工具调用在当前消息的处理中完成
+    naga_job_max_pending: int = 50  # 未完成的后台任务上限
+    naga_job_deadline: float = 900.0  # 单个后台任务的处理时间上限（秒）
+    naga_job_retention: float = 3600.0  # 完成后的任务记录保留时间（秒），期间可以查询结果
+    
+    # 进行中请求的处理策略，同一用户在同一会话中还有请求未完成时收到新消息：
+    # "queue" 排队等待之前的请求完成，"cancel" 取消之前的请求，"reject" 拒绝新消息
+    naga_inflight_policy: str = "queue"
+    
+    # 会话持久化配置
+    naga_store_path: str = "data/naga/sessions.db"  # SQLite数据库路径，":memory:" 表示不持久化
+    naga_store_flush_interval: float = 2.0  # 会话数据批量写回间隔（秒）
+    
+    # 会话内存管理配置
+    naga_session_ttl: float = 7200.0  # 会话在内存中的最长空闲时间（秒）
+    naga_session_cache_size: int = 10000  # 内存中最多缓存的用户会话状态数
@@ -0,0 +1,70 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+
+# 当前请求的截止时间（time.monotonic() 时间），子任务创建时自动继承
+_deadline: ContextVar[Optional[float]] = ContextVar("naga_deadline", default=None)
+
+
+@contextmanager
+def deadline_scope(seconds: float, detach: bool = False) -> Iterator[None]:
+    """
+    为当前请求设置处理时间预算，期间发起的所有调用共享同一个截止时间
+
+    嵌套使用时取更早的截止时间，内层不能延长外层的预算
+
+    Args:
+        seconds: 时间预算（秒），0表示不限制
+        detach: 忽略外层的预算，用于脱离原消息继续执行的后台任务
+    """
+    if seconds <= 0 and not detach:
+        yield
+        return
+    deadline = time.monotonic() + seconds if seconds > 0 else None
+    outer = None if detach else _deadline.get()
+    if outer is not None:
+        deadline = min(deadline, outer)
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """
+    当前请求剩余的时间预算
+
+    Returns:
+        剩余秒数，可能为负数；没有设置预算时返回None
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def expired() -> bool:
+    """当前请求的时间预算是否已经用完"""
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def budget(timeout: Optional[float]) -> Optional[float]:
+    """
+    计算单个调用可以使用的超时时间
+
+    Args:
+        timeout: 调用自身的超时时间（秒），None或0表示不限制
+
+    Returns:
+        调用超时与剩余预算中较小的一个，不小于0；两者都不限制时返回None
+    """
+    left = remaining()
+    if not timeout or timeout <= 0:
+        return None if left is None else max(0.0, left)
+    if left is None:
+        return timeout
+    return max(0.0, min(timeout, left))
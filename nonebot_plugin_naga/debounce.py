@@ -0,0 +1,97 @@
+import asyncio
+from typing import Dict, Hashable, List, Optional
+
+
+class _Batch:
+    """等待合并的一组消息"""
+
+    __slots__ = ("messages", "chars", "closed", "wakeup")
+
+    def __init__(self, message: str):
+        self.messages: List[str] = [message]
+        self.chars = len(message)
+        # 已达到上限，不再接受新消息
+        self.closed = False
+        self.wakeup = asyncio.Event()
+
+
+class MessageDebouncer:
+    """
+    合并短时间内连续发送的消息
+
+    同一键（用户和会话）的第一条消息开始一个合并窗口，窗口内到达的后续消息都追加到这一批中，
+    每收到一条新消息重新计时，直到窗口内没有新消息或合并内容达到上限，
+    由第一条消息的处理流程发送合并后的请求，后续消息的处理流程直接结束
+    """
+
+    def __init__(self, window: float, max_chars: int = 2000, max_messages: int = 10,
+                 separator: str = "\n"):
+        """
+        初始化消息合并器
+
+        Args:
+            window: 合并窗口（秒），0表示不合并
+            max_chars: 合并后的最大字符数，0表示不限制
+            max_messages: 最多合并的消息数，0表示不限制
+            separator: 消息之间的分隔符
+        """
+        self.window = window
+        self.max_chars = max_chars
+        self.max_messages = max_messages
+        self.separator = separator
+        self._batches: Dict[Hashable, _Batch] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def _fits(self, batch: _Batch, message: str) -> bool:
+        """消息追加到这一批后是否仍在上限以内"""
+        if batch.closed:
+            return False
+        if self.max_messages and len(batch.messages) >= self.max_messages:
+            return False
+        chars = batch.chars + len(self.separator) + len(message)
+        return not self.max_chars or chars <= self.max_chars
+
+    async def collect(self, key: Hashable, message: str) -> Optional[str]:
+        """
+        提交一条消息，等待合并窗口结束
+
+        Args:
+            key: 合并键，通常为 (用户ID, 活跃会话名称)
+            message: 消息内容
+
+        Returns:
+            由当前调用方发送的合并后消息；消息已合并到更早的一批中时返回None
+        """
+        if not self.enabled:
+            return message
+
+        batch = self._batches.get(key)
+        if batch is not None:
+            if self._fits(batch, message):
+                batch.messages.append(message)
+                batch.chars += len(self.separator) + len(message)
+                if self.max_messages and len(batch.messages) >= self.max_messages:
+                    batch.closed = True
+                batch.wakeup.set()
+                return None
+            # 放不下时立即发送已有的一批，当前消息开始新的一批
+            batch.closed = True
+            batch.wakeup.set()
+
+        batch = _Batch(message)
+        self._batches[key] = batch
+        try:
+            while not batch.closed:
+                batch.wakeup.clear()
+                try:
+                    await asyncio.wait_for(batch.wakeup.wait(), self.window)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            batch.closed = True
+            if self._batches.get(key) is batch:
+                del self._batches[key]
+        return self.separator.join(batch.messages)
@@ -1,106 +1,159 @@
-from nonebot import on_message, logger
+from nonebot import get_driver, on_message, logger
 from nonebot.adapters import Bot, Event
+from nonebot.exception import MatcherException
 from nonebot.typing import T_State
 from nonebot.rule import Rule
-import json
+from typing import Dict, Any, List, Optional
 import asyncio
+import time
 
 from .api_client import NagaAgentClient
-from .utils import parse_handoff_content
-from . import plugin_config
+from .debounce import MessageDebouncer
+from .health import HealthMonitor
+from .jobs import JOB_STATUS_TEXT, Job, JobManager, current_job, is_job_id, set_progress
+from .limiter import LANE_BACKGROUND, LANE_HANDOFF, AdmissionController, AdmissionRejected, RequestRegistry
+from .matcher import MatcherEngine
+from .metrics import (
+    ACTIVE_SESSIONS, HANDLER_DURATION, HANDOFF_CALLS, HANDOFF_ROUNDS, INFLIGHT, MESSAGES_MERGED, QUEUED,
+    RATE_LIMITED, service_label, setup_metrics_endpoint
+)
+from .ratelimit import RateLimited, RequestThrottle, TokenBucketLimiter
+from .shaping import shape_tool_result
+from .sessions import SessionIdAllocator
+from .storage import SessionStore
+from .streaming import ReplyChunker
+from .tracing import current_trace_id, tracer
+from .utils import parse_handoff_calls
+from . import deadline, plugin_config
 
 # 创建API客户端实例
 naga_client = NagaAgentClient()
 
-# 存储用户自定义前缀的字典 {user_id: prefix}
-user_prefixes = {}
+# 后台健康检查任务
+health_monitor = HealthMonitor(naga_client, interval=plugin_config.naga_health_check_interval)
 
-import random
-import time
+driver = get_driver()
+
+
+@driver.on_startup
+async def start_health_monitor():
+    """NoneBot启动后开始定期检查API服务器状态"""
+    health_monitor.start()
+
+
+@driver.on_shutdown
+async def close_naga_client():
+    """NoneBot关闭时停止健康检查并释放API客户端的连接"""
+    await health_monitor.stop()
+    await naga_client.close()
+
+
+@driver.on_startup
+async def open_session_store():
+    """NoneBot启动时打开会话存储"""
+    await session_store.open()
+    matcher_engine.load_user_prefixes(session_store.prefixes)
 
-# 存储用户会话信息的字典 {user_id: {session_name: session_id, ...}}
-user_sessions = {}
-
-# 存储用户当前活跃会话名的字典 {user_id: active_session_name}
-active_sessions = {}
-
-# 已生成的会话ID集合，确保唯一性
-generated_session_ids = set()
-
-# 生成唯一的6位数字会话ID
-def generate_session_id() -> str:
-    """生成唯一的6位数字会话ID"""
-    max_attempts = 100  # 最大尝试次数，防止无限循环
-    for _ in range(max_attempts):
-        # 使用时间戳和随机数生成唯一ID
-        timestamp = int(time.time()) % 1000000  # 取时间戳后6位
-        random_num = random.randint(0, 999999)  # 6位随机数
-        # 组合生成6位数字ID
-        session_id = (timestamp + random_num) % 1000000
-        session_id_str = f"{session_id:06d}"  # 格式化为6位数字，不足的前面补0
-        
-        # 检查ID是否唯一
-        if session_id_str not in generated_session_ids:
-            generated_session_ids.add(session_id_str)
-            return session_id_str
-    
-    # 如果尝试次数过多，使用随机生成
-    while True:
-        session_id_str = f"{random.randint(0, 999999):06d}"
-        if session_id_str not in generated_session_ids:
-            generated_session_ids.add(session_id_str)
-            return session_id_str
 
-# API服务器健康状态
-api_healthy = None
-# 健康检查是否已经执行过
-health_check_done = False
+@driver.on_shutdown
+async def close_session_store():
+    """NoneBot关闭时将未写回的会话数据写入磁盘"""
+    await session_store.close()
 
-# 定义规则：消息以 #naga 开头或者匹配用户自定义前缀
+
+@driver.on_shutdown
+async def close_job_manager():
+    """NoneBot关闭时取消未完成的后台任务"""
+    await job_manager.close()
+
+@driver.on_shutdown
+async def close_tracer():
+    """NoneBot关闭时写出剩余的追踪并关闭追踪导出器"""
+    await tracer.close()
+
+
+# 请求准入控制器，限制发往NagaAgent的并发请求数
+admission = AdmissionController(
+    max_inflight=plugin_config.naga_max_concurrent_requests,
+    max_per_user=plugin_config.naga_max_user_concurrent_requests,
+    max_queue=plugin_config.naga_max_queue_size,
+    queue_timeout=plugin_config.naga_queue_timeout,
+    max_user_queue=plugin_config.naga_max_user_queue_size,
+    lane_weights=plugin_config.naga_lane_weights
+)
+
+# 处理时间预算用完后，等待发送超时提示的时间（秒）
+DEADLINE_GRACE = 5.0
+
+# 进行中的对话请求，用于取消和处理同一会话中的并发消息
+request_registry = RequestRegistry(plugin_config.naga_inflight_policy)
+
+# 请求频率限制，按用户、群组和适配器分别限流
+throttle = RequestThrottle(
+    user=TokenBucketLimiter(plugin_config.naga_user_rate_limit, plugin_config.naga_user_rate_burst,
+                            plugin_config.naga_rate_limit_notice_interval),
+    group=TokenBucketLimiter(plugin_config.naga_group_rate_limit, plugin_config.naga_group_rate_burst,
+                             plugin_config.naga_rate_limit_notice_interval),
+    adapter=TokenBucketLimiter(plugin_config.naga_adapter_rate_limit, plugin_config.naga_adapter_rate_burst,
+                               plugin_config.naga_rate_limit_notice_interval)
+)
+
+# 连续消息合并器，短时间内的多条消息只发送一次对话请求
+debouncer = MessageDebouncer(
+    plugin_config.naga_debounce_window,
+    max_chars=plugin_config.naga_debounce_max_chars,
+    max_messages=plugin_config.naga_debounce_max_messages
+)
+
+# 后台任务池，耗时较长的工具调用在这里执行
+job_manager = JobManager(
+    workers=plugin_config.naga_job_workers,
+    max_pending=plugin_config.naga_job_max_pending,
+    retention=plugin_config.naga_job_retention
+)
+
+# 用户会话与自定义前缀的持久化存储
+session_store = SessionStore(
+    plugin_config.naga_store_path,
+    flush_interval=plugin_config.naga_store_flush_interval,
+    idle_timeout=plugin_config.naga_session_ttl,
+    max_cached_users=plugin_config.naga_session_cache_size
+)
+
+# 采集指标时读取的实时状态
+INFLIGHT.set_function(lambda: admission.inflight)
+QUEUED.set_function(lambda: admission.queued)
+ACTIVE_SESSIONS.set_function(lambda: session_store.cached_users)
+
+# 开启指标时通过驱动器提供采集接口
+setup_metrics_endpoint(driver)
+
+# 会话ID分配器，计数器持久化在会话存储中
+session_id_allocator = SessionIdAllocator(session_store)
+
+
+async def generate_session_id() -> str:
+    """生成唯一的数字会话ID"""
+    return await session_id_allocator.allocate()
+
+
+# 消息匹配引擎，默认前缀、全局别名、群组别名和用户自定义前缀编译在同一棵前缀树中
+matcher_engine = MatcherEngine(
+    global_aliases=plugin_config.naga_global_aliases,
+    group_aliases=plugin_config.naga_group_aliases
+)
+
+
+# 定义规则：消息以 #naga 开头或者匹配激活前缀
 async def message_match_naga(bot: Bot, event: Event, state: T_State) -> bool:
-    """检查消息是否以 #naga 开头或者匹配用户自定义前缀"""
-    # 棣检查是否是支持的消息事件类型
-    plain_text = ""
-    user_id = None
-    
-    # 尝试获取消息文本和用户ID（适用于所有适配器）
-    if hasattr(event, 'get_plaintext'):
-        plain_text = event.get_plaintext().strip()
-    elif hasattr(event, 'get_message'):
-        try:
-            message = event.get_message()
-            if hasattr(message, 'extract_plain_text'):
-                plain_text = message.extract_plain_text().strip()
-        except Exception:
-            pass
-    
-    # 尝试获取用户ID
-    if hasattr(event, 'get_user_id'):
-        user_id = event.get_user_id()
-    elif hasattr(event, 'user_id'):
-        user_id = str(event.user_id)
-    else:
-        # 如果无法获取用户ID，使用事件类型和ID组合作为标识符
-        user_id = f"{event.__class__.__name__}_{getattr(event, 'event_id', 'unknown')}"
-    
-    if plain_text and user_id:
-        # 检查是否以 #naga 开头
-        if plain_text.startswith("#naga"):
-            state["user_id"] = user_id
-            state["prefix_type"] = "default"
-            logger.info(f"检测到Naga默认激活消息: {plain_text}")
-            return True
-            
-        # 检查是否匹配用户自定义前缀
-        user_prefix = user_prefixes.get(user_id)
-        if user_prefix and plain_text.startswith(user_prefix):
-            state["user_id"] = user_id
-            state["prefix_type"] = "custom"
-            state["custom_prefix"] = user_prefix
-            logger.info(f"检测到Naga自定义激活消息: {plain_text} (前缀: {user_prefix})")
-            return True
-            
-    return False
+    """检查消息是否以 #naga 开头或者匹配激活前缀，匹配时将提取结果保存到state"""
+    started = time.time()
+    if not matcher_engine.match(bot, event, state):
+        return False
+    # 匹配发生在追踪开始之前，记录下来由处理函数补充到追踪中
+    state["match_timing"] = (started, time.time() - started)
+    logger.info(f"检测到Naga激活消息: {state['plain_text']} (激活方式: {state['prefix_type']}, 前缀: {state['prefix']})")
+    return True
 
 # 创建消息处理器
 naga_handler = on_message(
@@ -111,39 +164,18 @@ naga_handler = on_message(
 
 logger.info("Naga处理器已注册，支持所有适配器")
 
-# 插件启动时检查API服务器状态
-async def check_api_health():
-    """检查API服务器健康状态"""
-    global api_healthy, health_check_done
-    if not health_check_done:  # 只执行一次健康检查
-        api_healthy = await naga_client.health_check()
-        health_check_done = True
-        if api_healthy:
-            logger.success("NagaAgent API服务器连接正常")
-        else:
-            logger.error("NagaAgent API服务器未响应，请检查服务器是否启动")
-
-# 我们不能直接在这里创建任务，因为此时可能还没有运行的事件循环
-# 改为在第一次实际使用时检查健康状态
-
-
 async def handle_session_commands(user_id: str, command: str, handler) -> None:
     """处理会话管理命令"""
     logger.debug(f"用户 {user_id} 请求会话管理命令: {command}")
     
-    # 初始化用户会话字典
-    if user_id not in user_sessions:
-        user_sessions[user_id] = {}
-    
-    # 初始化用户活跃会话
-    if user_id not in active_sessions:
-        active_sessions[user_id] = None  # 没有活跃会话
+    # 获取用户会话状态（首次访问时从存储中加载）
+    user_state = await session_store.get_user(user_id)
+    sessions = user_state.sessions
     
     # 分析命令
     if command == "list":
         # 列出所有会话
-        sessions = user_sessions.get(user_id, {})
-        active_session = active_sessions.get(user_id)
+        active_session = user_state.active
         
         # 如果没有任何会话，显示提示信息
         if not sessions:
@@ -159,8 +191,9 @@ async def handle_session_commands(user_id: str, command: str, handler) -> None:
     
     elif command == "clear":
         # 清空所有会话
-        user_sessions[user_id] = {}
-        active_sessions[user_id] = None
+        sessions.clear()
+        user_state.active = None
+        session_store.mark_dirty(user_id)
         await handler.finish("✅ 已清空所有会话")
     
     elif command.startswith("switch "):
@@ -169,11 +202,11 @@ async def handle_session_commands(user_id: str, command: str, handler) -> None:
         if not session_name:
             await handler.finish("❌ 请提供会话名称")
         
-        sessions = user_sessions.get(user_id, {})
         if session_name not in sessions:
             await handler.finish(f"❌ 会话 '{session_name}' 不存在")
         
-        active_sessions[user_id] = session_name
+        user_state.active = session_name
+        session_store.mark_dirty(user_id)
         await handler.finish(f"✅ 已切换到会话 '{session_name}'")
     
     elif command.startswith("create "):
@@ -182,16 +215,15 @@ async def handle_session_commands(user_id: str, command: str, handler) -> None:
         if not session_name:
             await handler.finish("❌ 请提供会话名称")
         
-        sessions = user_sessions.get(user_id, {})
         if session_name in sessions:
             await handler.finish(f"❌ 会话 '{session_name}' 已存在")
         
         # 创建新会话（初始ID为None，将在首次使用时由API分配）
         sessions[session_name] = None
-        user_sessions[user_id] = sessions
         
         # 自动激活新创建的会话
-        active_sessions[user_id] = session_name
+        user_state.active = session_name
+        session_store.mark_dirty(user_id)
         await handler.finish(f"✅ 已创建并激活会话 '{session_name}'")
     
     elif command.startswith("delete "):
@@ -200,17 +232,16 @@ async def handle_session_commands(user_id: str, command: str, handler) -> None:
         if not session_name:
             await handler.finish("❌ 请提供会话名称")
         
-        sessions = user_sessions.get(user_id, {})
         if session_name not in sessions:
             await handler.finish(f"❌ 会话 '{session_name}' 不存在")
         
         # 删除会话
         del sessions[session_name]
-        user_sessions[user_id] = sessions
         
         # 如果删除的是当前活跃会话，清除活跃会话
-        if active_sessions.get(user_id) == session_name:
-            active_sessions[user_id] = None
+        if user_state.active == session_name:
+            user_state.active = None
+        session_store.mark_dirty(user_id)
         
         await handler.finish(f"✅ 已删除会话 '{session_name}'")
     
@@ -224,7 +255,6 @@ async def handle_session_commands(user_id: str, command: str, handler) -> None:
         if not old_name or not new_name:
             await handler.finish("❌ 请提供旧会话名称和新会话名称")
         
-        sessions = user_sessions.get(user_id, {})
         if old_name not in sessions:
             await handler.finish(f"❌ 会话 '{old_name}' 不存在")
         
@@ -234,18 +264,17 @@ async def handle_session_commands(user_id: str, command: str, handler) -> None:
         # 重命名会话
         session_id = sessions.pop(old_name)
         sessions[new_name] = session_id
-        user_sessions[user_id] = sessions
         
         # 如果重命名的是当前活跃会话，更新活跃会话名
-        if active_sessions.get(user_id) == old_name:
-            active_sessions[user_id] = new_name
+        if user_state.active == old_name:
+            user_state.active = new_name
+        session_store.mark_dirty(user_id)
         
         await handler.finish(f"✅ 已将会话 '{old_name}' 重命名为 '{new_name}'")
     
     elif command == "info":
         # 显示当前会话信息
-        active_session = active_sessions.get(user_id)
-        sessions = user_sessions.get(user_id, {})
+        active_session = user_state.active
         session_id = sessions.get(active_session) if active_session else None
         
         info_text = "📊 当前会话信息:\n"
@@ -271,66 +300,211 @@ async def handle_session_commands(user_id: str, command: str, handler) -> None:
         await handler.finish(help_text)
 
 
-@naga_handler.handle()
-async def handle_naga_command(bot: Bot, event: Event, state: T_State):
-    """处理以 #naga 开头或匹配自定义前缀的命令"""
-    global api_healthy
+async def resolve_session_id(user_id: str) -> str:
+    """
+    获取用户当前活跃会话的ID，必要时自动创建默认会话或分配新ID
     
-    # 获取用户消息
-    plain_text = ""
-    user_id = None
+    Args:
+        user_id: 用户ID
+        
+    Returns:
+        当前活跃会话的ID
+    """
+    user_state = await session_store.get_user(user_id)
+    sessions = user_state.sessions
     
-    # 获取消息文本内容和用户ID（适用于所有适配器）
-    if hasattr(event, 'get_plaintext'):
-        plain_text = event.get_plaintext().strip()
-    elif hasattr(event, 'get_message'):
-        try:
+    # 生成ID需要等待，期间同一用户同时发送的其他消息可能已经创建了会话或分配了ID，
+    # 已写回的用户状态也可能被从内存中淘汰，继续修改旧对象不会被写回，
+    # 因此等待后重新获取用户状态再检查，以先写入的为准，避免同一会话被分配多个ID
+    if not sessions:
+        # 如果没有任何会话，自动创建默认会话，使用生成的数字ID
+        session_id = await generate_session_id()
+        user_state = await session_store.get_user(user_id)
+        sessions = user_state.sessions
+        if not sessions:
+            user_state.active = "default"
+            sessions["default"] = session_id
+            session_store.mark_dirty(user_id)
+            logger.debug(f"为用户 {user_id} 自动创建默认会话，ID: {session_id}")
+    if not user_state.active or user_state.active not in sessions:
+        # 如果没有活跃会话但有会话存在，使用第一个会话
+        user_state.active = next(iter(sessions))
+        session_store.mark_dirty(user_id)
+    
+    active = user_state.active
+    session_id = sessions.get(active)
+    if not session_id:
+        # 如果会话ID不存在或无效，生成新的ID
+        session_id = await generate_session_id()
+        user_state = await session_store.get_user(user_id)
+        sessions = user_state.sessions
+        if sessions.get(active):
+            session_id = sessions[active]
+        elif active in sessions:
+            sessions[active] = session_id
+            session_store.mark_dirty(user_id)
+            logger.debug(f"为用户 {user_id} 的会话 '{active}' 分配ID: {session_id}")
+    
+    logger.debug(f"用户 {user_id} 的活跃会话 '{user_state.active}' ID: {session_id}")
+    return session_id
 
-            message = event.get_message()
-            if hasattr(message, 'extract_plain_text'):
-                plain_text = message.extract_plain_text().strip()
-        except Exception:
-            pass
+
+async def save_session_id(user_id: str, session_id: str) -> None:
+    """
+    保存API返回的会话ID到用户当前活跃会话
     
-    # 获取用户ID
-    if hasattr(event, 'get_user_id'):
-        user_id = event.get_user_id()
-    elif hasattr(event, 'user_id'):
-        user_id = str(event.user_id)
-    else:
-        # 如果无法获取用户ID，使用事件类型和ID组合作为标识符
-        user_id = f"{event.__class__.__name__}_{getattr(event, 'event_id', 'unknown')}"
-    
-    # 为用户ID添加平台标识以避免不同平台间的会话混淆
-    if hasattr(event, 'adapter'):
-        adapter_name = event.adapter.get_name()
-        user_id = f"{adapter_name}_{user_id}"
-    elif hasattr(bot, 'adapter') and hasattr(bot.adapter, 'get_name'):
-        adapter_name = bot.adapter.get_name()
-        user_id = f"{adapter_name}_{user_id}"
-    
-    # 记录用户ID和消息内容以便调试
-    logger.debug(f"获取到用户ID: {user_id}, 消息内容: '{plain_text}'")
-    
-    if not plain_text or not user_id:
-        logger.warning("无法从事件中提取消息文本或用户ID")
-        await naga_handler.finish("无法处理该消息")
-    
-    # 根据激活方式提取用户消息
-    prefix_type = state.get("prefix_type", "default")
-    user_message = ""
-    
-    if prefix_type == "default":
-        # 以 #naga 开头的情况
-        if plain_text.startswith("#naga"):
-            # 移除 #naga 前缀和可能的空格
-            user_message = plain_text[5:].lstrip()  # 5是"#naga"的长度
-    elif prefix_type == "custom":
-        # 匹配自定义前缀的情况
-        custom_prefix = state.get("custom_prefix", "")
-        if custom_prefix and plain_text.startswith(custom_prefix):
-            # 移除自定义前缀和可能的空格
-            user_message = plain_text[len(custom_prefix):].lstrip()
+    Args:
+        user_id: 用户ID
+        session_id: 会话ID
+    """
+    user_state = await session_store.get_user(user_id)
+    if user_state.active and user_state.sessions.get(user_state.active) != session_id:
+        user_state.sessions[user_state.active] = session_id
+        session_store.mark_dirty(user_id)
+        logger.debug(f"为用户 {user_id} 的会话 '{user_state.active}' 保存ID: {session_id}")
+
+
+async def send_chunks(outbox: "asyncio.Queue[Optional[str]]") -> int:
+    """
+    按顺序发送队列中的回复分段，收到None时结束
+    
+    Returns:
+        发送的分段数
+    """
+    sent_chunks = 0
+    while True:
+        chunk = await outbox.get()
+        if chunk is None:
+            return sent_chunks
+        await naga_handler.send(chunk)
+        sent_chunks += 1
+
+
+async def stream_chat_reply(user_id: str, message: str, session_id: Optional[str]) -> Dict[str, Any]:
+    """
+    通过流式接口获取回复，并按句子或长度分段发送给用户
+    
+    只在读取流式响应期间占用准入名额，分段由单独的任务按顺序发送，
+    平台发送较慢时不会拖住名额，流式响应结束后立即释放名额，剩余分段在名额之外发送完
+    
+    Args:
+        user_id: 用户ID
+        message: 用户消息
+        session_id: 会话ID
+        
+    Returns:
+        与 NagaAgentClient.chat 格式相同的响应字典，
+        streamed字段为True表示完整回复已经发送给用户
+    """
+    chunker = ReplyChunker(plugin_config.naga_stream_min_chars, plugin_config.naga_stream_max_chars)
+    new_session_id = None
+    outbox: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+    sender = asyncio.ensure_future(send_chunks(outbox))
+    
+    try:
+        async with admission.slot(user_id):
+            async for event in naga_client.chat_stream(message, session_id):
+                if event["type"] == "error":
+                    if not chunker.full_text:
+                        return {"status": "error", "message": event["message"]}
+                    # 已经收到部分内容时，保留已收到的部分而不是整体失败
+                    logger.warning(f"流式回复中断: {event['message']}")
+                    break
+                if event["type"] == "session":
+                    new_session_id = event["session_id"]
+                    continue
+                if sender.done():
+                    # 发送失败时不再继续读取，由下面等待发送任务时抛出异常
+                    break
+                for chunk in chunker.feed(event["content"]):
+                    outbox.put_nowait(chunk)
+        
+        reply = chunker.full_text.strip()
+        # 回复中包含工具调用时，工具调用之前的内容已经发送，剩余部分交给工具调用循环处理
+        has_handoff = bool(parse_handoff_calls(reply))
+        for chunk in chunker.flush(include_held=not has_handoff):
+            outbox.put_nowait(chunk)
+        outbox.put_nowait(None)
+        sent_chunks = await sender
+    finally:
+        sender.cancel()
+    logger.debug(f"流式回复完成，共发送 {sent_chunks} 段，总长度: {len(reply)}")
+    
+    return {
+        "status": "success",
+        "response": reply,
+        "session_id": new_session_id or session_id,
+        "streamed": not has_handoff
+    }
+
+
+def format_tool_result(service_result: Dict[str, Any]) -> str:
+    """
+    按配置压缩工具调用结果并序列化，避免过大的结果拖慢后续的LLM调用
+    
+    Args:
+        service_result: 工具调用结果
+        
+    Returns:
+        发送给LLM的结果文本
+    """
+    return shape_tool_result(
+        service_result,
+        max_bytes=plugin_config.naga_tool_result_max_bytes,
+        max_tokens=plugin_config.naga_tool_result_max_tokens,
+        max_items=plugin_config.naga_tool_result_max_items,
+        max_string=plugin_config.naga_tool_result_max_string,
+        drop_fields=plugin_config.naga_tool_result_drop_fields
+    )
+
+
+async def run_handoff_calls(calls: List[Dict[str, Any]], session_id: Optional[str]) -> List[Dict[str, Any]]:
+    """
+    并发执行一轮回复中的所有工具调用
+    
+    同时进行的调用数受 naga_handoff_max_parallel 限制，单个调用超过 naga_handoff_call_timeout
+    或处理时间预算用完时由API客户端取消请求并记为失败，不影响其他调用
+    
+    Args:
+        calls: parse_handoff_calls 解析出的工具调用列表
+        session_id: 会话ID
+        
+    Returns:
+        与calls顺序一致的调用结果列表
+    """
+    semaphore = asyncio.Semaphore(max(1, plugin_config.naga_handoff_max_parallel))
+    
+    async def run(handoff_data: Dict[str, Any]) -> Dict[str, Any]:
+        async with semaphore:
+            # 根据新的API文档，task应该包含tool_name和其他参数
+            task_data = handoff_data["params"].copy()
+            with tracer.span("tool", service=handoff_data["service_name"]) as span:
+                result = await naga_client.mcp_handoff(handoff_data["service_name"], task_data, session_id)
+                if isinstance(result, dict) and result.get("timeout"):
+                    span.end("error", error="timeout")
+                return result
+    
+    if len(calls) == 1:
+        return [await run(calls[0])]
+    return list(await asyncio.gather(*(run(call) for call in calls)))
+
+
+@naga_handler.handle()
+async def handle_naga_event(bot: Bot, event: Event, state: T_State):
+    """Naga消息处理入口，设置处理时间预算，记录整个处理过程的耗时和各阶段的追踪"""
+    started, match_duration = state.get("match_timing", (None, 0.0))
+    with tracer.trace("naga.message", start=started, user_id=state["user_id"],
+                      prefix_type=state["prefix_type"]):
+        tracer.record_span("match", match_duration, start=started)
+        with HANDLER_DURATION.labels("total").time(), deadline.deadline_scope(plugin_config.naga_request_deadline):
+            await handle_naga_command(bot, event, state)
+
+
+async def handle_naga_command(bot: Bot, event: Event, state: T_State):
+    """处理以 #naga 开头或匹配自定义前缀的命令"""
+    # 消息文本、带平台标识的用户ID和去掉前缀后的消息已由匹配规则提取
+    user_id = state["user_id"]
+    user_message = state["user_message"]
     
     logger.info(f"Naga功能被激活，用户ID: {user_id}, 消息: {user_message}")
     
@@ -339,6 +513,8 @@ async def handle_naga_command(bot: Bot, event: Event, state: T_State):
         help_text = """🤖 NagaAgent AI助手使用说明:
 #naga [消息] - 发送消息给AI
 #naga activate [前缀] - 设置自定义激活前缀
+#naga cancel - 取消正在处理中的请求和后台任务
+#naga status [任务ID] - 查看后台任务进度
 
 🔧 会话管理命令:
 #naga session list - 列出所有会话
@@ -361,23 +537,41 @@ async def handle_naga_command(bot: Bot, event: Event, state: T_State):
         # 设置用户自定义前缀
         new_prefix = user_message[9:].strip()  # 9是"activate "的长度
         if new_prefix:
-            user_prefixes[user_id] = new_prefix
+            matcher_engine.set_user_prefix(user_id, new_prefix, session_store.get_prefix(user_id))
+            session_store.set_prefix(user_id, new_prefix)
             logger.info(f"用户 {user_id} 设置自定义前缀: {new_prefix}")
             await naga_handler.finish(f"✅ 已设置自定义激活前缀为: {new_prefix}")
         else:
             await naga_handler.finish("❌ 请提供有效的前缀")
     
-    # 检查API服务器是否在线（首次使用时执行健康检查）
-    if api_healthy is None:
-        # 首次使用时执行健康检查
-        await check_api_health()
+    # 取消进行中的请求，不需要访问API服务器
+    if user_message == "cancel":
+        cancelled = request_registry.cancel(user_id) + job_manager.cancel(user_id)
+        logger.info(f"用户 {user_id} 取消了 {cancelled} 个进行中的请求")
+        if cancelled:
+            await naga_handler.finish(f"✅ 已取消 {cancelled} 个进行中的请求")
+        await naga_handler.finish("当前没有进行中的请求")
+    
+    # 查询后台任务进度，不需要访问API服务器；未开启任务模式或参数不是任务ID时按普通对话处理
+    if job_manager.enabled and (user_message == "status"
+                                or (user_message.startswith("status ")
+                                    and is_job_id(user_message[7:].strip().lower()))):
+        await naga_handler.finish(format_job_status(user_id, user_message[7:].strip().lower()))
+    
+    # 会话管理命令只读写本地会话数据，不经过准入控制，服务不可用时也能使用
+    if user_message.startswith("session "):
+        await handle_session_commands(user_id, user_message[8:], naga_handler)  # 8是"session "的长度
+        return
     
-    if not api_healthy:
+    # 检查API服务器是否可用，熔断期间直接失败而不是等待超时
+    if not naga_client.available:
         logger.error("NagaAgent API服务器未响应，请检查服务器是否启动")
         await naga_handler.finish("NagaAgent API服务器未响应，请检查服务器是否启动")
     
-    # 检查是否是特殊命令
+    # 检查是否是特殊命令，管理命令直接调用系统接口，不与对话请求一起排队
     logger.debug(f"用户消息: '{user_message}'")
+    if user_message in ("devmode on", "devmode off", "sysinfo"):
+        await check_rate_limit(user_id, state)
     if user_message == "devmode on":
         logger.info("用户请求启用开发者模式")
         result = await naga_client.toggle_developer_mode(True)
@@ -413,79 +607,278 @@ async def handle_naga_command(bot: Bot, event: Event, state: T_State):
             info_text += f"  {key}: {value}\n"
         await naga_handler.finish(info_text.rstrip())
     
-    # 会话管理命令
-    elif user_message.startswith("session "):
-        await handle_session_commands(user_id, user_message[8:], naga_handler)  # 8是"session "的长度
+    # 等待合并窗口内的后续消息，被合并的消息由同一批的第一条消息统一回复，
+    # 此时还不分配会话ID，按用户当前活跃的会话名称合并
+    if debouncer.enabled:
+        with tracer.span("debounce"):
+            user_state = await session_store.get_user(user_id)
+            merged = await debouncer.collect((user_id, user_state.active), user_message)
+        if merged is None:
+            MESSAGES_MERGED.inc()
+            logger.debug(f"用户 {user_id} 的消息已合并到之前的消息中")
+            return
+        user_message = merged
+    
+    # 合并后的一批消息只发送一次请求，由发送请求的第一条消息检查请求频率，
+    # 被限流的消息不会分配会话ID，也不会写入会话存储
+    await check_rate_limit(user_id, state)
+    
+    # 获取用户的会话ID，如果用户没有任何会话，自动创建一个默认会话
+    with tracer.span("session"):
+        session_id = await resolve_session_id(user_id)
+    
+    # 处理普通对话，同一会话中还有请求未完成时按配置的策略排队、取消之前的请求或拒绝
+    try:
+        # 各阶段的调用已按剩余预算限制超时，预算用完后留出少量时间发送超时提示，之后强制取消
+        left = deadline.remaining()
+        cancelled = await request_registry.run(
+            user_id, session_id, lambda: process_chat(user_id, user_message, session_id),
+            timeout=None if left is None else max(0.0, left) + DEADLINE_GRACE
+        )
+    except AdmissionRejected as e:
+        logger.warning(f"用户 {user_id} 的请求未被接纳: {e.reason}")
+        await naga_handler.finish(e.message)
+    if cancelled == "deadline":
+        logger.warning(f"用户 {user_id} 的请求超出处理时间预算，已强制取消")
+        await naga_handler.finish(deadline_reply())
+    if cancelled:
+        # 被取消的请求不再回复，取消命令或新消息会给出回复
+        logger.info(f"用户 {user_id} 的请求已取消: {cancelled}")
+
+
+async def check_rate_limit(user_id: str, state: T_State) -> None:
+    """
+    为一次发往NagaAgent的请求检查请求频率，超出限制时结束处理
+    
+    同一限流对象在提示间隔内只提示一次，其余被限流的消息不回复
+    
+    Args:
+        user_id: 用户ID
+        state: 事件处理状态，包含匹配规则提取的群组ID和适配器名称
+    """
+    if not throttle.enabled:
         return
+    try:
+        throttle.acquire(user_id, state.get("group_id"), state.get("adapter"))
+    except RateLimited as e:
+        RATE_LIMITED.labels(e.scope).inc()
+        logger.warning(f"用户 {user_id} 的请求超出频率限制: {e.scope}")
+        if e.notice:
+            await naga_handler.finish(e.message)
+        await naga_handler.finish()
+
+
+def format_job_status(user_id: str, job_id: str = "") -> str:
+    """
+    生成后台任务的进度信息
+    
+    Args:
+        user_id: 用户ID，只能查询自己的任务
+        job_id: 任务ID，为空时列出用户的所有任务
+        
+    Returns:
+        回复文本
+    """
+    if not job_id:
+        jobs = job_manager.user_jobs(user_id)
+        if not jobs:
+            return "📋 当前没有后台任务"
+        lines = ["📋 后台任务:"]
+        for job in jobs[-10:]:
+            lines.append(f"  {job.id} {JOB_STATUS_TEXT[job.status]} ({job.elapsed:.0f}秒) {job.description[:20]}")
+        return "\n".join(lines)
+    
+    job = job_manager.get(job_id)
+    if job is None or job.user_id != user_id:
+        return f"❌ 未找到任务 {job_id}，任务记录可能已过期"
+    lines = [
+        f"📋 任务 {job.id}: {JOB_STATUS_TEXT[job.status]}",
+        f"  内容: {job.description[:50]}",
+        f"  耗时: {job.elapsed:.0f}秒",
+    ]
+    if job.active and job.progress:
+        lines.append(f"  进度: {job.progress}")
+    if job.error:
+        lines.append(f"  失败原因: {job.error[:100]}")
+    return "\n".join(lines)
+
+
+def deadline_reply(partial: str = "") -> str:
+    """
+    生成处理时间预算用完时的回复
     
-    # 处理普通对话
+    Args:
+        partial: 已经获得的部分结果
+        
+    Returns:
+        回复文本
+    """
+    # 后台任务使用单独的处理时间预算
+    seconds = plugin_config.naga_job_deadline if current_job() else plugin_config.naga_request_deadline
+    if partial:
+        return f"⏱️ 处理时间超过 {seconds:g} 秒，以下是已获得的部分结果:\n{partial}"
+    return f"⏱️ 处理时间超过 {seconds:g} 秒，请稍后重试或简化问题"
+
+
+async def fail_reply(message: str) -> None:
+    """
+    结束处理并回复错误信息，在后台任务中同时记录为任务的失败原因
+    
+    Args:
+        message: 回复给用户的错误信息
+    """
+    job = current_job()
+    if job is not None:
+        job.error = message
+        message = f"❌ 任务 {job.id}: {message}"
+    await naga_handler.finish(message)
+
+
+async def run_handoff_loop(user_id: str, reply: str, handoff_calls: List[Dict[str, Any]],
+                           session_id: Optional[str], lane: str = LANE_HANDOFF) -> str:
+    """
+    执行工具调用循环，直到LLM的回复中不再包含工具调用
+    
+    Args:
+        user_id: 用户ID
+        reply: 包含工具调用的LLM回复
+        handoff_calls: 从回复中解析出的工具调用
+        session_id: 当前会话ID
+        lane: 工具调用和后续请求排队时使用的优先级通道
+        
+    Returns:
+        最终回复
+    """
+    for i in range(plugin_config.max_handoff_loop):
+        # 并发执行本轮回复中的所有工具调用，结果合并后一次性发送给LLM
+        services = ', '.join(call['service_name'] for call in handoff_calls)
+        logger.info(f"执行第 {i+1} 轮工具调用: {services}")
+        set_progress(f"第 {i+1} 轮工具调用: {services}")
+        HANDOFF_ROUNDS.inc()
+        for handoff_data in handoff_calls:
+            HANDOFF_CALLS.labels(service_label(handoff_data["service_name"])).inc()
+        with HANDLER_DURATION.labels("tool_calls").time(), tracer.span("tool_calls", round=i + 1, calls=len(handoff_calls)):
+            async with admission.slot(user_id, lane):
+                service_results = await run_handoff_calls(handoff_calls, session_id)
+        
+        result_lines = []
+        failures = []
+        for handoff_data, service_result in zip(handoff_calls, service_results):
+            logger.opt(lazy=True).debug("工具调用结果: {}", lambda: service_result)
+            # 检查工具调用结果
+            if not isinstance(service_result, dict):
+                logger.error(f"工具调用响应格式错误: {type(service_result)}")
+                service_result = {"status": "error", "message": "工具调用响应格式错误"}
+            if service_result.get("status") == "error":
+                logger.error(f"工具 {handoff_data['service_name']} 调用失败: {service_result.get('message')}")
+                failures.append(service_result.get("message", "工具调用失败"))
+            result_lines.append(f"工具 {handoff_data['service_name']} 执行结果: {format_tool_result(service_result)}")
+        
+        # 所有工具调用都失败时直接告知用户，部分失败时把失败原因一并交给LLM处理
+        if len(failures) == len(handoff_calls):
+            if deadline.expired():
+                await fail_reply(deadline_reply())
+            await fail_reply(f"工具调用失败: {failures[0]}")
+        
+        # 将结果发送回LLM进行下一步处理
+        followup_message = "\n".join(result_lines)
+        if deadline.expired():
+            # 没有时间再让LLM整理结果，直接返回工具调用结果
+            await fail_reply(deadline_reply(followup_message))
+        logger.opt(lazy=True).debug("发送给LLM的消息: {}", lambda: followup_message)
+        set_progress(f"第 {i+1} 轮工具调用完成，正在整理结果")
+        with HANDLER_DURATION.labels("followup").time(), tracer.span("followup", round=i + 1):
+            async with admission.slot(user_id, lane):
+                followup_response = await naga_client.chat(
+                    followup_message,
+                    session_id
+                )
+        logger.opt(lazy=True).debug("LLM响应: {}", lambda: followup_response)
+        
+        # 检查LLM响应格式
+        if not isinstance(followup_response, dict):
+            logger.error(f"LLM响应格式错误: {type(followup_response)}")
+            await fail_reply("LLM响应格式错误")
+            
+        # 检查LLM调用是否成功
+        if followup_response.get("status") == "error":
+            if deadline.expired():
+                await fail_reply(deadline_reply(followup_message))
+            error_msg = followup_response.get("message", "LLM调用失败")
+            logger.error(f"LLM调用失败: {error_msg}")
+            await fail_reply(f"LLM调用失败: {error_msg}")
+            
+        reply = followup_response.get("response", "")
+        # 更新会话ID（如果API返回了新的会话ID）
+        new_session_id = followup_response.get("session_id")
+        # 如果API没有返回新的会话ID，使用我们生成的ID
+        actual_session_id = new_session_id if new_session_id else session_id
+        
+        if actual_session_id:
+            await save_session_id(user_id, actual_session_id)
+            session_id = actual_session_id
+        
+        handoff_calls = parse_handoff_calls(reply)
+        
+        # 如果没有更多的工具调用内容，跳出循环
+        if not handoff_calls:
+            logger.info("工具调用循环结束")
+            break
+        
+        if plugin_config.show_handoff:
+            await naga_handler.send(f"中间结果: {reply}")
+    return reply
+
+
+async def run_handoff_job(job: Job, user_id: str, reply: str, handoff_calls: List[Dict[str, Any]],
+                          session_id: Optional[str]) -> None:
+    """
+    在后台任务中执行工具调用循环，完成后把结果发送给用户
+    
+    任务脱离原消息的处理时间预算，使用单独的任务预算，并记录为单独的追踪
+    """
+    with tracer.trace("naga.job", job_id=job.id, user_id=user_id), deadline.deadline_scope(plugin_config.naga_job_deadline, detach=True):
+        try:
+            reply = await run_handoff_loop(user_id, reply, handoff_calls, session_id, lane=LANE_BACKGROUND)
+            if not reply:
+                await fail_reply("未收到有效的回复内容")
+            with tracer.span("send", chars=len(reply)):
+                await naga_handler.send(f"✅ 任务 {job.id} 已完成:\n{reply}")
+        except MatcherException:
+            # 失败原因已经由 fail_reply 记录并发送给用户
+            pass
+        except AdmissionRejected as e:
+            logger.warning(f"后台任务 {job.id} 的请求未被接纳: {e.reason}")
+            job.error = e.message
+            await naga_handler.send(f"❌ 任务 {job.id}: {e.message}")
+        except Exception as e:
+            logger.error(f"后台任务 {job.id} 出错 (追踪ID: {current_trace_id()}): {e}", exc_info=True)
+            job.error = "处理时发生错误"
+            await naga_handler.send(f"❌ 任务 {job.id} 处理时发生错误，请稍后重试")
+
+
+async def process_chat(user_id: str, user_message: str, session_id: str):
+    """
+    处理普通对话，包括工具调用循环，在可取消的任务中执行
+    
+    Args:
+        user_id: 用户ID
+        user_message: 用户消息
+        session_id: 当前活跃会话的ID
+    """
     try:
         logger.info(f"开始处理普通对话请求: {user_message}")
         
-        # 获取用户的会话ID（如果存在）
-        # 如果用户没有任何会话，自动创建一个默认会话
-        if user_id not in user_sessions:
-            user_sessions[user_id] = {}
-        
-        user_session_dict = user_sessions.get(user_id, {})
-        active_session_name = active_sessions.get(user_id)
-        
-        # 初始化session_id变量
-        session_id = None
-        
-        # 如果没有任何会话，自动创建默认会话
-        if not user_session_dict:
-            # 创建默认会话，使用生成的6位数字ID
-            default_session_id = generate_session_id()
-            user_session_dict["default"] = default_session_id
-            user_sessions[user_id] = user_session_dict
-            active_sessions[user_id] = "default"
-            active_session_name = "default"
-            session_id = default_session_id
-            logger.debug(f"为用户 {user_id} 自动创建默认会话，ID: {default_session_id}")
-        # 如果没有活跃会话但有会话存在，使用第一个会话
-        elif not active_session_name and user_session_dict:
-            active_session_name = next(iter(user_session_dict))
-            active_sessions[user_id] = active_session_name
-            # 确保会话有有效的ID
-            session_id = user_session_dict.get(active_session_name)
-            if not session_id:
-                session_id = generate_session_id()
-                user_session_dict[active_session_name] = session_id
-                user_sessions[user_id] = user_session_dict
-                logger.debug(f"为用户 {user_id} 的会话 '{active_session_name}' 分配ID: {session_id}")
-        else:
-            # 如果有活跃会话，获取会话ID
-            if active_session_name:
-                session_id = user_session_dict.get(active_session_name)
-                # 如果会话ID不存在或无效，生成新的ID
-                if not session_id:
-                    session_id = generate_session_id()
-                    user_session_dict[active_session_name] = session_id
-                    user_sessions[user_id] = user_session_dict
-                    logger.debug(f"为用户 {user_id} 的会话 '{active_session_name}' 分配ID: {session_id}")
-        
-        # 确保session_id不为None
-        if not session_id:
-            session_id = generate_session_id()
-            # 如果有活跃会话，则更新该会话的ID
-            if active_session_name:
-                user_session_dict[active_session_name] = session_id
-                user_sessions[user_id] = user_session_dict
-                logger.debug(f"为用户 {user_id} 的会话 '{active_session_name}' 更新ID: {session_id}")
+        # 先尝试普通对话，开启流式回复时边生成边发送
+        with HANDLER_DURATION.labels("chat").time(), tracer.span("chat", stream=plugin_config.naga_stream_reply):
+            if plugin_config.naga_stream_reply:
+                # 流式回复只在读取响应期间占用准入名额，不包括向平台发送分段的时间
+                response = await stream_chat_reply(user_id, user_message, session_id)
             else:
-                # 如果没有活跃会话，创建默认会话
-                user_session_dict["default"] = session_id
-                user_sessions[user_id] = user_session_dict
-                active_sessions[user_id] = "default"
-                active_session_name = "default"
-                logger.debug(f"为用户 {user_id} 创建默认会话，ID: {session_id}")
-        
-        logger.debug(f"用户 {user_id} 的活跃会话 '{active_session_name}' ID: {session_id}")
-        
-        # 先尝试普通对话
-        response = await naga_client.chat(user_message, session_id)
-        logger.debug(f"API响应: {response}")
+                async with admission.slot(user_id):
+                    response = await naga_client.chat(user_message, session_id)
+        # 调试日志只在实际输出时才格式化完整响应
+        logger.opt(lazy=True).debug("API响应: {}", lambda: response)
         
         # 检查响应格式
         if not isinstance(response, dict):
@@ -494,6 +887,8 @@ async def handle_naga_command(bot: Bot, event: Event, state: T_State):
             
         # 检查API调用是否成功
         if response.get("status") == "error":
+            if deadline.expired():
+                await naga_handler.finish(deadline_reply())
             error_msg = response.get("message", "API调用失败")
             logger.error(f"API调用失败: {error_msg}")
             await naga_handler.finish(f"API调用失败: {error_msg}")
@@ -507,20 +902,9 @@ async def handle_naga_command(bot: Bot, event: Event, state: T_State):
             actual_session_id = new_session_id if new_session_id else session_id
             
             if actual_session_id:
-                # 初始化用户会话字典
-                if user_id not in user_sessions:
-                    user_sessions[user_id] = {}
-                
-                # 获取当前活跃会话名
-                active_session_name = active_sessions.get(user_id)
-                
-                # 如果有活跃会话，保存会话ID
-                if active_session_name:
-                    user_sessions[user_id][active_session_name] = actual_session_id
-                    logger.debug(f"为用户 {user_id} 的会话 '{active_session_name}' 保存ID: {actual_session_id}")
-                    
-                    # 更新当前会话ID变量，确保在后续工具调用中使用正确的会话ID
-                    session_id = actual_session_id
+                await save_session_id(user_id, actual_session_id)
+                # 更新当前会话ID变量，确保在后续工具调用中使用正确的会话ID
+                session_id = actual_session_id
                 
             logger.info(f"API调用成功，回复长度: {len(reply) if reply else 0}, session_id: {session_id}")
             
@@ -530,99 +914,35 @@ async def handle_naga_command(bot: Bot, event: Event, state: T_State):
                 await naga_handler.finish("API返回了空回复")
             
             # 检查是否有HANDOFF内容需要处理（工具调用）
-            handoff_data = parse_handoff_content(reply)
-            if handoff_data:
-                logger.info(f"检测到工具调用，开始处理工具调用循环: {handoff_data['service_name']}")
-                # 确保session_id已定义
-                if 'session_id' not in locals():
-                    logger.warning("在工具调用循环中，session_id未定义，使用默认值")
-                    session_id = None
+            handoff_calls = parse_handoff_calls(reply)
+            if handoff_calls:
+                logger.info(f"检测到 {len(handoff_calls)} 个工具调用，开始处理工具调用循环: {', '.join(call['service_name'] for call in handoff_calls)}")
                 
-                # 处理工具调用循环
-                for i in range(plugin_config.max_handoff_loop):
-                    logger.info(f"执行第 {i+1} 次工具调用: {handoff_data['service_name']}")
-                    # 执行MCP服务调用
-                    # 根据新的API文档，task应该包含tool_name和其他参数
-                    task_data = handoff_data["params"].copy()
-                    service_result = await naga_client.mcp_handoff(
-                        handoff_data["service_name"],
-                        task_data,
-                        session_id
+                # 工具调用可能耗时较长，开启任务模式时转为后台任务执行，先回复任务ID
+                if job_manager.enabled:
+                    job = job_manager.submit(
+                        user_id, user_message,
+                        lambda job: run_handoff_job(job, user_id, reply, handoff_calls, session_id)
                     )
-                    logger.debug(f"工具调用结果: {service_result}")
-                    
-                    # 检查工具调用结果
-                    if not isinstance(service_result, dict):
-                        logger.error(f"工具调用响应格式错误: {type(service_result)}")
-                        await naga_handler.finish("工具调用响应格式错误")
-                    
-                    # 检查工具调用是否成功
-                    if service_result.get("status") == "error":
-                        error_msg = service_result.get("message", "工具调用失败")
-                        logger.error(f"工具调用失败: {error_msg}")
-                        await naga_handler.finish(f"工具调用失败: {error_msg}")
-                    
-                    # 将结果发送回LLM进行下一步处理
-                    followup_message = f"工具 {handoff_data['service_name']} 执行结果: {json.dumps(service_result, ensure_ascii=False)}"
-                    logger.debug(f"发送给LLM的消息: {followup_message}")
-                    # 确保session_id在调用前已定义
-                    if 'session_id' not in locals() or session_id is None:
-                        logger.warning("在工具调用循环中，session_id未定义，使用默认值")
-                        session_id = None
-                    followup_response = await naga_client.chat(
-                        followup_message,
-                        session_id
+                    logger.info(f"用户 {user_id} 的工具调用转为后台任务 {job.id}")
+                    await naga_handler.finish(
+                        f"🕒 需要调用工具，已转为后台任务 {job.id}，完成后会把结果发送给你\n"
+                        f"可以使用 '#naga status {job.id}' 查看进度"
                     )
-                    logger.debug(f"LLM响应: {followup_response}")
-                    
-                    # 检查LLM响应格式
-                    if not isinstance(followup_response, dict):
-                        logger.error(f"LLM响应格式错误: {type(followup_response)}")
-                        await naga_handler.finish("LLM响应格式错误")
-                        
-                    # 检查LLM调用是否成功
-                    if followup_response.get("status") == "error":
-                        error_msg = followup_response.get("message", "LLM调用失败")
-                        logger.error(f"LLM调用失败: {error_msg}")
-                        await naga_handler.finish(f"LLM调用失败: {error_msg}")
-                        
-                    reply = followup_response.get("response", "")
-                    # 更新会话ID（如果API返回了新的会话ID）
-                    new_session_id = followup_response.get("session_id")
-                    # 如果API没有返回新的会话ID，使用我们生成的ID
-                    actual_session_id = new_session_id if new_session_id else session_id
-                    
-                    if actual_session_id:
-                        # 初始化用户会话字典
-                        if user_id not in user_sessions:
-                            user_sessions[user_id] = {}
-                        
-                        # 获取当前活跃会话名
-                        active_session_name = active_sessions.get(user_id)
-                        
-                        # 如果有活跃会话，保存会话ID
-                        if active_session_name:
-                            user_sessions[user_id][active_session_name] = actual_session_id
-                            logger.debug(f"为用户 {user_id} 的会话 '{active_session_name}' 更新ID: {actual_session_id}")
-                            
-                            # 更新当前会话ID变量
-                            session_id = actual_session_id
-                    
-                    handoff_data = parse_handoff_content(reply)
-                    
-                    # 如果没有更多的工具调用内容，跳出循环
-                    if not handoff_data:
-                        logger.info("工具调用循环结束")
-                        break
-                    
-                    if plugin_config.show_handoff:
-                        await naga_handler.send(f"中间结果: {reply}")
+                
+                # 处理工具调用循环
+                reply = await run_handoff_loop(user_id, reply, handoff_calls, session_id)
             
             # 发送最终回复
             logger.info(f"发送最终回复给用户，长度: {len(reply) if reply else 0}")
             if not reply:
                 await naga_handler.finish("未收到有效的回复内容")
-            await naga_handler.finish(reply)
+            if response.get("streamed") and reply == response.get("response"):
+                # 回复已经通过流式输出分段发送完毕
+                await naga_handler.finish()
+            with tracer.span("send", chars=len(reply)):
+                await naga_handler.send(reply)
+            await naga_handler.finish()
         else:
             error_msg = f"API调用失败: {response.get('message', '未知错误')}"
             logger.error(error_msg)
@@ -639,9 +959,13 @@ async def handle_naga_command(bot: Bot, event: Event, state: T_State):
             # 其他 Matcher 异常，记录但不视为错误
             logger.info(f"Matcher 流程控制: {type(e).__name__}")
             raise  # 重新抛出异常以确保正常流程
+        elif isinstance(e, AdmissionRejected):
+            # 请求过多被准入控制拒绝，快速告知用户
+            logger.warning(f"用户 {user_id} 的请求未被接纳: {e.reason}")
+            await naga_handler.finish(e.message)
         else:
             # 真正的异常情况
-            logger.error(f"NagaAgent API调用出错: {e}", exc_info=True)
+            logger.error(f"NagaAgent API调用出错 (追踪ID: {current_trace_id()}): {e}", exc_info=True)
             try:
                 await naga_handler.finish("处理命令时发生错误，请稍后重试")
             except FinishedException:
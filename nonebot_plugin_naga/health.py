@@ -0,0 +1,148 @@
+import asyncio
+import time
+from typing import TYPE_CHECKING, Optional
+
+from nonebot import logger
+
+if TYPE_CHECKING:
+    from .api_client import NagaAgentClient
+
+
+class CircuitBreaker:
+    """
+    熔断器，根据请求结果判断后端是否可用
+
+    - closed: 正常状态，连续失败次数达到阈值后进入open状态
+    - open: 熔断状态，请求立即失败，经过恢复时间后进入half_open状态
+    - half_open: 半开状态，只放行少量探测请求，成功则关闭熔断，失败则重新熔断
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0,
+                 half_open_max_calls: int = 1, name: str = "NagaAgent"):
+        """
+        初始化熔断器
+
+        Args:
+            failure_threshold: 连续失败多少次后熔断
+            recovery_timeout: 熔断后经过多久进入半开状态（秒）
+            half_open_max_calls: 半开状态下允许同时进行的探测请求数
+            name: 熔断器名称，用于日志
+        """
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = max(1, half_open_max_calls)
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._half_open_calls = 0
+
+    @property
+    def available(self) -> bool:
+        """后端当前是否可能可用（不占用半开状态的探测名额）"""
+        if self.state != self.OPEN:
+            return True
+        return time.monotonic() - self.opened_at >= self.recovery_timeout
+
+    def allow_request(self) -> bool:
+        """
+        判断是否允许发送请求
+
+        Returns:
+            bool: 是否允许发送请求，半开状态下会占用一个探测名额
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._half_open_calls = 0
+            logger.info(f"{self.name} 熔断器进入半开状态，开始探测")
+        if self._half_open_calls >= self.half_open_max_calls:
+            return False
+        self._half_open_calls += 1
+        return True
+
+    def record_success(self) -> None:
+        """记录一次成功的请求"""
+        if self.state != self.CLOSED:
+            logger.info(f"{self.name} 已恢复，熔断器关闭")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._half_open_calls = 0
+
+    def record_failure(self) -> None:
+        """记录一次失败的请求"""
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (
+            self.state == self.CLOSED and self.failures >= self.failure_threshold
+        ):
+            self._open()
+        elif self.state == self.OPEN:
+            # 熔断期间的失败（例如健康探测）会重新计算恢复时间
+            self.opened_at = time.monotonic()
+
+    def release_probe(self) -> None:
+        """请求未能得出后端是否健康的结论时，归还半开状态占用的探测名额"""
+        if self.state == self.HALF_OPEN and self._half_open_calls > 0:
+            self._half_open_calls -= 1
+
+    def _open(self) -> None:
+        """进入熔断状态"""
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self._half_open_calls = 0
+        logger.warning(f"{self.name} 连续失败 {self.failures} 次，熔断器打开")
+
+
+class HealthMonitor:
+    """后台健康检查任务，定期探测NagaAgent服务并更新熔断器状态"""
+
+    def __init__(self, client: "NagaAgentClient", interval: float = 30.0):
+        """
+        初始化健康检查任务
+
+        Args:
+            client: NagaAgent API 客户端
+            interval: 探测间隔（秒），0表示不进行定期探测
+        """
+        self.client = client
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """启动后台探测任务"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """停止后台探测任务"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        """探测循环"""
+        healthy = await self.client.health_check()
+        if healthy:
+            logger.success("NagaAgent API服务器连接正常")
+        else:
+            logger.error("NagaAgent API服务器未响应，请检查服务器是否启动")
+        if self.interval <= 0:
+            return
+
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.client.health_check()
+            except Exception as e:
+                logger.warning(f"健康检查任务出错: {e}")
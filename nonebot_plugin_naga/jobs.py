@@ -0,0 +1,223 @@
+import asyncio
+import re
+import secrets
+import time
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from nonebot import logger
+
+from .limiter import AdmissionRejected
+
+
+# 任务状态
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+JOB_STATUS_TEXT = {
+    JOB_PENDING: "排队中",
+    JOB_RUNNING: "进行中",
+    JOB_DONE: "已完成",
+    JOB_FAILED: "失败",
+    JOB_CANCELLED: "已取消",
+}
+
+
+class Job:
+    """一个在后台执行的请求"""
+
+    __slots__ = ("id", "user_id", "description", "status", "progress", "error",
+                 "created", "started", "finished", "task")
+
+    def __init__(self, job_id: str, user_id: str, description: str):
+        self.id = job_id
+        self.user_id = user_id
+        self.description = description
+        self.status = JOB_PENDING
+        # 当前进度说明，由任务执行过程中更新
+        self.progress = ""
+        # 失败原因，任务执行过程中设置后任务结束时记为失败
+        self.error: Optional[str] = None
+        self.created = time.monotonic()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in (JOB_PENDING, JOB_RUNNING)
+
+    @property
+    def elapsed(self) -> float:
+        """从提交到结束（或到现在）经过的秒数"""
+        return (self.finished or time.monotonic()) - self.created
+
+
+# 任务ID格式，与 JobManager._new_id 生成的ID一致
+_JOB_ID_PATTERN = re.compile(r"[0-9a-f]{6}")
+
+
+def is_job_id(text: str) -> bool:
+    """文本是否符合任务ID的格式"""
+    return _JOB_ID_PATTERN.fullmatch(text) is not None
+
+
+# 当前协程所在的后台任务
+_current_job: ContextVar[Optional[Job]] = ContextVar("naga_current_job", default=None)
+
+
+def current_job() -> Optional[Job]:
+    """当前协程所在的后台任务，不在后台任务中时返回None"""
+    return _current_job.get()
+
+
+def set_progress(progress: str) -> None:
+    """更新当前后台任务的进度说明，不在后台任务中时不做任何事"""
+    job = _current_job.get()
+    if job is not None:
+        job.progress = progress
+
+
+class JobManager:
+    """
+    后台任务池
+
+    耗时较长的请求提交为后台任务后立即返回任务ID，任务在有界的并发池中执行，
+    结束后的任务记录保留一段时间供查询进度
+    """
+
+    def __init__(self, workers: int = 4, max_pending: int = 50, retention: float = 3600.0):
+        """
+        初始化任务池
+
+        Args:
+            workers: 同时执行的任务数，0表示关闭任务模式
+            max_pending: 未结束（排队中和进行中）的任务上限
+            retention: 结束后的任务记录保留时间（秒）
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.retention = retention
+        self._semaphore = asyncio.Semaphore(max(1, workers))
+        # 按提交顺序保存的任务记录
+        self._jobs: Dict[str, Job] = {}
+        self._pending = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    @property
+    def pending(self) -> int:
+        """未结束的任务数"""
+        return self._pending
+
+    def _cleanup(self) -> None:
+        """
+        清理超过保留时间的任务记录
+
+        任务按提交顺序排列，但结束顺序不同，未结束的任务之后仍可能有已过期的记录，
+        因此跳过未结束的任务继续检查，遇到结束后仍在保留期内的任务即停止：
+        它之后提交的任务即使已经结束，通常也结束得更晚
+        """
+        now = time.monotonic()
+        expired = []
+        for job in self._jobs.values():
+            if job.finished is None:
+                continue
+            if now - job.finished < self.retention:
+                break
+            expired.append(job.id)
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _new_id(self) -> str:
+        while True:
+            job_id = secrets.token_hex(3)
+            if job_id not in self._jobs:
+                return job_id
+
+    def submit(self, user_id: str, description: str,
+               factory: Callable[[Job], Awaitable[None]]) -> Job:
+        """
+        提交后台任务
+
+        Args:
+            user_id: 用户ID
+            description: 任务说明，通常为用户消息
+            factory: 接收任务对象、返回执行任务的协程的函数
+
+        Returns:
+            任务对象
+
+        Raises:
+            AdmissionRejected: 未结束的任务已达上限
+        """
+        self._cleanup()
+        if self._pending >= self.max_pending:
+            raise AdmissionRejected("jobs_full", "⏳ 后台任务过多，请稍后再试")
+        job = Job(self._new_id(), user_id, description)
+        self._jobs[job.id] = job
+        self._pending += 1
+        # 任务继承当前上下文，结果可以发送到原消息所在的会话
+        job.task = asyncio.ensure_future(self._run(job, factory))
+        # 在完成回调中统计，任务在开始执行前就被取消时也能正确结束
+        job.task.add_done_callback(lambda task: self._finished(job, task))
+        return job
+
+    def _finished(self, job: Job, task: asyncio.Task) -> None:
+        if task.cancelled():
+            job.status = JOB_CANCELLED
+        job.finished = time.monotonic()
+        self._pending -= 1
+        logger.info(f"后台任务 {job.id} 结束: {job.status}，耗时 {job.elapsed:.1f} 秒")
+
+    async def _run(self, job: Job, factory: Callable[[Job], Awaitable[None]]) -> None:
+        token = _current_job.set(job)
+        try:
+            async with self._semaphore:
+                job.status = JOB_RUNNING
+                job.started = time.monotonic()
+                await factory(job)
+            job.status = JOB_FAILED if job.error else JOB_DONE
+        except Exception as e:
+            job.status = JOB_FAILED
+            job.error = job.error or str(e)
+            logger.error(f"后台任务 {job.id} 执行出错: {e}", exc_info=True)
+        finally:
+            _current_job.reset(token)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """按ID获取任务"""
+        self._cleanup()
+        return self._jobs.get(job_id)
+
+    def user_jobs(self, user_id: str) -> List[Job]:
+        """获取用户的所有任务记录，按提交顺序排列"""
+        self._cleanup()
+        return [job for job in self._jobs.values() if job.user_id == user_id]
+
+    def cancel(self, user_id: str) -> int:
+        """
+        取消用户所有未结束的任务
+
+        Returns:
+            取消的任务数
+        """
+        cancelled = 0
+        for job in self._jobs.values():
+            if job.user_id == user_id and job.active and job.task is not None:
+                job.task.cancel()
+                cancelled += 1
+        return cancelled
+
+    async def close(self) -> None:
+        """取消所有未结束的任务并等待它们退出"""
+        tasks = [job.task for job in self._jobs.values() if job.active and job.task is not None]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
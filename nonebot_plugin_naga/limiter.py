@@ -0,0 +1,426 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from . import deadline
+from .metrics import ADMISSION_REJECTED, QUEUE_WAIT, REQUESTS_CANCELLED
+from .tracing import tracer
+
+
+class AdmissionRejected(Exception):
+    """请求未被接纳（等待队列已满或排队超时）"""
+
+    def __init__(self, reason: str, message: str):
+        """
+        Args:
+            reason: 拒绝原因，queue_full、queue_timeout 或 busy
+            message: 返回给用户的提示信息
+        """
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+
+
+# 发往NagaAgent的请求所在的优先级通道
+LANE_INTERACTIVE = "interactive"  # 用户发起的对话
+LANE_HANDOFF = "handoff"  # 工具调用和调用结果返回给LLM的后续请求
+LANE_BACKGROUND = "background"  # 后台任务
+
+# 各通道的默认权重，排队时按权重比例分配空出的名额
+DEFAULT_LANE_WEIGHTS = {LANE_HANDOFF: 4, LANE_INTERACTIVE: 2, LANE_BACKGROUND: 1}
+
+
+class _Lane:
+    """一个优先级通道的等待队列，每个用户单独排队，用户之间轮流接纳"""
+
+    __slots__ = ("name", "weight", "users", "order", "size", "vtime")
+
+    def __init__(self, name: str, weight: int):
+        self.name = name
+        self.weight = max(1, weight)
+        self.users: Dict[str, Deque[asyncio.Future]] = {}
+        # 有排队请求的用户的轮转顺序
+        self.order: Deque[str] = deque()
+        self.size = 0
+        # 虚拟时间，每接纳一个请求增加 1/weight，总是优先接纳虚拟时间最小的通道
+        self.vtime = 0.0
+
+    def push(self, user_id: str, future: asyncio.Future) -> None:
+        queue = self.users.get(user_id)
+        if queue is None:
+            queue = self.users[user_id] = deque()
+            self.order.append(user_id)
+        queue.append(future)
+        self.size += 1
+
+    def remove(self, user_id: str, future: asyncio.Future) -> bool:
+        """移除排队请求，请求已不在队列中时返回False"""
+        queue = self.users.get(user_id)
+        if queue is None:
+            return False
+        try:
+            queue.remove(future)
+        except ValueError:
+            return False
+        self.size -= 1
+        if not queue:
+            del self.users[user_id]
+            self.order.remove(user_id)
+        return True
+
+    def next_user(self, can_admit: Callable[[str], bool]) -> Optional[str]:
+        """
+        按轮转顺序找到第一个可以接纳的用户，并把它移到轮转队列的开头
+
+        Returns:
+            用户ID，所有排队用户都达到单用户并发上限时返回None
+        """
+        for _ in range(len(self.order)):
+            if can_admit(self.order[0]):
+                return self.order[0]
+            self.order.rotate(-1)
+        return None
+
+    def pop(self, user_id: str) -> asyncio.Future:
+        """取出用户最早的请求，该用户还有排队请求时移到轮转队列末尾"""
+        queue = self.users[user_id]
+        future = queue.popleft()
+        self.size -= 1
+        self.order.remove(user_id)
+        if queue:
+            self.order.append(user_id)
+        else:
+            del self.users[user_id]
+        return future
+
+
+class AdmissionController:
+    """
+    请求准入控制器，限制同时发往NagaAgent的请求数量
+
+    同时限制全局并发数和单个用户的并发数，超出限制的请求进入有界等待队列，
+    队列已满时立即拒绝，排队超时后放弃，避免后端被突发流量压垮。
+
+    等待队列分为多个优先级通道，空出名额时按通道权重加权轮转，高权重的通道优先但低权重的通道不会饿死；
+    同一通道中每个用户单独排队、轮流接纳，并限制单个用户的排队数，
+    一个用户连续发送大量消息不会挤占其他用户的名额
+    """
+
+    def __init__(self, max_inflight: int = 32, max_per_user: int = 2,
+                 max_queue: int = 100, queue_timeout: float = 30.0,
+                 max_user_queue: int = 0, lane_weights: Optional[Dict[str, int]] = None):
+        """
+        初始化准入控制器
+
+        Args:
+            max_inflight: 全局最大并发请求数，0表示不限制
+            max_per_user: 单个用户最大并发请求数，0表示不限制
+            max_queue: 等待队列最大长度
+            queue_timeout: 排队等待超时时间（秒）
+            max_user_queue: 单个用户最多排队的请求数，0表示不限制
+            lane_weights: 各通道的权重，未指定的通道使用默认权重
+        """
+        self.max_inflight = max_inflight
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_user_queue = max_user_queue
+        self.inflight = 0
+        self._user_inflight: Dict[str, int] = {}
+        self._user_queued: Dict[str, int] = {}
+        weights = dict(DEFAULT_LANE_WEIGHTS)
+        weights.update(lane_weights or {})
+        self._lanes: Dict[str, _Lane] = {name: _Lane(name, weight) for name, weight in weights.items()}
+        self._queued = 0
+        # 最近一次接纳请求时的虚拟时间，空闲后重新排队的通道从这里开始，不会积累过多的优先额度
+        self._vclock = 0.0
+
+    @property
+    def queued(self) -> int:
+        """当前排队中的请求数"""
+        return self._queued
+
+    def lane_queued(self, lane: str) -> int:
+        """指定通道中排队的请求数"""
+        return self._lanes[lane].size
+
+    def _can_admit(self, user_id: str) -> bool:
+        """检查是否可以立即接纳该用户的请求"""
+        if self.max_inflight and self.inflight >= self.max_inflight:
+            return False
+        return self._user_has_capacity(user_id)
+
+    def _user_has_capacity(self, user_id: str) -> bool:
+        """检查该用户是否还有并发名额"""
+        return not self.max_per_user or self._user_inflight.get(user_id, 0) < self.max_per_user
+
+    def _admit(self, user_id: str) -> None:
+        """占用一个并发名额"""
+        self.inflight += 1
+        self._user_inflight[user_id] = self._user_inflight.get(user_id, 0) + 1
+
+    def _release(self, user_id: str) -> None:
+        """释放并发名额，并唤醒可以继续执行的排队请求"""
+        self.inflight -= 1
+        count = self._user_inflight.get(user_id, 0) - 1
+        if count > 0:
+            self._user_inflight[user_id] = count
+        else:
+            self._user_inflight.pop(user_id, None)
+        self._wake_waiters()
+
+    def _enqueue(self, lane: _Lane, user_id: str, future: asyncio.Future) -> None:
+        if not lane.size:
+            lane.vtime = max(lane.vtime, self._vclock)
+        lane.push(user_id, future)
+        self._queued += 1
+        self._user_queued[user_id] = self._user_queued.get(user_id, 0) + 1
+
+    def _dequeued(self, user_id: str) -> None:
+        self._queued -= 1
+        count = self._user_queued.get(user_id, 0) - 1
+        if count > 0:
+            self._user_queued[user_id] = count
+        else:
+            self._user_queued.pop(user_id, None)
+
+    def _wake_waiters(self) -> None:
+        """
+        在有空闲名额时唤醒排队请求
+
+        每次从虚拟时间最小的通道中按用户轮转取出一个请求，
+        被单用户上限阻塞的用户会被跳过，不会挡住其他用户
+        """
+        while self._queued:
+            if self.max_inflight and self.inflight >= self.max_inflight:
+                return
+            for lane in sorted((lane for lane in self._lanes.values() if lane.size), key=lambda lane: lane.vtime):
+                user_id = lane.next_user(self._user_has_capacity)
+                if user_id is not None:
+                    break
+            else:
+                return
+            future = lane.pop(user_id)
+            self._dequeued(user_id)
+            self._vclock = lane.vtime
+            lane.vtime += 1.0 / lane.weight
+            self._admit(user_id)
+            future.set_result(None)
+
+    async def acquire(self, user_id: str, lane: str = LANE_INTERACTIVE) -> None:
+        """
+        获取一个并发名额，必要时排队等待
+
+        Args:
+            user_id: 用户ID
+            lane: 请求所在的优先级通道
+
+        Raises:
+            AdmissionRejected: 队列已满或排队超时
+        """
+        if not self._queued and self._can_admit(user_id):
+            self._admit(user_id)
+            QUEUE_WAIT.labels(lane).observe(0.0)
+            return
+
+        if self._queued >= self.max_queue:
+            ADMISSION_REJECTED.labels("queue_full").inc()
+            raise AdmissionRejected("queue_full", "⏳ 当前请求过多，请稍后再试")
+        if self.max_user_queue and self._user_queued.get(user_id, 0) >= self.max_user_queue:
+            ADMISSION_REJECTED.labels("user_queue_full").inc()
+            raise AdmissionRejected("user_queue_full", "⏳ 你的请求过多，请等待之前的请求完成")
+
+        queue = self._lanes[lane]
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(queue, user_id, future)
+        # 排队的请求可能只是被其他用户的并发上限挡住，立即尝试接纳
+        self._wake_waiters()
+        start = time.monotonic()
+        try:
+            # 排队时间同时受当前请求剩余的处理时间预算限制
+            await asyncio.wait_for(asyncio.shield(future), deadline.budget(self.queue_timeout))
+            waited = time.monotonic() - start
+            QUEUE_WAIT.labels(lane).observe(waited)
+            tracer.record_span("queue", waited, lane=lane)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # 超时的同时已经被唤醒，归还名额
+                self._release(user_id)
+            else:
+                future.cancel()
+                if queue.remove(user_id, future):
+                    self._dequeued(user_id)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            ADMISSION_REJECTED.labels("queue_timeout").inc()
+            raise AdmissionRejected("queue_timeout", "⏳ 排队等待超时，请稍后再试") from None
+
+    def release(self, user_id: str) -> None:
+        """
+        归还一个并发名额
+
+        Args:
+            user_id: 用户ID
+        """
+        self._release(user_id)
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, lane: str = LANE_INTERACTIVE) -> AsyncIterator[None]:
+        """
+        以上下文管理器的形式占用并发名额
+
+        Args:
+            user_id: 用户ID
+            lane: 请求所在的优先级通道
+        """
+        await self.acquire(user_id, lane)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+
+# 同一用户同一会话中已有进行中的请求时，新请求的处理策略
+POLICY_QUEUE = "queue"
+POLICY_CANCEL = "cancel"
+POLICY_REJECT = "reject"
+
+
+class InflightRequest:
+    """一个进行中的对话请求"""
+
+    __slots__ = ("user_id", "session_id", "task", "cancel_reason", "started")
+
+    def __init__(self, user_id: str, session_id: Optional[str]):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.task: Optional[asyncio.Task] = None
+        # 被取消的原因，superseded、user 或 deadline，未被取消时为None
+        self.cancel_reason: Optional[str] = None
+        self.started = time.monotonic()
+
+    def cancel(self, reason: str) -> bool:
+        """
+        取消请求，取消会传递到正在进行的HTTP请求和工具调用
+
+        Args:
+            reason: 取消原因
+
+        Returns:
+            请求此前尚未结束且未被取消时返回True
+        """
+        if self.cancel_reason is not None or self.task is None or self.task.done():
+            return False
+        self.cancel_reason = reason
+        self.task.cancel()
+        return True
+
+
+class RequestRegistry:
+    """
+    按用户和会话记录进行中的对话请求
+
+    每个请求在独立的任务中执行，可以随时取消；同一用户在同一会话中还有请求未完成时，
+    新请求按策略排队等待、取消之前的请求或被拒绝，避免用户不再需要的回复继续占用后端
+    """
+
+    def __init__(self, policy: str = POLICY_QUEUE):
+        """
+        初始化请求记录
+
+        Args:
+            policy: 冲突处理策略，queue、cancel 或 reject
+        """
+        if policy not in (POLICY_QUEUE, POLICY_CANCEL, POLICY_REJECT):
+            raise ValueError(f"未知的请求冲突处理策略: {policy}")
+        self.policy = policy
+        # {(user_id, session_id): [按开始顺序排列的请求]}
+        self._requests: Dict[Tuple[str, Optional[str]], List[InflightRequest]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(requests) for requests in self._requests.values())
+
+    def user_requests(self, user_id: str) -> List[InflightRequest]:
+        """获取用户所有进行中的请求"""
+        return [
+            request
+            for (owner, _), requests in self._requests.items() if owner == user_id
+            for request in requests
+        ]
+
+    async def run(self, user_id: str, session_id: Optional[str],
+                  factory: Callable[[], Awaitable[None]],
+                  timeout: Optional[float] = None) -> Optional[str]:
+        """
+        在可取消的任务中执行请求
+
+        Args:
+            user_id: 用户ID
+            session_id: 会话ID
+            factory: 执行请求的协程函数
+            timeout: 超时时间（秒），超时后取消请求，取消原因为 deadline
+
+        Returns:
+            请求被取消时返回取消原因，正常完成时返回None
+
+        Raises:
+            AdmissionRejected: 策略为reject且同一会话中已有进行中的请求
+        """
+        key = (user_id, session_id)
+        previous = list(self._requests.get(key, ()))
+        if previous and self.policy == POLICY_REJECT:
+            ADMISSION_REJECTED.labels("busy").inc()
+            raise AdmissionRejected("busy", "⏳ 上一条消息还在处理中，请稍后再试，或发送 #naga cancel 取消")
+        if previous and self.policy == POLICY_CANCEL:
+            for request in previous:
+                if request.cancel("superseded"):
+                    REQUESTS_CANCELLED.labels("superseded").inc()
+            previous = []
+
+        request = InflightRequest(user_id, session_id)
+        request.task = asyncio.ensure_future(self._execute(previous, factory))
+        self._requests.setdefault(key, []).append(request)
+        try:
+            done, _ = await asyncio.wait((request.task,), timeout=timeout)
+            if not done and request.cancel("deadline"):
+                REQUESTS_CANCELLED.labels("deadline").inc()
+            await request.task
+        except asyncio.CancelledError:
+            # asyncio.wait 不会取消等待的任务，外部取消时需要手动取消
+            request.task.cancel()
+            # 只有主动取消的请求才当作正常结束，外部取消（例如关闭）继续向上传递
+            if request.cancel_reason is None:
+                raise
+            return request.cancel_reason
+        finally:
+            requests = self._requests.get(key)
+            if requests is not None:
+                requests.remove(request)
+                if not requests:
+                    del self._requests[key]
+        return None
+
+    @staticmethod
+    async def _execute(previous: List[InflightRequest], factory: Callable[[], Awaitable[None]]) -> None:
+        """排队策略下先等待之前的请求结束，再执行请求"""
+        waiting = [request.task for request in previous if request.task is not None]
+        if waiting:
+            await asyncio.wait(waiting)
+        await factory()
+
+    def cancel(self, user_id: str) -> int:
+        """
+        取消用户所有进行中和排队中的请求
+
+        Args:
+            user_id: 用户ID
+
+        Returns:
+            取消的请求数
+        """
+        cancelled = sum(1 for request in self.user_requests(user_id) if request.cancel("user"))
+        if cancelled:
+            REQUESTS_CANCELLED.labels("user").inc(cancelled)
+        return cancelled
@@ -0,0 +1,298 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from nonebot.adapters import Bot, Event
+
+
+# 前缀作用域，同一前缀同时属于多个作用域时按用户、群组、全局的顺序优先
+SCOPE_USER = "user"
+SCOPE_GROUP = "group"
+SCOPE_GLOBAL = "global"
+
+# 默认激活前缀
+DEFAULT_PREFIX = "#naga"
+
+
+class _TrieNode:
+    """前缀树节点"""
+
+    __slots__ = ("children", "owners")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        # 以该节点结尾的前缀属于哪些作用域 {(scope, owner_id): prefix_type}
+        self.owners: Dict[Tuple[str, str], str] = {}
+
+
+class PrefixTrie:
+    """
+    激活前缀索引
+
+    所有作用域的前缀编译到同一棵前缀树中，匹配时只需沿消息开头逐字符走一遍，
+    耗时只与最长前缀的长度有关，与用户数和前缀数无关。
+    绝大多数消息的第一个字符就不在树中，可以立即判定不匹配
+    """
+
+    def __init__(self):
+        self._root = _TrieNode()
+
+    def add(self, prefix: str, scope: str, owner_id: str = "", prefix_type: str = "custom") -> None:
+        """
+        添加前缀
+
+        Args:
+            prefix: 前缀文本
+            scope: 作用域，SCOPE_USER、SCOPE_GROUP 或 SCOPE_GLOBAL
+            owner_id: 作用域所属的用户ID或群组ID，全局作用域为空字符串
+            prefix_type: 匹配成功后记录到state中的激活方式
+        """
+        if not prefix:
+            return
+        node = self._root
+        for char in prefix:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = _TrieNode()
+            node = child
+        node.owners[(scope, owner_id)] = prefix_type
+
+    def remove(self, prefix: str, scope: str, owner_id: str = "") -> None:
+        """
+        移除前缀，并清理不再使用的节点
+
+        Args:
+            prefix: 前缀文本
+            scope: 作用域
+            owner_id: 作用域所属的用户ID或群组ID
+        """
+        path = [self._root]
+        for char in prefix:
+            node = path[-1].children.get(char)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].owners.pop((scope, owner_id), None)
+        for i in range(len(prefix), 0, -1):
+            node = path[i]
+            if node.owners or node.children:
+                break
+            del path[i - 1].children[prefix[i - 1]]
+
+    def match(self, text: str, owners: Iterable[Tuple[str, str]]) -> Optional[Tuple[str, str]]:
+        """
+        查找消息开头匹配的最长前缀
+
+        Args:
+            text: 消息文本
+            owners: 本条消息可用的作用域，按优先级从高到低排列
+
+        Returns:
+            (前缀, 激活方式)，没有匹配时返回None
+        """
+        node = self._root
+        # 沿途经过的前缀结尾节点，越靠后前缀越长
+        candidates: List[Tuple[int, _TrieNode]] = []
+        for i, char in enumerate(text):
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.owners:
+                candidates.append((i + 1, node))
+        if not candidates:
+            return None
+        owners = tuple(owners)
+        for length, node in reversed(candidates):
+            for owner in owners:
+                prefix_type = node.owners.get(owner)
+                if prefix_type is not None:
+                    return text[:length], prefix_type
+        return None
+
+    def may_match(self, text: str) -> bool:
+        """消息的第一个字符是否可能属于某个前缀"""
+        return bool(text) and text[0] in self._root.children
+
+
+class EventExtractor:
+    """
+    某一适配器某一事件类型的信息提取方式
+
+    原先每条消息都要依次 hasattr 判断如何获取文本和用户ID，
+    现在每种 (Bot, Event) 类型只判断一次，之后直接调用缓存的提取函数
+    """
+
+    __slots__ = ("adapter_name", "get_text", "get_user_id", "group_attr")
+
+    def __init__(self, bot: Bot, event: Event):
+        """
+        根据首个事件实例确定提取方式
+
+        Args:
+            bot: 收到事件的机器人
+            event: 事件实例
+        """
+        adapter = getattr(event, "adapter", None) or getattr(bot, "adapter", None)
+        self.adapter_name: Optional[str] = (
+            adapter.get_name() if adapter is not None and hasattr(adapter, "get_name") else None
+        )
+        self.get_text: Callable[[Event], str] = self._text_extractor(event)
+        self.get_user_id: Callable[[Event], str] = self._user_id_extractor(event)
+        # 群聊标识字段，私聊等没有群组概念的事件为None
+        self.group_attr: Optional[str] = next(
+            (name for name in ("group_id", "channel_id") if hasattr(event, name)), None
+        )
+
+    @staticmethod
+    def _text_extractor(event: Event) -> Callable[[Event], str]:
+        """确定获取消息纯文本的方式"""
+        if hasattr(event, "get_plaintext"):
+            return lambda e: e.get_plaintext()
+        if hasattr(event, "get_message"):
+            def extract(e: Event) -> str:
+                try:
+                    message = e.get_message()
+                except Exception:
+                    return ""
+                if hasattr(message, "extract_plain_text"):
+                    return message.extract_plain_text()
+                return ""
+            return extract
+        return lambda e: ""
+
+    @staticmethod
+    def _user_id_extractor(event: Event) -> Callable[[Event], str]:
+        """确定获取用户ID的方式"""
+        if hasattr(event, "get_user_id"):
+            return lambda e: e.get_user_id()
+        if hasattr(event, "user_id"):
+            return lambda e: str(e.user_id)
+        # 如果无法获取用户ID，使用事件类型和ID组合作为标识符
+        return lambda e: f"{e.__class__.__name__}_{getattr(e, 'event_id', 'unknown')}"
+
+    def normalize(self, raw_id: Any) -> str:
+        """为ID添加平台标识以避免不同平台间的会话混淆"""
+        if self.adapter_name:
+            return f"{self.adapter_name}_{raw_id}"
+        return str(raw_id)
+
+    def group_id(self, event: Event) -> Optional[str]:
+        """获取群组ID（未添加平台标识），不在群聊中时返回None"""
+        if self.group_attr is None:
+            return None
+        value = getattr(event, self.group_attr, None)
+        return str(value) if value is not None else None
+
+
+class MatcherEngine:
+    """
+    Naga消息匹配引擎
+
+    事件规则对所有消息生效，其中绝大多数消息与本插件无关，
+    因此先用缓存的提取函数取出文本，再用前缀树判断，
+    确定匹配后才计算用户ID和群组ID，并将结果保存到state中供处理器复用
+    """
+
+    def __init__(self, global_aliases: Iterable[str] = (),
+                 group_aliases: Optional[Dict[str, List[str]]] = None):
+        """
+        初始化匹配引擎
+
+        Args:
+            global_aliases: 所有用户都可以使用的激活前缀别名
+            group_aliases: 按群组配置的激活前缀别名 {group_id: [prefix, ...]}
+        """
+        self.trie = PrefixTrie()
+        self._extractors: Dict[Tuple[type, type], EventExtractor] = {}
+        self.trie.add(DEFAULT_PREFIX, SCOPE_GLOBAL, prefix_type="default")
+        for alias in global_aliases:
+            if alias != DEFAULT_PREFIX:
+                self.trie.add(alias, SCOPE_GLOBAL, prefix_type="global")
+        for group_id, aliases in (group_aliases or {}).items():
+            for alias in aliases:
+                self.trie.add(alias, SCOPE_GROUP, str(group_id), prefix_type="group")
+
+    def extractor(self, bot: Bot, event: Event) -> EventExtractor:
+        """获取 (Bot, Event) 类型对应的缓存提取器"""
+        key = (type(bot), type(event))
+        extractor = self._extractors.get(key)
+        if extractor is None:
+            extractor = self._extractors[key] = EventExtractor(bot, event)
+        return extractor
+
+    def set_user_prefix(self, user_id: str, prefix: Optional[str], old_prefix: Optional[str] = None) -> None:
+        """
+        更新用户自定义前缀
+
+        Args:
+            user_id: 带平台标识的用户ID
+            prefix: 新前缀，为None时只清除旧前缀
+            old_prefix: 用户之前的前缀
+        """
+        if old_prefix:
+            self.trie.remove(old_prefix, SCOPE_USER, user_id)
+        if prefix:
+            self.trie.add(prefix, SCOPE_USER, user_id, prefix_type="custom")
+
+    def load_user_prefixes(self, prefixes: Dict[str, str]) -> None:
+        """
+        批量加载用户自定义前缀
+
+        Args:
+            prefixes: {带平台标识的用户ID: 前缀}
+        """
+        for user_id, prefix in prefixes.items():
+            self.trie.add(prefix, SCOPE_USER, user_id, prefix_type="custom")
+
+    def match(self, bot: Bot, event: Event, state: Dict[str, Any]) -> bool:
+        """
+        判断事件是否需要由Naga处理，匹配时写入state
+
+        写入的字段：plain_text、user_id（带平台标识）、group_id（带平台标识，私聊为None）、adapter、
+        prefix_type、prefix、user_message，
+        自定义前缀匹配时额外写入custom_prefix
+
+        Args:
+            bot: 收到事件的机器人
+            event: 事件
+            state: 事件处理状态
+
+        Returns:
+            bool: 是否匹配
+        """
+        extractor = self.extractor(bot, event)
+        try:
+            plain_text = extractor.get_text(event)
+        except Exception:
+            return False
+        plain_text = plain_text.lstrip() if plain_text else ""
+        if not self.trie.may_match(plain_text):
+            return False
+
+        try:
+            raw_user_id = extractor.get_user_id(event)
+        except Exception:
+            return False
+        if not raw_user_id:
+            return False
+        user_id = extractor.normalize(raw_user_id)
+        owners = [(SCOPE_USER, user_id)]
+        group_id = extractor.group_id(event)
+        if group_id is not None:
+            owners.append((SCOPE_GROUP, group_id))
+        owners.append((SCOPE_GLOBAL, ""))
+
+        matched = self.trie.match(plain_text, owners)
+        if matched is None:
+            return False
+        prefix, prefix_type = matched
+        plain_text = plain_text.rstrip()
+        state["plain_text"] = plain_text
+        state["user_id"] = user_id
+        # 群组ID同样添加平台标识，供按群组限流使用
+        state["group_id"] = extractor.normalize(group_id) if group_id is not None else None
+        state["adapter"] = extractor.adapter_name
+        state["prefix_type"] = prefix_type
+        state["prefix"] = prefix
+        state["user_message"] = plain_text[len(prefix):].lstrip()
+        if prefix_type == "custom":
+            state["custom_prefix"] = prefix
+        return True
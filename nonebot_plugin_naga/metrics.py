@@ -0,0 +1,391 @@
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+from nonebot import logger
+
+from . import plugin_config
+
+
+# 默认延迟分桶（秒），覆盖从快速命令到LLM长回复的范围
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value: str) -> str:
+    """转义标签值"""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    """生成 {name="value",...} 形式的标签文本"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    """格式化样本值"""
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """指标基类，按标签值保存子指标"""
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], "_Metric"] = {}
+
+    def labels(self, *values: str) -> "_Metric":
+        """
+        获取指定标签值的子指标，子指标会被缓存，重复调用只有一次字典查找
+
+        Args:
+            values: 按labelnames顺序排列的标签值
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"指标 {self.name} 需要 {len(self.labelnames)} 个标签值")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self) -> "_Metric":
+        return type(self)(self.name, self.documentation)
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        """返回 (名称后缀, 附加标签, 值) 列表"""
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        """生成Prometheus文本格式的样本行"""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}"
+        ]
+        children = self._children.items() if self.labelnames else [((), self)]
+        for values, child in children:
+            for suffix, extra, value in child._samples():
+                labels = _format_labels(self.labelnames, values, extra)
+                lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        """增加计数"""
+        self.value += amount
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        return [("", "", self.value)]
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值，也可以在采集时通过回调函数读取"""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        """设置当前值"""
+        self.value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        """增加当前值"""
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        """减少当前值"""
+        self.value -= amount
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        采集时调用函数获取当前值，适合由其他组件维护的状态
+
+        Args:
+            function: 返回当前值的函数
+        """
+        self._function = function
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        value = self.value
+        if self._function is not None:
+            try:
+                value = float(self._function())
+            except Exception as e:
+                logger.debug(f"读取指标 {self.name} 失败: {e}")
+        return [("", "", value)]
+
+
+class Histogram(_Metric):
+    """分桶直方图，用于统计延迟等分布"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每个分桶单独计数，输出时再累加
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _new_child(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value: float) -> None:
+        """记录一个观测值"""
+        self._counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> "_Timer":
+        """返回记录代码块耗时的上下文管理器"""
+        return _Timer(self)
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self._counts):
+            cumulative += count
+            samples.append(("_bucket", f'le="{_format_value(bound)}"', cumulative))
+        samples.append(("_sum", "", self.sum))
+        samples.append(("_count", "", self.count))
+        return samples
+
+
+class _Timer:
+    """记录代码块耗时"""
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self) -> "_Timer":
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.monotonic() - self.start)
+
+
+class _NoopMetric:
+    """关闭指标时使用的空实现，所有操作都不做任何事"""
+
+    __slots__ = ()
+
+    def labels(self, *values: str) -> "_NoopMetric":
+        return self
+
+    def inc(self, amount: float = 1.0) -> None:
+        pass
+
+    def dec(self, amount: float = 1.0) -> None:
+        pass
+
+    def set(self, value: float) -> None:
+        pass
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        pass
+
+    def observe(self, value: float) -> None:
+        pass
+
+    def time(self) -> "_NoopMetric":
+        return self
+
+    def __enter__(self) -> "_NoopMetric":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+_NOOP = _NoopMetric()
+
+
+class MetricsRegistry:
+    """
+    指标注册表
+
+    关闭时所有注册方法都返回同一个空实现，埋点处不需要判断是否开启
+    """
+
+    def __init__(self, enabled: bool = True):
+        """
+        初始化注册表
+
+        Args:
+            enabled: 是否开启指标收集
+        """
+        self.enabled = enabled
+        self._metrics: List[_Metric] = []
+
+    def _register(self, metric: _Metric):
+        if not self.enabled:
+            return _NOOP
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        """注册计数器"""
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        """注册瞬时值"""
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        """注册直方图"""
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """生成Prometheus文本格式的全部指标"""
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def error_type(error: BaseException) -> str:
+    """
+    将异常归类为错误类型标签
+
+    Args:
+        error: 异常
+
+    Returns:
+        HTTP状态码错误为 http_<状态码>，其他为异常类名
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return f"http_{error.response.status_code}"
+    return type(error).__name__
+
+
+# 工具调用指标中单独统计的服务，服务名称由LLM生成，不在其中的服务统一计入 other，避免标签取值无限增长
+_KNOWN_SERVICES = frozenset(plugin_config.naga_metrics_services) | frozenset(plugin_config.naga_tool_cache_services)
+
+
+def service_label(service_name: str) -> str:
+    """
+    将MCP服务名称转换为指标标签
+
+    Args:
+        service_name: 工具调用中的服务名称
+
+    Returns:
+        已配置的服务返回服务名称，其他返回 other
+    """
+    if isinstance(service_name, str) and service_name in _KNOWN_SERVICES:
+        return service_name
+    return "other"
+
+
+# 全局指标注册表
+registry = MetricsRegistry(enabled=plugin_config.naga_metrics_enabled)
+
+# NagaAgent 接口调用，每次HTTP请求（包括重试）记录一次
+REQUESTS = registry.counter(
+    "naga_requests_total", "NagaAgent API requests by endpoint and outcome", ("endpoint", "outcome")
+)
+REQUEST_DURATION = registry.histogram(
+    "naga_request_duration_seconds", "NagaAgent API request latency", ("endpoint",)
+)
+ERRORS = registry.counter(
+    "naga_errors_total", "NagaAgent API errors by endpoint and type", ("endpoint", "type")
+)
+
+# 消息处理阶段
+HANDLER_DURATION = registry.histogram(
+    "naga_handler_duration_seconds", "Time spent in each handler stage", ("stage",)
+)
+HANDOFF_ROUNDS = registry.counter("naga_handoff_rounds_total", "Tool call loop iterations")
+HANDOFF_CALLS = registry.counter(
+    "naga_handoff_calls_total", "MCP tool calls by service", ("service",)
+)
+
+RATE_LIMITED = registry.counter(
+    "naga_rate_limited_total", "Messages dropped by the request rate limits", ("scope",)
+)
+MESSAGES_MERGED = registry.counter(
+    "naga_messages_merged_total", "Messages merged into an earlier message by the debounce window"
+)
+
+# 准入控制
+QUEUE_WAIT = registry.histogram(
+    "naga_queue_wait_seconds", "Time requests wait for an admission slot", ("lane",),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+)
+ADMISSION_REJECTED = registry.counter(
+    "naga_admission_rejected_total", "Requests rejected by admission control", ("reason",)
+)
+REQUESTS_CANCELLED = registry.counter(
+    "naga_requests_cancelled_total", "Chat requests cancelled before completion", ("reason",)
+)
+INFLIGHT = registry.gauge("naga_inflight_requests", "Requests currently holding an admission slot")
+QUEUED = registry.gauge("naga_queued_requests", "Requests waiting for an admission slot")
+
+# 会话
+ACTIVE_SESSIONS = registry.gauge("naga_active_sessions", "Users whose session state is cached in memory")
+
+
+def setup_metrics_endpoint(driver) -> None:
+    """
+    通过NoneBot驱动器注册指标采集接口
+
+    Args:
+        driver: NoneBot驱动器，需要支持HTTP服务端（例如FastAPI驱动器）
+    """
+    if not registry.enabled:
+        return
+    try:
+        from nonebot.drivers import URL, ASGIMixin, HTTPServerSetup, Request, Response
+    except ImportError:
+        # ASGIMixin 从 nonebot2 2.2.0 开始提供
+        logger.warning("当前 NoneBot 版本低于 2.2.0，无法提供指标采集接口，指标仍会在内存中收集")
+        return
+
+    if not isinstance(driver, ASGIMixin):
+        logger.warning("当前驱动器不支持HTTP服务端，无法提供指标采集接口")
+        return
+
+    async def handle_metrics(request: Request) -> Response:
+        return Response(
+            200,
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+            content=registry.render()
+        )
+
+    driver.setup_http_server(HTTPServerSetup(
+        path=URL(plugin_config.naga_metrics_path),
+        method="GET",
+        name="naga_metrics",
+        handle_func=handle_metrics
+    ))
+    logger.info(f"指标采集接口已注册: {plugin_config.naga_metrics_path}")
@@ -0,0 +1,168 @@
+import time
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Tuple
+
+
+class RateLimited(Exception):
+    """请求超出频率限制"""
+
+    def __init__(self, scope: str, retry_after: float, notice: bool):
+        """
+        Args:
+            scope: 触发限流的范围，user、group 或 adapter
+            retry_after: 建议等待的秒数
+            notice: 是否需要提示用户，同一限流对象在提示冷却期间只提示一次
+        """
+        super().__init__(f"{scope} rate limited")
+        self.scope = scope
+        self.retry_after = retry_after
+        self.notice = notice
+
+    @property
+    def message(self) -> str:
+        """返回给用户的提示信息"""
+        seconds = max(1, int(self.retry_after + 0.999))
+        if self.scope == "user":
+            return f"⏳ 你发送得太快了，请 {seconds} 秒后再试"
+        if self.scope == "group":
+            return f"⏳ 本群请求过于频繁，请 {seconds} 秒后再试"
+        return f"⏳ 当前请求过多，请 {seconds} 秒后再试"
+
+
+class _Bucket:
+    """一个限流对象的令牌桶"""
+
+    __slots__ = ("tokens", "updated", "noticed")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        # 上次提示被限流的时间
+        self.noticed: Optional[float] = None
+
+
+class TokenBucketLimiter:
+    """
+    按键限流的令牌桶
+
+    每个键的令牌以固定速率补充，最多积累 burst 个，每个请求消耗一个令牌。
+    令牌桶按最近使用时间排列，空闲到令牌已经补满（且提示冷却已过）的桶与新建的桶没有区别，
+    在每次访问时从最久未使用的一端顺带清理，保存的状态只与活跃的键数量有关
+    """
+
+    def __init__(self, rate: float, burst: int, notice_interval: float = 0.0):
+        """
+        初始化限流器
+
+        Args:
+            rate: 每秒补充的令牌数，0表示不限制
+            burst: 令牌桶容量，即允许的突发请求数
+            notice_interval: 同一个键两次提示被限流的最短间隔（秒）
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.notice_interval = notice_interval
+        self._buckets: "OrderedDict[Hashable, _Bucket]" = OrderedDict()
+        # 空闲超过这个时间的桶可以丢弃
+        self._idle_ttl = max(self.burst / rate, notice_interval) if rate > 0 else 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _evict(self, now: float) -> None:
+        """清理最久未使用的空闲令牌桶"""
+        buckets = self._buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if now - bucket.updated < self._idle_ttl:
+                break
+            del buckets[key]
+
+    def _bucket(self, key: Hashable, now: float) -> _Bucket:
+        """获取补充过令牌的桶，不存在时创建一个满的桶"""
+        self._evict(now)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(float(self.burst), now)
+            return bucket
+        self._buckets.move_to_end(key)
+        bucket.tokens = min(float(self.burst), bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        return bucket
+
+    def check(self, key: Hashable, now: float) -> Tuple[_Bucket, float]:
+        """
+        检查键是否还有令牌，不消耗令牌
+
+        Returns:
+            (令牌桶, 需要等待的秒数)，有令牌时等待时间为0
+        """
+        bucket = self._bucket(key, now)
+        if bucket.tokens >= 1.0:
+            return bucket, 0.0
+        return bucket, (1.0 - bucket.tokens) / self.rate
+
+    def should_notice(self, bucket: _Bucket, now: float) -> bool:
+        """是否需要提示被限流，提示冷却期间重复触发的限流静默处理"""
+        if bucket.noticed is not None and now - bucket.noticed < self.notice_interval:
+            return False
+        bucket.noticed = now
+        return True
+
+
+class RequestThrottle:
+    """
+    按用户、群组和适配器分别限流
+
+    三个范围都有令牌时才接纳请求并各消耗一个令牌，任一范围令牌不足时不消耗任何令牌，
+    避免被拒绝的请求继续占用其他范围的额度
+    """
+
+    def __init__(self, user: TokenBucketLimiter, group: TokenBucketLimiter,
+                 adapter: TokenBucketLimiter):
+        """
+        初始化限流器组合
+
+        Args:
+            user: 按用户限流
+            group: 按群组限流
+            adapter: 按适配器限流
+        """
+        self.limiters = (("user", user), ("group", group), ("adapter", adapter))
+        self._active = [(scope, limiter) for scope, limiter in self.limiters if limiter.enabled]
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._active)
+
+    def acquire(self, user_id: str, group_id: Optional[str], adapter: Optional[str]) -> None:
+        """
+        为一个请求消耗令牌
+
+        Args:
+            user_id: 用户ID
+            group_id: 群组ID，私聊为None
+            adapter: 适配器名称
+
+        Raises:
+            RateLimited: 任一范围超出频率限制
+        """
+        if not self._active:
+            return
+        keys = {"user": user_id, "group": group_id, "adapter": adapter}
+        now = time.monotonic()
+        buckets: List[_Bucket] = []
+        for scope, limiter in self._active:
+            key = keys[scope]
+            if key is None:
+                continue
+            bucket, wait = limiter.check(key, now)
+            if wait > 0:
+                raise RateLimited(scope, wait, limiter.should_notice(bucket, now))
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket.tokens -= 1.0
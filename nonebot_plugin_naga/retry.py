@@ -0,0 +1,88 @@
+import random
+from typing import Optional
+
+import httpx
+
+
+# 请求尚未发送到服务端的异常，即使是非幂等请求也可以安全重试
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+# 幂等请求可以重试的HTTP状态码（网关错误和服务暂不可用）
+RETRYABLE_STATUS_CODES = frozenset({502, 503, 504})
+
+
+def is_retryable(error: Exception, idempotent: bool) -> bool:
+    """
+    判断请求失败后是否可以重试
+
+    Args:
+        error: 请求抛出的异常
+        idempotent: 请求是否幂等
+
+    Returns:
+        bool: 是否可以重试
+    """
+    if isinstance(error, httpx.PoolTimeout):
+        # 连接池繁忙时重试只会加剧排队
+        return False
+    if isinstance(error, NOT_SENT_ERRORS):
+        return True
+    if not idempotent:
+        # 非幂等请求可能已经被服务端处理，重试会导致重复执行
+        return False
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, httpx.TransportError)
+
+
+def backoff_delay(attempt: int, base: float, maximum: float) -> float:
+    """
+    计算带随机抖动的指数退避时间（full jitter）
+
+    Args:
+        attempt: 第几次重试，从0开始
+        base: 基础退避时间（秒）
+        maximum: 最大退避时间（秒）
+
+    Returns:
+        本次重试前需要等待的时间（秒）
+    """
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
+
+
+class RetryBudget:
+    """
+    重试预算，限制重试请求占总请求的比例
+
+    每个请求存入ratio个令牌，每次重试消耗一个令牌，
+    后端整体故障时重试次数会被预算限制，避免重试风暴放大负载
+    """
+
+    def __init__(self, ratio: float = 0.2, min_tokens: float = 3.0, max_tokens: Optional[float] = None):
+        """
+        初始化重试预算
+
+        Args:
+            ratio: 每个请求增加的重试令牌数，即重试请求占比上限
+            min_tokens: 初始令牌数，保证低流量时也能重试
+            max_tokens: 令牌上限，默认为min_tokens的10倍
+        """
+        self.ratio = ratio
+        self.max_tokens = max_tokens if max_tokens is not None else max(min_tokens, 1.0) * 10
+        self.tokens = min_tokens
+
+    def deposit(self) -> None:
+        """记录一次请求，增加重试令牌"""
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """
+        尝试消耗一个重试令牌
+
+        Returns:
+            bool: 预算是否允许本次重试
+        """
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
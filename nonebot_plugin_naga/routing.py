@@ -0,0 +1,147 @@
+import hashlib
+from collections import OrderedDict
+from typing import Iterable, List, Optional
+
+from nonebot import logger
+
+from .health import CircuitBreaker
+
+
+def normalize_backend_url(backend: str) -> str:
+    """
+    规范化后端地址
+
+    Args:
+        backend: 后端地址，支持 host:port 或 http(s)://host:port 格式
+
+    Returns:
+        不带末尾斜杠的完整URL
+    """
+    backend = backend.strip().rstrip("/")
+    if "://" not in backend:
+        backend = f"http://{backend}"
+    return backend
+
+
+class Backend:
+    """单个NagaAgent后端节点"""
+
+    def __init__(self, base_url: str, breaker: CircuitBreaker, ewma_alpha: float = 0.3):
+        """
+        初始化后端节点
+
+        Args:
+            base_url: 后端地址
+            breaker: 该节点的熔断器，熔断时节点会被自动摘除
+            ewma_alpha: 延迟指数加权平均的平滑系数
+        """
+        self.base_url = base_url
+        self.breaker = breaker
+        self.ewma_alpha = ewma_alpha
+        self.inflight = 0
+        self.ewma_latency = 0.0
+
+    @property
+    def load(self) -> tuple:
+        """节点负载，先比较进行中的请求数，再比较平均延迟"""
+        return (self.inflight, self.ewma_latency)
+
+    def record_latency(self, seconds: float) -> None:
+        """
+        记录一次请求的延迟
+
+        Args:
+            seconds: 请求耗时（秒）
+        """
+        if self.ewma_latency == 0.0:
+            self.ewma_latency = seconds
+        else:
+            self.ewma_latency = self.ewma_alpha * seconds + (1 - self.ewma_alpha) * self.ewma_latency
+
+    def __repr__(self) -> str:
+        return f"Backend({self.base_url}, inflight={self.inflight}, state={self.breaker.state})"
+
+
+def _rendezvous_score(session_id: str, backend: Backend) -> int:
+    """会话在节点上的最高随机权重哈希（HRW）得分，与进程无关，重启后结果不变"""
+    key = f"{backend.base_url}\0{session_id}".encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+
+class BackendRouter:
+    """
+    后端路由器
+
+    同一会话的请求固定发往同一节点以保持对话上下文：已绑定的会话使用绑定的节点，
+    没有绑定记录（新会话、绑定被淘汰或插件重启）的会话按最高随机权重哈希在可用节点中确定性地选择，
+    节点集合不变时总是落在同一节点；没有会话ID的请求发往负载最低的可用节点，熔断中的节点不参与路由
+    """
+
+    def __init__(self, backends: List[Backend], max_affinity: int = 10000):
+        """
+        初始化路由器
+
+        Args:
+            backends: 后端节点列表
+            max_affinity: 最多记录多少个会话与节点的绑定关系，超出时淘汰最久未使用的
+        """
+        if not backends:
+            raise ValueError("至少需要配置一个NagaAgent后端")
+        self.backends = backends
+        self.max_affinity = max_affinity
+        # 会话与节点的绑定关系 {session_id: Backend}
+        self._affinity: "OrderedDict[str, Backend]" = OrderedDict()
+
+    @property
+    def available(self) -> bool:
+        """是否存在可能可用的节点"""
+        return any(backend.breaker.available for backend in self.backends)
+
+    def pick(self, session_id: Optional[str] = None, exclude: Iterable[Backend] = ()) -> Optional[Backend]:
+        """
+        为请求选择后端节点
+
+        Args:
+            session_id: 会话ID（可选），已绑定的会话优先使用绑定的节点，未绑定的会话按哈希选择
+            exclude: 不参与选择的节点，例如刚刚连接失败的节点
+
+        Returns:
+            选中的节点，没有可用节点时返回None
+        """
+        if len(self.backends) == 1:
+            return self.backends[0]
+
+        if session_id:
+            backend = self._affinity.get(session_id)
+            if backend is not None and backend not in exclude:
+                if backend.breaker.available:
+                    self._affinity.move_to_end(session_id)
+                    return backend
+                logger.warning(f"会话 {session_id} 绑定的节点 {backend.base_url} 不可用，将迁移到其他节点")
+
+        candidates = [
+            backend for backend in self.backends
+            if backend.breaker.available and backend not in exclude
+        ]
+        if not candidates:
+            return None
+        if not session_id:
+            return min(candidates, key=lambda b: b.load)
+        backend = max(candidates, key=lambda b: _rendezvous_score(session_id, b))
+        self.bind(session_id, backend)
+        return backend
+
+    def bind(self, session_id: str, backend: Backend) -> None:
+        """
+        将会话绑定到指定节点
+
+        Args:
+            session_id: 会话ID
+            backend: 后端节点
+        """
+        if len(self.backends) == 1:
+            return
+        self._affinity[session_id] = backend
+        self._affinity.move_to_end(session_id)
+        while len(self._affinity) > self.max_affinity:
+            self._affinity.popitem(last=False)
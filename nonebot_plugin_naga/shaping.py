@@ -0,0 +1,142 @@
+import json
+from typing import Any, Collection
+
+
+# 截断标记
+TRUNCATED_ITEMS_MARKER = "…（省略 {count} 项）"
+TRUNCATED_STRING_MARKER = "…（省略 {count} 字）"
+TRUNCATED_RESULT_MARKER = "…（结果过长，已截断）"
+
+_encoder = json.JSONEncoder(ensure_ascii=False, default=str)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算文本的token数
+
+    中文等非ASCII字符按每字一个token计算，ASCII字符按每4个字符一个token计算
+
+    Args:
+        text: 文本
+
+    Returns:
+        估算的token数
+    """
+    non_ascii = len(text) - len(text.encode("ascii", "ignore"))
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+
+def compact(value: Any, max_items: int = 0, max_string: int = 0,
+            drop_fields: Collection[str] = ()) -> Any:
+    """
+    压缩工具调用结果，不修改原对象
+
+    Args:
+        value: 工具调用结果
+        max_items: 数组最多保留的元素数，0表示不限制
+        max_string: 字符串最多保留的字符数，0表示不限制
+        drop_fields: 需要删除的字段名，对所有层级的对象生效
+
+    Returns:
+        压缩后的结果
+    """
+    if isinstance(value, dict):
+        return {
+            key: compact(item, max_items, max_string, drop_fields)
+            for key, item in value.items()
+            if key not in drop_fields
+        }
+    if isinstance(value, (list, tuple)):
+        items = value
+        if max_items and len(value) > max_items:
+            items = value[:max_items]
+        result = [compact(item, max_items, max_string, drop_fields) for item in items]
+        if len(items) < len(value):
+            result.append(TRUNCATED_ITEMS_MARKER.format(count=len(value) - len(items)))
+        return result
+    if isinstance(value, str) and max_string and len(value) > max_string:
+        return value[:max_string] + TRUNCATED_STRING_MARKER.format(count=len(value) - max_string)
+    return value
+
+
+def _cut(text: str, max_bytes: int = 0, max_tokens: int = 0) -> str:
+    """截取不超过字节数和估算token数限制的最长前缀，限制为0表示不限制"""
+    if max_bytes:
+        text = text.encode("utf-8")[:max_bytes].decode("utf-8", "ignore")
+    if max_tokens and estimate_tokens(text) > max_tokens:
+        # 前缀的估算token数随长度单调不减，二分查找最长的合规前缀
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if estimate_tokens(text[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        text = text[:low]
+    return text
+
+
+def encode_limited(value: Any, max_bytes: int = 0, max_tokens: int = 0) -> str:
+    """
+    流式序列化为JSON，超出大小限制时立即停止
+
+    使用 iterencode 逐块生成，超大结果不需要先完整序列化再截断
+
+    Args:
+        value: 需要序列化的对象
+        max_bytes: 最大UTF-8字节数，0表示不限制
+        max_tokens: 最大估算token数，0表示不限制
+
+    Returns:
+        JSON文本，被截断时以截断标记结尾（此时不再是合法JSON），包括截断标记在内不超过限制
+    """
+    if not max_bytes and not max_tokens:
+        return _encoder.encode(value)
+
+    parts = []
+    used_bytes = 0
+    used_tokens = 0
+    for chunk in _encoder.iterencode(value):
+        chunk_bytes = len(chunk.encode("utf-8"))
+        chunk_tokens = estimate_tokens(chunk) if max_tokens else 0
+        over_bytes = max_bytes and used_bytes + chunk_bytes > max_bytes
+        over_tokens = max_tokens and used_tokens + chunk_tokens > max_tokens
+        if over_bytes or over_tokens:
+            # 为截断标记预留额度后截取已生成的内容，保证加上标记后仍不超过限制；
+            # 限制小于标记本身时只保留截断后的标记
+            parts.append(chunk)
+            text = "".join(parts)
+            marker_bytes = len(TRUNCATED_RESULT_MARKER.encode("utf-8"))
+            marker_tokens = estimate_tokens(TRUNCATED_RESULT_MARKER)
+            if (max_bytes and max_bytes < marker_bytes) or (max_tokens and max_tokens < marker_tokens):
+                return _cut(TRUNCATED_RESULT_MARKER, max_bytes, max_tokens)
+            head = _cut(text, max_bytes and max_bytes - marker_bytes, max_tokens and max_tokens - marker_tokens)
+            return head + TRUNCATED_RESULT_MARKER
+        parts.append(chunk)
+        used_bytes += chunk_bytes
+        used_tokens += chunk_tokens
+    return "".join(parts)
+
+
+def shape_tool_result(result: Any, max_bytes: int = 0, max_tokens: int = 0,
+                      max_items: int = 0, max_string: int = 0,
+                      drop_fields: Collection[str] = ()) -> str:
+    """
+    将工具调用结果整形为发送给LLM的文本
+
+    先删除噪声字段、截断过长的数组和字符串，再流式序列化并限制总大小
+
+    Args:
+        result: 工具调用结果
+        max_bytes: 最大UTF-8字节数，0表示不限制
+        max_tokens: 最大估算token数，0表示不限制
+        max_items: 数组最多保留的元素数，0表示不限制
+        max_string: 字符串最多保留的字符数，0表示不限制
+        drop_fields: 需要删除的字段名
+
+    Returns:
+        序列化后的结果文本
+    """
+    if max_items or max_string or drop_fields:
+        result = compact(result, max_items, max_string, frozenset(drop_fields))
+    return encode_limited(result, max_bytes, max_tokens)
@@ -0,0 +1,165 @@
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Any, List, Optional
+
+
+# 流结束标记
+DONE_SENTINEL = "[DONE]"
+
+# 尚未解析JSON时的占位对象
+_UNPARSED = object()
+
+# SSE只以\r\n、\r或\n作为行结束符，str.splitlines 还会在\x0c、\u2028等字符处断行
+_LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+
+@dataclass
+class SSEEvent:
+    """单个Server-Sent Events事件"""
+    data: str
+    event: str = "message"
+    id: Optional[str] = None
+    retry: Optional[int] = None
+    _json: Any = field(default=_UNPARSED, repr=False, compare=False)
+
+    @property
+    def is_done(self) -> bool:
+        """是否为流结束标记"""
+        return self.data == DONE_SENTINEL
+
+    def json(self) -> Any:
+        """
+        按需将data解析为JSON，解析结果会被缓存
+
+        Returns:
+            解析后的对象，data不是合法JSON时返回None
+        """
+        if self._json is _UNPARSED:
+            try:
+                self._json = json.loads(self.data)
+            except (json.JSONDecodeError, ValueError):
+                self._json = None
+        return self._json
+
+
+class SSEDecoder:
+    """
+    增量式SSE解码器
+
+    网络数据块与SSE事件边界并不对齐，解码器按行缓冲输入，
+    可以处理跨数据块的事件、单个数据块中的多个事件以及\\r\\n等各种换行符
+    """
+
+    def __init__(self):
+        """初始化解码器"""
+        self._buffer = ""
+        self._data: List[str] = []
+        self._event: Optional[str] = None
+        self._id: Optional[str] = None
+        self._retry: Optional[int] = None
+        # 最近一次收到的事件ID，可用于断线重连
+        self.last_event_id: Optional[str] = None
+
+    def feed(self, chunk: str) -> List[SSEEvent]:
+        """
+        输入一段数据
+
+        Args:
+            chunk: 从网络读取到的文本数据块
+
+        Returns:
+            本次输入后完整解析出的事件列表
+        """
+        if not chunk:
+            return []
+        buffer = self._buffer + chunk if self._buffer else chunk
+
+        # 以\r结尾时下一个数据块可能以\n开头，先保留这个\r等待确认是否为\r\n
+        held = ""
+        if buffer.endswith("\r"):
+            buffer, held = buffer[:-1], "\r"
+
+        # 只处理到最后一个换行符为止，剩余的不完整行留到下次
+        end = max(buffer.rfind("\n"), buffer.rfind("\r"))
+        if end == -1:
+            self._buffer = buffer + held
+            return []
+
+        complete, self._buffer = buffer[:end + 1], buffer[end + 1:] + held
+        events = []
+        # 最后一个换行符之后是空字符串，不是一个空行
+        for line in _LINE_BREAK.split(complete)[:-1]:
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def flush(self) -> List[SSEEvent]:
+        """
+        数据流结束时调用，处理缓冲区中剩余的内容
+
+        Returns:
+            剩余的事件列表
+        """
+        events = []
+        if self._buffer:
+            lines = _LINE_BREAK.split(self._buffer)
+            if not lines[-1]:
+                lines.pop()
+            for line in lines:
+                event = self._process_line(line)
+                if event is not None:
+                    events.append(event)
+            self._buffer = ""
+        # 部分服务端在最后一个事件后不发送空行，这里宽松处理
+        event = self._dispatch()
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _process_line(self, line: str) -> Optional[SSEEvent]:
+        """处理单行内容，遇到空行时返回完整事件"""
+        if not line:
+            return self._dispatch()
+        if line[0] == ":":
+            # 注释行，常用作心跳
+            return None
+
+        name, sep, value = line.partition(":")
+        if sep and value.startswith(" "):
+            value = value[1:]
+
+        if name == "data":
+            self._data.append(value)
+        elif name == "event":
+            self._event = value
+        elif name == "id":
+            if "\0" not in value:
+                self._id = value
+        elif name == "retry":
+            if value.isdigit():
+                self._retry = int(value)
+        return None
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        """根据已收集的字段生成事件并重置状态"""
+        if self._id is not None:
+            self.last_event_id = self._id
+        if not self._data:
+            self._event = None
+            self._id = None
+            self._retry = None
+            return None
+
+        event = SSEEvent(
+            data="\n".join(self._data),
+            event=self._event or "message",
+            id=self._id,
+            retry=self._retry
+        )
+        self._data = []
+        self._event = None
+        self._id = None
+        self._retry = None
+        return event
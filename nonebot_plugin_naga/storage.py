@@ -0,0 +1,348 @@
+import asyncio
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+from nonebot import logger
+
+
+# 数据库表结构
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_state (
+    user_id TEXT PRIMARY KEY,
+    active_session TEXT,
+    prefix TEXT
+);
+CREATE TABLE IF NOT EXISTS user_sessions (
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    session_id TEXT,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (user_id, name)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+@dataclass
+class UserState:
+    """单个用户的会话状态"""
+    # 用户的所有会话 {session_name: session_id}，保持创建顺序
+    sessions: Dict[str, Optional[str]] = field(default_factory=dict)
+    # 当前活跃会话名
+    active: Optional[str] = None
+    # 最后访问时间，用于淘汰长时间未使用的用户
+    touched: float = field(default_factory=time.monotonic, repr=False, compare=False)
+
+
+class SessionStore:
+    """
+    基于SQLite的用户会话与前缀存储
+
+    用户会话状态在首次访问时按用户加载到内存，修改后只标记为脏数据，
+    由后台任务批量写回数据库，关闭时再完整写回一次，消息处理路径不会等待磁盘写入。
+    已写回的用户状态超过空闲时间或缓存数量超出上限时会从内存中淘汰，下次访问时重新加载。
+    自定义前缀数据量很小且每条消息都要检查，启动时一次性加载
+    """
+
+    def __init__(self, path: str, flush_interval: float = 2.0,
+                 idle_timeout: float = 7200.0, max_cached_users: int = 10000):
+        """
+        初始化存储
+
+        Args:
+            path: SQLite数据库文件路径，":memory:" 表示不持久化
+            flush_interval: 后台批量写回间隔（秒）
+            idle_timeout: 用户状态在内存中的最长空闲时间（秒），0表示不按时间淘汰
+            max_cached_users: 内存中最多缓存的用户数，0表示不限制
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.idle_timeout = idle_timeout
+        self.max_cached_users = max_cached_users
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        # 已加载到内存的用户状态，按最后访问时间从旧到新排列 {user_id: UserState}
+        self._users: "OrderedDict[str, UserState]" = OrderedDict()
+        # 正在加载中的用户，避免并发重复加载 {user_id: Future}
+        self._loading: Dict[str, asyncio.Future] = {}
+        # 用户自定义前缀 {user_id: prefix}
+        self.prefixes: Dict[str, str] = {}
+        # 等待写回的用户
+        self._dirty: Set[str] = set()
+
+    @property
+    def cached_users(self) -> int:
+        """内存中缓存的用户数"""
+        return len(self._users)
+
+    @property
+    def opened(self) -> bool:
+        """数据库是否已打开"""
+        return self._conn is not None
+
+    async def open(self) -> None:
+        """打开数据库并加载前缀，启动后台写回任务"""
+        async with self._open_lock:
+            if self._conn is not None:
+                return
+            self._conn, self.prefixes = await asyncio.get_running_loop().run_in_executor(None, self._open_sync)
+            logger.info(f"会话存储已打开: {self.path}，已加载 {len(self.prefixes)} 个自定义前缀")
+        if self.flush_interval > 0 and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    def _open_sync(self) -> Tuple[sqlite3.Connection, Dict[str, str]]:
+        """在工作线程中打开数据库"""
+        if self.path != ":memory:":
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        # WAL模式下写入不会阻塞读取，配合NORMAL同步级别减少fsync次数
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        conn.commit()
+        prefixes = dict(conn.execute(
+            "SELECT user_id, prefix FROM user_state WHERE prefix IS NOT NULL AND prefix != ''"
+        ).fetchall())
+        return conn, prefixes
+
+    async def close(self) -> None:
+        """停止后台任务，写回所有脏数据并关闭数据库"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        if self._conn is None:
+            return
+        await self.flush()
+        async with self._db_lock:
+            await asyncio.get_running_loop().run_in_executor(None, self._conn.close)
+            self._conn = None
+        logger.info("会话存储已关闭")
+
+    async def get_user(self, user_id: str) -> UserState:
+        """
+        获取用户会话状态，首次访问时从数据库加载
+
+        Args:
+            user_id: 用户ID
+
+        Returns:
+            用户会话状态，直接修改后需要调用 mark_dirty 以便写回
+        """
+        state = self._users.get(user_id)
+        if state is not None:
+            state.touched = time.monotonic()
+            self._users.move_to_end(user_id)
+            return state
+
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            return await asyncio.shield(loading)
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[user_id] = future
+        try:
+            if self._conn is None:
+                await self.open()
+            async with self._db_lock:
+                state = await asyncio.get_running_loop().run_in_executor(None, self._load_user_sync, user_id)
+            # 加载期间可能已经有其他协程创建了状态
+            state = self._users.setdefault(user_id, state)
+            if self.max_cached_users and len(self._users) > self.max_cached_users:
+                self.evict()
+            future.set_result(state)
+            return state
+        except BaseException as e:
+            future.set_exception(e)
+            # 避免没有等待者时出现未获取异常的警告
+            future.exception()
+            raise
+        finally:
+            self._loading.pop(user_id, None)
+
+    def _load_user_sync(self, user_id: str) -> UserState:
+        """在工作线程中加载单个用户的会话状态"""
+        state = UserState()
+        rows = self._conn.execute(
+            "SELECT name, session_id FROM user_sessions WHERE user_id = ? ORDER BY position",
+            (user_id,)
+        ).fetchall()
+        state.sessions = dict(rows)
+        row = self._conn.execute(
+            "SELECT active_session FROM user_state WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+        if row is not None:
+            state.active = row[0]
+        return state
+
+    def mark_dirty(self, user_id: str) -> None:
+        """
+        标记用户状态已修改，等待后台批量写回
+
+        Args:
+            user_id: 用户ID
+        """
+        self._dirty.add(user_id)
+
+    def get_prefix(self, user_id: str) -> Optional[str]:
+        """
+        获取用户自定义前缀
+
+        Args:
+            user_id: 用户ID
+
+        Returns:
+            自定义前缀，未设置时返回None
+        """
+        return self.prefixes.get(user_id)
+
+    def set_prefix(self, user_id: str, prefix: Optional[str]) -> None:
+        """
+        设置用户自定义前缀
+
+        Args:
+            user_id: 用户ID
+            prefix: 自定义前缀，为None时清除
+        """
+        if prefix:
+            self.prefixes[user_id] = prefix
+        else:
+            self.prefixes.pop(user_id, None)
+        self._dirty.add(user_id)
+
+    async def flush(self) -> None:
+        """将所有脏数据在一个事务中写回数据库"""
+        if not self._dirty or self._conn is None:
+            return
+        dirty, self._dirty = self._dirty, set()
+        # 在事件循环线程中生成快照，避免工作线程读取到正在修改的字典
+        batch: List[Tuple[str, Optional[UserState], Optional[str]]] = []
+        for user_id in dirty:
+            state = self._users.get(user_id)
+            if state is not None:
+                state = UserState(sessions=dict(state.sessions), active=state.active)
+            batch.append((user_id, state, self.prefixes.get(user_id)))
+        try:
+            async with self._db_lock:
+                await asyncio.get_running_loop().run_in_executor(None, self._write_batch_sync, batch)
+        except Exception as e:
+            # 写入失败时保留脏标记，下次重试
+            self._dirty.update(dirty)
+            logger.error(f"会话存储写回失败: {e}")
+            return
+        logger.debug(f"会话存储已写回 {len(batch)} 个用户")
+
+    def _write_batch_sync(self, batch: List[Tuple[str, Optional[UserState], Optional[str]]]) -> None:
+        """在工作线程中批量写入"""
+        with self._conn:
+            for user_id, state, prefix in batch:
+                if state is None:
+                    # 用户会话状态未加载，只更新前缀
+                    self._conn.execute(
+                        "INSERT INTO user_state (user_id, prefix) VALUES (?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET prefix = excluded.prefix",
+                        (user_id, prefix)
+                    )
+                    continue
+                self._conn.execute(
+                    "INSERT INTO user_state (user_id, active_session, prefix) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET "
+                    "active_session = excluded.active_session, prefix = excluded.prefix",
+                    (user_id, state.active, prefix)
+                )
+                self._conn.execute("DELETE FROM user_sessions WHERE user_id = ?", (user_id,))
+                self._conn.executemany(
+                    "INSERT INTO user_sessions (user_id, name, session_id, position) VALUES (?, ?, ?, ?)",
+                    [
+                        (user_id, name, session_id, position)
+                        for position, (name, session_id) in enumerate(state.sessions.items())
+                    ]
+                )
+
+    async def reserve_counter(self, key: str, count: int, initial: int = 0,
+                              legacy_initial: Optional[int] = None) -> int:
+        """
+        从持久化计数器中预留一段连续的值，预留结果立即提交到数据库
+
+        Args:
+            key: 计数器名称
+            count: 预留数量
+            initial: 计数器不存在时的初始值
+            legacy_initial: 计数器不存在但数据库中已有旧版本会话数据时使用的初始值
+
+        Returns:
+            预留区间的起始值，区间为 [start, start + count)
+        """
+        if self._conn is None:
+            await self.open()
+        async with self._db_lock:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self._reserve_counter_sync, key, count, initial, legacy_initial
+            )
+
+    def _reserve_counter_sync(self, key: str, count: int, initial: int,
+                              legacy_initial: Optional[int]) -> int:
+        """在工作线程中预留计数器区间"""
+        with self._conn:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                start = row[0]
+            elif legacy_initial is not None and self._conn.execute(
+                "SELECT 1 FROM user_sessions WHERE LENGTH(session_id) = 6 "
+                "AND session_id NOT GLOB '*[^0-9]*' LIMIT 1"
+            ).fetchone():
+                start = legacy_initial
+            else:
+                start = initial
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, start + count)
+            )
+        return start
+
+    def evict(self) -> int:
+        """
+        从内存中淘汰空闲超时或超出缓存上限的用户状态
+
+        用户按最后访问时间排列，只需从头部开始检查，尚未写回的用户会被跳过
+
+        Returns:
+            淘汰的用户数量
+        """
+        now = time.monotonic()
+        overflow = len(self._users) - self.max_cached_users if self.max_cached_users else 0
+        victims = []
+        for user_id, state in self._users.items():
+            idle = self.idle_timeout > 0 and now - state.touched > self.idle_timeout
+            if not idle and len(victims) >= overflow:
+                break
+            if user_id in self._dirty:
+                continue
+            victims.append(user_id)
+        for user_id in victims:
+            del self._users[user_id]
+        return len(victims)
+
+    async def _flush_loop(self) -> None:
+        """后台定期写回任务，写回后淘汰不再需要保留在内存中的用户状态"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            evicted = self.evict()
+            if evicted:
+                logger.debug(f"已从内存中淘汰 {evicted} 个用户的会话状态")
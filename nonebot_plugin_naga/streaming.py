@@ -0,0 +1,102 @@
+from typing import List
+
+
+# 句子结束符，遇到这些字符时可以切分发送
+SENTENCE_ENDINGS = frozenset("。！？!?；;…\n")
+
+# 工具调用起始符，出现后的内容需要等待完整回复后再判断是否发送
+HANDOFF_MARKERS = ("｛", "{")
+
+
+class ReplyChunker:
+    """流式回复分段器，将流式文本按句子或长度切分为适合发送的片段"""
+    
+    def __init__(self, min_chars: int = 30, max_chars: int = 300):
+        """
+        初始化分段器
+        
+        Args:
+            min_chars: 片段最小长度，短句会与后续内容合并后再发送
+            max_chars: 片段最大长度，超过时即使没有句子结束符也强制切分
+        """
+        self.min_chars = max(1, min_chars)
+        self.max_chars = max(self.min_chars, max_chars)
+        self._buffer = ""
+        self._held = False  # 是否遇到了可能的工具调用内容
+        self.full_text = ""  # 累计收到的完整回复
+    
+    def feed(self, text: str) -> List[str]:
+        """
+        追加一段流式文本
+        
+        Args:
+            text: 新收到的文本
+            
+        Returns:
+            可以立即发送的片段列表
+        """
+        if not text:
+            return []
+        self.full_text += text
+        if self._held:
+            self._buffer += text
+            return []
+        
+        # 工具调用内容不应以原始JSON的形式发送给用户，遇到起始符后暂停分段
+        marker_pos = min(
+            (pos for pos in (text.find(m) for m in HANDOFF_MARKERS) if pos != -1),
+            default=-1
+        )
+        if marker_pos != -1:
+            self._held = True
+            ready = self._split(self._buffer + text[:marker_pos], final=True)
+            self._buffer = text[marker_pos:]
+            return ready
+        
+        self._buffer += text
+        return self._split_buffer()
+    
+    def flush(self, include_held: bool = True) -> List[str]:
+        """
+        结束流式输出，返回剩余的所有片段
+        
+        Args:
+            include_held: 是否包含遇到工具调用起始符后暂存的内容
+            
+        Returns:
+            剩余片段列表
+        """
+        if self._held and not include_held:
+            self._buffer = ""
+            return []
+        chunks = self._split(self._buffer, final=True)
+        self._buffer = ""
+        return chunks
+    
+    def _split_buffer(self) -> List[str]:
+        """从缓冲区中切出已完成的片段，未完成的部分保留在缓冲区"""
+        chunks = []
+        start = 0
+        last_end = -1
+        for i, char in enumerate(self._buffer):
+            if char in SENTENCE_ENDINGS:
+                last_end = i
+            length = i + 1 - start
+            # 按实际切出的片段长度判断，片段只到最后一个句子结束符为止
+            if last_end >= start and last_end + 1 - start >= self.min_chars:
+                chunks.append(self._buffer[start:last_end + 1])
+                start = last_end + 1
+            elif length >= self.max_chars:
+                chunks.append(self._buffer[start:i + 1])
+                start = i + 1
+        self._buffer = self._buffer[start:]
+        return [chunk.strip() for chunk in chunks if chunk.strip()]
+    
+    def _split(self, text: str, final: bool) -> List[str]:
+        """切分一段文本，final为True时剩余内容也作为最后一个片段返回"""
+        self._buffer = text
+        chunks = self._split_buffer()
+        if final and self._buffer.strip():
+            chunks.append(self._buffer.strip())
+        self._buffer = ""
+        return chunks
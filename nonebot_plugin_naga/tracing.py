@@ -0,0 +1,467 @@
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from nonebot import logger
+from nonebot.exception import MatcherException
+
+from . import plugin_config
+
+
+class Span:
+    """
+    一个处理阶段的耗时记录
+
+    开始时间为Unix时间戳，便于导出到外部系统；耗时使用单调时钟计算
+    """
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start", "duration",
+                 "attributes", "status", "_started")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str],
+                 attributes: Dict[str, Any], start: Optional[float] = None):
+        self.trace = trace
+        self.name = name
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        now = time.time()
+        self.start = now if start is None else start
+        self.duration: Optional[float] = None
+        self.attributes = attributes
+        # ok、error 或 cancelled
+        self.status = "ok"
+        # 通过start指定了更早的开始时间时，耗时包括已经过去的部分
+        self._started = time.perf_counter() - (now - self.start)
+        trace.spans.append(self)
+
+    def set(self, **attributes: Any) -> None:
+        """添加或更新属性"""
+        self.attributes.update(attributes)
+
+    def end(self, status: Optional[str] = None, **attributes: Any) -> None:
+        """
+        结束阶段，重复调用时只有第一次生效
+
+        Args:
+            status: 阶段状态，不指定时保持原状态
+            attributes: 需要补充的属性
+        """
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        if status is not None:
+            self.status = status
+        if attributes:
+            self.attributes.update(attributes)
+
+    def fail(self, error: BaseException) -> None:
+        """根据异常设置阶段状态，Matcher的流程控制异常不算失败"""
+        if isinstance(error, MatcherException):
+            return
+        if isinstance(error, asyncio.CancelledError):
+            self.status = "cancelled"
+            return
+        self.status = "error"
+        self.attributes["error"] = type(error).__name__
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为可以序列化为JSON的字典"""
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "status": self.status,
+            "attributes": self.attributes
+        }
+
+
+class _NoopSpan:
+    """没有进行中的追踪或追踪未被记录时使用的空实现"""
+
+    __slots__ = ()
+
+    trace = None
+    span_id = None
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def end(self, status: Optional[str] = None, **attributes: Any) -> None:
+        pass
+
+    def fail(self, error: BaseException) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """一条消息处理过程中的全部阶段"""
+
+    __slots__ = ("trace_id", "sampled", "spans")
+
+    def __init__(self, sampled: bool):
+        # 与OpenTelemetry相同的128位追踪ID
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.sampled = sampled
+        self.spans: List[Span] = []
+
+    @property
+    def root(self) -> Span:
+        return self.spans[0]
+
+
+class Exporter:
+    """追踪导出器基类"""
+
+    def export(self, trace: Trace) -> None:
+        """导出一条已完成的追踪"""
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """写出尚未完成的导出并释放资源"""
+
+
+def _format_attributes(attributes: Dict[str, Any]) -> str:
+    return " ".join(f"{key}={value}" for key, value in attributes.items())
+
+
+class LogExporter(Exporter):
+    """以阶段树的形式输出到日志"""
+
+    def export(self, trace: Trace) -> None:
+        children: Dict[Optional[str], List[Span]] = {}
+        for span in trace.spans:
+            children.setdefault(span.parent_id, []).append(span)
+        lines = []
+        # 深度优先遍历，子阶段按开始时间排列在父阶段下方
+        stack = [(span, 0) for span in reversed(children.get(None, []))]
+        while stack:
+            span, level = stack.pop()
+            line = f"{'  ' * level}{span.name} {(span.duration or 0.0) * 1000:.1f}ms"
+            if span.status != "ok":
+                line += f" [{span.status}]"
+            if span.attributes:
+                line += f" {_format_attributes(span.attributes)}"
+            lines.append(line)
+            for child in sorted(children.get(span.span_id, []), key=lambda s: s.start, reverse=True):
+                stack.append((child, level + 1))
+        logger.info(f"追踪 {trace.trace_id}:\n" + "\n".join(lines))
+
+
+class JsonlExporter(Exporter):
+    """
+    每个阶段一行JSON追加写入文件
+
+    导出时只把追踪放入待写队列，由后台写入任务在线程中序列化并写入文件，不阻塞事件循环
+    """
+
+    # 待写队列的最大追踪数，磁盘写入跟不上时丢弃新的追踪
+    MAX_PENDING = 10000
+
+    def __init__(self, path: str):
+        """
+        初始化导出器
+
+        Args:
+            path: 输出文件路径
+        """
+        self.path = path
+        self._file = None
+        self._pending: List[Trace] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def export(self, trace: Trace) -> None:
+        if len(self._pending) >= self.MAX_PENDING:
+            logger.warning("追踪写入跟不上，已丢弃一条追踪")
+            return
+        self._pending.append(trace)
+        if self._writer is None:
+            self._wakeup = asyncio.Event()
+            self._writer = asyncio.get_running_loop().create_task(self._write_loop())
+        self._wakeup.set()
+
+    async def _write_loop(self) -> None:
+        """后台写入任务，每次被唤醒时写出队列中的全部追踪"""
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await self._drain()
+            if self._closing:
+                return
+
+    async def _drain(self) -> None:
+        while self._pending:
+            traces, self._pending = self._pending, []
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write, traces)
+            except Exception as e:
+                logger.warning(f"追踪写入失败: {e}")
+
+    def _write(self, traces: List[Trace]) -> None:
+        """在线程中执行的序列化和写入"""
+        if self._file is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        # 一批追踪的所有阶段合并为一次写入
+        self._file.write("".join(
+            json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n"
+            for trace in traces
+            for span in trace.spans
+        ))
+        self._file.flush()
+
+    async def close(self) -> None:
+        self._closing = True
+        if self._writer is not None:
+            self._wakeup.set()
+            await self._writer
+            self._writer = None
+        await self._drain()
+        if self._file is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._file.close)
+            self._file = None
+
+
+class OpenTelemetryExporter(Exporter):
+    """
+    转发到OpenTelemetry
+
+    按记录的开始时间和耗时重建阶段，导出方式由OpenTelemetry SDK的配置决定，
+    插件只使用 opentelemetry-api
+    """
+
+    def __init__(self):
+        from opentelemetry import trace as otel_trace
+        from opentelemetry.trace import Status, StatusCode
+
+        self._otel_trace = otel_trace
+        self._error_status = Status(StatusCode.ERROR)
+        self._tracer = otel_trace.get_tracer("nonebot_plugin_naga")
+
+    def export(self, trace: Trace) -> None:
+        otel_spans = {}
+        # 父阶段总是先于子阶段创建，按记录顺序重建即可
+        for span in trace.spans:
+            parent = otel_spans.get(span.parent_id)
+            context = self._otel_trace.set_span_in_context(parent) if parent is not None else None
+            attributes = {
+                key: value if isinstance(value, (str, bool, int, float)) else str(value)
+                for key, value in span.attributes.items()
+            }
+            attributes["naga.trace_id"] = trace.trace_id
+            otel_span = self._tracer.start_span(
+                span.name, context=context, attributes=attributes, start_time=int(span.start * 1e9)
+            )
+            if span.status == "error":
+                otel_span.set_status(self._error_status)
+            otel_spans[span.span_id] = otel_span
+        for span in trace.spans:
+            otel_spans[span.span_id].end(end_time=int((span.start + (span.duration or 0.0)) * 1e9))
+
+
+def create_exporters(names: Sequence[str], path: str) -> List[Exporter]:
+    """
+    按名称创建导出器，无法创建的导出器会被跳过
+
+    Args:
+        names: 导出器名称，可选 log、jsonl、otel
+        path: jsonl导出器的输出文件路径
+
+    Returns:
+        导出器列表
+    """
+    exporters: List[Exporter] = []
+    for name in names:
+        if name == "log":
+            exporters.append(LogExporter())
+        elif name == "jsonl":
+            exporters.append(JsonlExporter(path))
+        elif name == "otel":
+            if importlib.util.find_spec("opentelemetry") is None:
+                logger.warning("未安装 opentelemetry-api，无法导出到OpenTelemetry，请使用 pip install opentelemetry-api 安装")
+                continue
+            exporters.append(OpenTelemetryExporter())
+        else:
+            logger.warning(f"未知的追踪导出器: {name}")
+    return exporters
+
+
+# 当前协程所在的阶段，子任务创建时自动继承
+_current_span: ContextVar[Optional[Span]] = ContextVar("naga_current_span", default=None)
+
+
+class Tracer:
+    """
+    轻量追踪器
+
+    每条消息生成一个追踪ID，各处理阶段记录为父子关系的阶段。
+    按采样比例在消息开始时决定是否导出；设置了慢请求阈值时所有消息都会记录阶段，
+    结束时总耗时超过阈值的消息即使未被采样也会导出，便于排查长尾延迟。
+    没有配置导出器时所有操作都是空操作
+    """
+
+    def __init__(self, exporters: Sequence[Exporter], sample_rate: float = 1.0,
+                 slow_threshold: float = 0.0):
+        """
+        初始化追踪器
+
+        Args:
+            exporters: 导出器列表
+            sample_rate: 采样比例，0到1之间
+            slow_threshold: 慢请求阈值（秒），0表示只按采样比例导出
+        """
+        self.exporters = list(exporters)
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.exporters)
+
+    @contextmanager
+    def trace(self, name: str, start: Optional[float] = None, **attributes: Any) -> Iterator[Span]:
+        """
+        开始一条新追踪，返回根阶段
+
+        Args:
+            name: 根阶段名称
+            start: 开始时间（Unix时间戳），默认为当前时间
+            attributes: 根阶段属性
+        """
+        if not self.exporters:
+            yield NOOP_SPAN
+            return
+        sampled = self.sample_rate >= 1.0 or random.random() < self.sample_rate
+        if not sampled and self.slow_threshold <= 0:
+            yield NOOP_SPAN
+            return
+        root = Span(Trace(sampled), name, None, attributes, start)
+        token = _current_span.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            root.fail(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            root.end()
+            self._finish(root.trace)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """
+        在当前追踪中记录一个阶段，期间创建的阶段都是它的子阶段
+
+        Args:
+            name: 阶段名称
+            attributes: 阶段属性
+        """
+        parent = _current_span.get()
+        if parent is None:
+            yield NOOP_SPAN
+            return
+        span = Span(parent.trace, name, parent.span_id, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.fail(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    def start_span(self, name: str, **attributes: Any) -> Span:
+        """
+        开始一个需要手动调用 end 结束的阶段，它不会成为后续阶段的父阶段
+
+        Args:
+            name: 阶段名称
+            attributes: 阶段属性
+        """
+        parent = _current_span.get()
+        if parent is None:
+            return NOOP_SPAN
+        return Span(parent.trace, name, parent.span_id, attributes)
+
+    def record_span(self, name: str, duration: float, start: Optional[float] = None,
+                    **attributes: Any) -> None:
+        """
+        记录一个已经结束的阶段
+
+        Args:
+            name: 阶段名称
+            duration: 耗时（秒）
+            start: 开始时间（Unix时间戳），默认为当前时间减去耗时
+            attributes: 阶段属性
+        """
+        parent = _current_span.get()
+        if parent is None:
+            return
+        span = Span(parent.trace, name, parent.span_id, attributes,
+                    time.time() - duration if start is None else start)
+        span.duration = duration
+
+    def headers(self, span: Optional[Span] = None) -> Dict[str, str]:
+        """
+        生成W3C Trace Context请求头，将追踪ID传递给NagaAgent
+
+        Args:
+            span: 发出请求的阶段，默认为当前阶段
+
+        Returns:
+            没有进行中的追踪时返回空字典
+        """
+        if span is None or span.trace is None:
+            span = _current_span.get()
+        if span is None:
+            return {}
+        flags = "01" if span.trace.sampled else "00"
+        return {"traceparent": f"00-{span.trace.trace_id}-{span.span_id}-{flags}"}
+
+    def _finish(self, trace: Trace) -> None:
+        """根据采样结果和总耗时决定是否导出"""
+        duration = trace.root.duration or 0.0
+        if not trace.sampled and duration < self.slow_threshold:
+            return
+        for exporter in self.exporters:
+            try:
+                exporter.export(trace)
+            except Exception as e:
+                logger.warning(f"追踪导出失败 ({type(exporter).__name__}): {e}")
+
+    async def close(self) -> None:
+        """写出尚未完成的导出并关闭所有导出器"""
+        for exporter in self.exporters:
+            try:
+                await exporter.close()
+            except Exception as e:
+                logger.warning(f"追踪导出器关闭失败 ({type(exporter).__name__}): {e}")
+
+
+def current_trace_id() -> Optional[str]:
+    """当前协程所在追踪的ID，没有进行中的追踪时返回None"""
+    span = _current_span.get()
+    return span.trace.trace_id if span is not None else None
+
+
+# 全局追踪器
+tracer = Tracer(
+    create_exporters(plugin_config.naga_trace_exporters, plugin_config.naga_trace_file),
+    sample_rate=plugin_config.naga_trace_sample_rate,
+    slow_threshold=plugin_config.naga_trace_slow_threshold
+)
@@ -1,61 +1,176 @@
 import re
 import json
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 
 
-def parse_handoff_content(content: str) -> Optional[Dict[str, Any]]:
+# 扫描时需要关注的字符：两种大括号、字符串引号和转义符，其余字符由正则一次跳过
+_SCAN_PATTERN = re.compile(r'[{}｛｝"\\]')
+_OPENERS = frozenset("{｛")
+_CLOSERS = frozenset("}｝")
+# JSON中字符串之前（忽略空白）只会出现的字符
+_STRING_LEADERS = frozenset("{｛[,:")
+_JSON_WHITESPACE = frozenset(" \t\r\n")
+
+# 已闭合的对象：(起始位置, 结束位置, 已闭合的直接子对象)
+_Span = Tuple[int, int, list]
+
+
+def _to_tool_call(text: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
     """
-    解析LLM返回的工具调用格式内容（JSON格式）
-    支持两种格式：
-    1. 特殊括号格式：｛"agentType": "mcp", "service_name": "...", ...｝
-    2. 标准JSON格式：{"agentType": "mcp", "service_name": "...", ...}
+    尝试将一个大括号对象解析为工具调用
     
     Args:
-        content: 包含工具调用格式的文本
-        
+        text: 以大括号开头和结尾的文本，外层可以是全角括号
+    
     Returns:
-        解析后的字典，包含service_name和参数，如果未找到则返回None
+        (是否为合法JSON, 工具调用)，合法JSON但不是MCP工具调用时工具调用为None
     """
-    # 查找JSON格式的工具调用，支持标准JSON格式和特殊括号格式
-    # 首先尝试查找特殊括号格式 ｛...｝
-    special_pattern = r'｛([\s\S]*?)｝'
-    special_match = re.search(special_pattern, content)
-    
-    if special_match:
-        try:
-            # 提取并解析JSON内容
-            json_content = "{" + special_match.group(1).strip() + "}"
-            tool_args = json.loads(json_content)
-        except json.JSONDecodeError:
-            return None
-    else:
-        # 如果没有特殊括号格式，尝试查找标准JSON格式
-        # 查找包含agentType和service_name的JSON对象
-        standard_pattern = r'\{[^{}]*"agentType"\s*:\s*"[^"]*"[^{}]*"service_name"\s*:\s*"[^"]*"[^{}]*\}'
-        standard_match = re.search(standard_pattern, content)
-        if not standard_match:
-            return None
-            
-        try:
-            tool_args = json.loads(standard_match.group(0))
-        except json.JSONDecodeError:
-            return None
-    
-    # 检查agentType是否为mcp
-    agent_type = tool_args.get('agentType')
-    if agent_type != 'mcp':
-        return None
-        
-    # 获取服务名称
+    try:
+        # 全角括号格式只替换最外层，内部嵌套对象使用标准括号
+        tool_args = json.loads("{" + text[1:-1] + "}")
+    except (ValueError, RecursionError):
+        # JSONDecodeError 是 ValueError 的子类，嵌套过深的合法JSON会触发 RecursionError
+        return False, None
+    
+    # 检查agentType是否为mcp，并获取服务名称
+    if not isinstance(tool_args, dict) or tool_args.get('agentType') != 'mcp':
+        return True, None
     service_name = tool_args.get('service_name')
     if not service_name:
-        return None
-        
+        return True, None
+    
     # 提取参数（排除service_name和agentType）
-    params = {k: v for k, v in tool_args.items() 
-             if k not in ['service_name', 'agentType']}
+    params = {k: v for k, v in tool_args.items()
+              if k not in ('service_name', 'agentType')}
     
-    return {
+    return True, {
         "service_name": service_name,
         "params": params
-    }
\ No newline at end of file
+    }
+
+
+def _collect(content: str, span: _Span, calls: List[Dict[str, Any]]) -> None:
+    """
+    解析一个顶层对象，本身不是合法JSON时继续尝试其中完整的子对象
+
+    使用显式栈按出现顺序遍历，嵌套层数很多时也不会超出递归深度限制
+    """
+    pending = [span]
+    while pending:
+        start, end, children = pending.pop()
+        if content.find("agentType", start, end + 1) == -1:
+            # 对象及其子对象都不可能是工具调用，省去JSON解析
+            continue
+        valid, call = _to_tool_call(content[start:end + 1])
+        if call is not None:
+            calls.append(call)
+        elif not valid:
+            pending.extend(reversed(children))
+
+
+def _opens_string(content: str, pos: int) -> bool:
+    """对象内pos处的引号是否处在JSON中字符串可以开始的位置，文本中随手写的引号返回False"""
+    pos -= 1
+    while pos >= 0 and content[pos] in _JSON_WHITESPACE:
+        pos -= 1
+    return pos >= 0 and content[pos] in _STRING_LEADERS
+
+
+def _scan_handoff_calls(content: str, begin: int, calls: List[Dict[str, Any]]) -> int:
+    """
+    从begin开始扫描一遍文本，将找到的工具调用追加到calls
+    
+    Returns:
+        需要重新扫描的起始位置，不需要时返回-1
+    """
+    # 未闭合的对象栈
+    stack: List[Tuple[int, list]] = []
+    in_string = False
+    # 当前字符串的起始引号位置
+    string_start = -1
+    # 被转义的字符位置，扫描到该位置时跳过
+    escaped = -1
+    
+    for match in _SCAN_PATTERN.finditer(content, begin):
+        pos = match.start()
+        char = match.group()
+        if pos == escaped:
+            continue
+        if in_string:
+            if char == "\\":
+                escaped = pos + 1
+            elif char == '"':
+                in_string = False
+            continue
+        if char == "\\":
+            # JSON的字符串之外不会出现转义符，普通文本中的 \" 不作为字符串的开始
+            escaped = pos + 1
+        elif char in _OPENERS:
+            stack.append((pos, []))
+        elif char in _CLOSERS:
+            if not stack:
+                # 多余的右括号，属于普通文本
+                continue
+            start, children = stack.pop()
+            span = (start, pos, children)
+            if stack:
+                stack[-1][1].append(span)
+            else:
+                _collect(content, span, calls)
+        elif char == '"' and stack and _opens_string(content, pos):
+            # 对象外的引号和紧跟在普通文字后的引号属于普通文本，不影响括号配对
+            in_string = True
+            string_start = pos
+    
+    # 始终未闭合的左括号属于普通文本，其中已经完整的对象仍然需要解析
+    for _, children in stack:
+        for child in children:
+            _collect(content, child, calls)
+    
+    if in_string:
+        # 不成对的引号之后的内容都被当作字符串跳过了，把这个引号视为普通文本，从它之后重新扫描。
+        # 跳过的内容中没有未转义的引号，重新扫描时不会再进入字符串，每个字符最多扫描两次
+        return string_start + 1
+    return -1
+
+
+def parse_handoff_calls(content: str) -> List[Dict[str, Any]]:
+    """
+    解析LLM回复中的所有工具调用（JSON格式）
+    支持两种格式，两种括号可以互相嵌套：
+    1. 特殊括号格式：｛"agentType": "mcp", "service_name": "...", ...｝
+    2. 标准JSON格式：{"agentType": "mcp", "service_name": "...", ...}
+    
+    单次扫描按括号配对切分出顶层对象，正确跳过字符串中的括号和转义字符，
+    因此参数中可以包含嵌套对象和数组，整体耗时与回复长度成线性关系；
+    只有出现在JSON中字符串可以开始的位置的引号才开始字符串，文本中随手写的引号不影响括号配对；
+    仍然出现不成对的引号时，从该引号之后重新扫描，避免之后的工具调用被当作字符串跳过
+    
+    Args:
+        content: 包含工具调用格式的文本
+    
+    Returns:
+        按出现顺序排列的工具调用列表，每项包含service_name和参数，未找到时返回空列表
+    """
+    calls: List[Dict[str, Any]] = []
+    if not content or ("{" not in content and "｛" not in content):
+        return calls
+    
+    begin = 0
+    while begin != -1:
+        begin = _scan_handoff_calls(content, begin, calls)
+    return calls
+
+
+def parse_handoff_content(content: str) -> Optional[Dict[str, Any]]:
+    """
+    解析LLM返回的第一个工具调用，格式说明见 parse_handoff_calls
+    
+    Args:
+        content: 包含工具调用格式的文本
+    
+    Returns:
+        解析后的字典，包含service_name和参数，如果未找到则返回None
+    """
+    calls = parse_handoff_calls(content)
+    return calls[0] if calls else None